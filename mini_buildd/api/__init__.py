@@ -3,9 +3,18 @@ from __future__ import unicode_literals
 
 import os
 import copy
+import contextlib
+import collections
+import json
+import datetime
 import logging
 
+import mini_buildd.setup
 import mini_buildd.misc
+import mini_buildd.blobs
+import mini_buildd.transfer
+import mini_buildd.reprepro
+import mini_buildd.gnupg
 
 LOG = logging.getLogger(__name__)
 
@@ -106,6 +115,15 @@ different components), or just as safeguard
                         cls.ADMIN: "super user login"}
         return "{doc}\n\n[auth level {auth_level}: {auth_string}]".format(doc=cls.__doc__, auth_level=cls.AUTH, auth_string=auth_strings[cls.AUTH])
 
+    def get_stream(self):
+        "Get result as iterator of unicode chunks (commands with streamed output only; None for all others)."
+        return None
+
+    def get_json(self):
+        "Get result as JSON: All public attributes (like the pickled object for 'python' output)."
+        return json.dumps(dict((k, v) for k, v in self.__getstate__().items() if k[0] != "_" and k != "args_help"),
+                          default=unicode, sort_keys=True)
+
     def has_flag(self, flag):
         return self.args.get(flag, "False") == "True"
 
@@ -127,11 +145,22 @@ class Status(Command):
         self.ftp = ""
         self.running = False
         self.load = 0.0
+        self.build_workers = 1
+        self.build_runtime = None
+        self.chroot_runtimes = {}
         self.chroots = {}
         self.repositories = {}
         self.remotes = {}
+        self.transfers = {}
+        self.exports = {}
+        # Features of this instance remotes may rely on ("blobs": understands blob manifests, see mini_buildd.blobs)
+        self.capabilities = ["blobs"]
+        self.verifications = {}
+        self.signatures = {}
         self.packaging = []
         self.building = []
+        self.incoming = []
+        self.queued = []
 
     def run(self, daemon):
         # version string
@@ -149,6 +178,13 @@ class Status(Command):
         # float value: 0 =< load <= 1+
         self.load = daemon.build_queue.load
 
+        # int, float value (seconds; None if unknown): For remote builder selection
+        self.build_workers = daemon.build_queue.workers
+        self.build_runtime = daemon.build_queue.runtime
+
+        # chroot_runtimes: {"jessie:amd64": SECONDS}: Average build time per chroot (for remote builder selection)
+        self.chroot_runtimes = daemon.build_queue.history.get_chroots()
+
         # chroots: {"squeeze": ["i386", "amd64"], "wheezy": ["amd64"]}
         for c in daemon.get_active_chroots():
             self.chroots.setdefault(c.source.codename, [])
@@ -161,9 +197,24 @@ class Status(Command):
         # remotes: ["host1.xyz.org:8066", "host2.xyz.org:8066"]
         self.remotes = [r.http for r in daemon.get_active_or_auto_reactivate_remotes()]
 
+        # transfers: {"host1.xyz.org:8067": {"files": N, "bytes": N, "seconds": N, "throughput": BYTES_PER_SECOND}}
+        self.transfers = mini_buildd.transfer.get_stats()
+
+        # exports: {"repo1": {"distributions": ["sid-repo1-unstable"], "due": SECONDS}}
+        self.exports = dict((os.path.basename(basedir), e) for basedir, e in mini_buildd.reprepro.EXPORTER.pending().items())
+
+        # verifications: {"verifications": N, "cached": N, "failed": N, "latency": SECONDS, "max": SECONDS}
+        self.verifications = mini_buildd.gnupg.VERIFIER.get_stats()
+
+        # signatures: {"signatures": N, "latency": SECONDS, "max": SECONDS}
+        self.signatures = mini_buildd.gnupg.get_sign_stats()
+
         # packaging/building: string/unicode
         self.packaging = ["{0}".format(p) for p in daemon.packages.values()]
         self.building = ["{0}".format(b) for b in daemon.builds.values()]
+        # queued (incoming/builder): string/unicode with queue position and estimated start
+        self.incoming = ["{0}".format(j) for j in daemon.incoming_queue.pending()]
+        self.queued = ["{0}".format(j) for j in daemon.build_queue.pending()]
 
         self._plain_result = """\
 http://{h} ({v}):
@@ -173,11 +224,19 @@ Daemon: {ds}: ftp://{f} (load {l})
 Repositories: {r}
 Chroots     : {c}
 Remotes     : {rm}
+Transfers   : {t}
+Exports     : {e}
+Verify      : {vf}
+Sign        : {sg}
 
 Packager: {p_len} packaging
 {p}
+Incoming: {i_len} queued
+{i}
 Builder: {b_len} building
-{b}""".format(h=self.http,
+{b}
+Queue: {q_len} queued
+{q}""".format(h=self.http,
               v=self.version,
               ds="UP" if self.running else "DOWN",
               f=self.ftp,
@@ -185,14 +244,40 @@ Builder: {b_len} building
               r=self.repositories_str(),
               c=self.chroots_str(),
               rm=", ".join(self.remotes),
+              t=self.transfers_str(),
+              e=self.exports_str(),
+              vf=self.verifications_str(),
+              sg=self.signatures_str(),
               p_len=len(self.packaging),
               p="\n".join(self.packaging) + "\n" if self.packaging else "",
+              i_len=len(self.incoming),
+              i="\n".join(self.incoming) + "\n" if self.incoming else "",
               b_len=len(self.building),
-              b="\n".join(self.building) + "\n" if self.building else "")
+              b="\n".join(self.building) + "\n" if self.building else "",
+              q_len=len(self.queued),
+              q="\n".join(self.queued) + "\n" if self.queued else "")
 
     def repositories_str(self):
         return ", ".join(["{i}: {c}".format(i=identity, c=" ".join(codenames)) for identity, codenames in self.repositories.items()])
 
+    def transfers_str(self):
+        return ", ".join(["{h}: {f} files, {t} bytes/s".format(h=hopo, f=s["files"], t=s["throughput"]) for hopo, s in self.transfers.items()])
+
+    def exports_str(self):
+        return ", ".join(["{r}: {d} (in {s}s)".format(r=r, d=" ".join(e["distributions"]), s=e["due"]) for r, e in self.exports.items()]) or "none pending"
+
+    def verifications_str(self):
+        v = self.verifications
+        return "{n} signatures ({c} cached, {f} failed), {l}s average, {m}s max".format(n=v.get("verifications", 0),
+                                                                                      c=v.get("cached", 0),
+                                                                                      f=v.get("failed", 0),
+                                                                                      l=v.get("latency"),
+                                                                                      m=v.get("max"))
+
+    def signatures_str(self):
+        s = self.signatures
+        return "{n} signatures, {l}s average, {m}s max".format(n=s.get("signatures", 0), l=s.get("latency"), m=s.get("max"))
+
     def chroots_str(self):
         return ", ".join(["{a}: {c}".format(a=arch, c=" ".join(codenames)) for arch, codenames in self.chroots.items()])
 
@@ -268,6 +353,64 @@ class Meta(Command):
         daemon.meta(self.args["model"], self.args["function"], msglog=self.msglog)
 
 
+class Blobs(Command):
+    """Get which of the given blobs (sha256 hashes) are available in the blob store.
+
+    Without user login, the call must be signed by a remote's
+    key (like mini-buildd instances do, see mini_buildd.blobs.missing()).
+    """
+
+    COMMAND = "blobs"
+    ARGUMENTS = [
+        (["hashes"], {"help": "comma-separated list of sha256 hashes"}),
+        (["--signature", "-S"], {"action": "store", "metavar": "SIGNATURE",
+                                 "default": "",
+                                 "help": "armored detached signature of the 'hashes' argument by a remote's key"})]
+
+    def __init__(self, args, request=None, msglog=LOG):
+        super(Blobs, self).__init__(args, request, msglog)
+        self.available = []
+
+    def _authorize(self, daemon):
+        if self.request is not None and self.request.user.is_authenticated() and self.request.user.is_active:
+            return
+        if not self.args["signature"]:
+            raise Exception("Needs user login, or a signature by a remote's key")
+
+        with contextlib.closing(mini_buildd.misc.TmpDir()) as t:
+            data = os.path.join(t.tmpdir, "hashes")
+            with open(data, "wb") as f:
+                f.write(self.args["hashes"].encode(mini_buildd.setup.CHAR_ENCODING))
+            with open(data + ".asc", "wb") as f:
+                f.write(self.args["signature"].encode(mini_buildd.setup.CHAR_ENCODING))
+            daemon.keyrings.get_remotes().verify(data + ".asc", data)
+
+    def run(self, daemon):
+        self._authorize(daemon)
+        self.available = mini_buildd.blobs.has([h for h in self.args["hashes"].split(",") if h])
+        self._plain_result = "".join(["{h}\n".format(h=h) for h in self.available])
+
+
+class FlushExports(Command):
+    """Export (and sign) all pending changed distributions now (see daemon's 'Export-Delay')."""
+
+    COMMAND = "flushexports"
+    AUTH = Command.STAFF
+    ARGUMENTS = [
+        (["--repository", "-R"], {"action": "store", "metavar": "REPO",
+                                  "default": "",
+                                  "help": "only flush exports of this repository"})]
+
+    def __init__(self, args, request=None, msglog=LOG):
+        super(FlushExports, self).__init__(args, request, msglog)
+        self.flushed = {}
+
+    def run(self, _daemon):
+        basedir = os.path.join(mini_buildd.setup.REPOSITORIES_DIR, self.args["repository"]) if self.args["repository"] else None
+        self.flushed = dict((os.path.basename(b), e["distributions"]) for b, e in mini_buildd.reprepro.EXPORTER.flush(basedir).items())
+        self._plain_result = "".join(["{r}: {d}\n".format(r=r, d=" ".join(d)) for r, d in self.flushed.items()]) or "No exports pending.\n"
+
+
 class GetKey(Command):
     """Get GnuPG public key."""
     COMMAND = "getkey"
@@ -330,6 +473,46 @@ class LogCat(Command):
         self._plain_result = daemon.logcat(lines=int(self.args["lines"]))
 
 
+class BuildLog(Command):
+    """Show the build log of a running build.
+
+    With '--follow', new lines are streamed until the build log is complete.
+    """
+
+    COMMAND = "buildlog"
+    ARGUMENTS = [
+        (["key"], {"help": "build key 'PACKAGE_VERSION:ARCH' (as shown in the status)"}),
+        (["--lines", "-n"], {"action": "store", "metavar": "N", "type": int,
+                             "default": 100,
+                             "help": "show the last N lines"}),
+        (["--follow", "-f"], {"action": "store_true",
+                              "default": False,
+                              "help": "stream new lines until the build log is complete"})]
+
+    def __init__(self, args, request=None, msglog=LOG):
+        super(BuildLog, self).__init__(args, request, msglog)
+        self._stream = None
+
+    def __getstate__(self):
+        "Stream (generator) cannot be pickled."
+        pstate = super(BuildLog, self).__getstate__()
+        del pstate["_stream"]
+        return pstate
+
+    def run(self, daemon):
+        build = daemon.builds.get(self.args["key"])
+        if build is None or build.log is None:
+            raise Exception("No live build log for '{k}' (not building; see package log when finished)".format(k=self.args["key"]))
+
+        if self.has_flag("follow"):
+            self._stream = build.log.follow(int(self.args["lines"]))
+        else:
+            self._plain_result = "".join(build.log.tail(int(self.args["lines"])))
+
+    def get_stream(self):
+        return self._stream
+
+
 def _get_table_format(dct, cols):
     tlen = {}
     for _r, values in dict(dct).items():
@@ -350,12 +533,15 @@ def _get_table_format(dct, cols):
 
 
 class List(Command):
-    """List packages matching a shell-like glob pattern; matches both source and binary package names."""
+    """List packages matching a shell-like glob pattern (or regex); matches both source and binary package names."""
 
     COMMAND = "list"
     AUTH = Command.LOGIN
     ARGUMENTS = [
         (["pattern"], {"help": "list source packages matching pattern"}),
+        (["--regex", "-x"], {"action": "store_true",
+                             "default": False,
+                             "help": "pattern is a regex (searched in package names) rather than a shell-like glob"}),
         (["--with-rollbacks", "-r"], {"action": "store_true",
                                       "default": False,
                                       "help": "also list packages on rollback distributions"}),
@@ -364,21 +550,44 @@ class List(Command):
                                     "help": "limit distributions to those matching this regex"}),
         (["--type", "-T"], {"action": "store", "metavar": "TYPE",
                             "default": "",
-                            "help": "package type: dsc, deb or udeb (like reprepo --type)"})]
+                            "help": "package type: dsc, deb or udeb (like reprepo --type)"}),
+        (["--architecture", "-A"], {"action": "store", "metavar": "ARCH",
+                                    "default": "",
+                                    "help": "limit to this architecture ('source' for source packages)"}),
+        (["--component", "-C"], {"action": "store", "metavar": "COMPONENT",
+                                 "default": "",
+                                 "help": "limit to this component"}),
+        (["--offset", "-o"], {"action": "store", "metavar": "N", "type": int,
+                              "default": 0,
+                              "help": "skip the first N results (see 'next_offset' in the result to continue)"}),
+        (["--limit", "-l"], {"action": "store", "metavar": "N", "type": int,
+                             "default": 100,
+                             "help": "show at most N results"})]
 
     def __init__(self, args, request=None, msglog=LOG):
         super(List, self).__init__(args, request, msglog)
         self.repositories = {}
+        self.total = 0
+        self.next_offset = None
 
     def run(self, daemon):
-        # Save all results of all repos in a top-level dict (don't add repos with empty results).
-        for r in daemon.get_active_repositories():
-            r_result = r.mbd_package_list(self.args["pattern"],
-                                          typ=self.arg_false2none("type"),
-                                          with_rollbacks=self.has_flag("with_rollbacks"),
-                                          dist_regex=self.args["distribution"])
-            if r_result:
-                self.repositories[r.identity] = r_result
+        offset, limit = int(self.args["offset"]), int(self.args["limit"])
+
+        # Save the requested page of results in a top-level dict (don't add repos with empty results); count all.
+        for r in sorted(daemon.get_active_repositories(), key=lambda r: r.identity):
+            for p in r.mbd_package_list(self.args["pattern"],
+                                        typ=self.arg_false2none("type"),
+                                        with_rollbacks=self.has_flag("with_rollbacks"),
+                                        dist_regex=self.args["distribution"],
+                                        architecture=self.arg_false2none("architecture"),
+                                        component=self.arg_false2none("component"),
+                                        regex=self.has_flag("regex")):
+                if offset <= self.total < offset + limit:
+                    self.repositories.setdefault(r.identity, []).append(dict(p))
+                self.total += 1
+
+        if self.total > offset + limit:
+            self.next_offset = offset + limit
 
     def __unicode__(self):
         if not self.repositories:
@@ -407,7 +616,10 @@ class List(Command):
            s1=sep1,
            p="\n".join([fmt.format(**p) for p in values]))
 
-        return "\n".join([p_table(k, v) for k, v in self.repositories.items()])
+        return "{r}\n{n} of {t} packages shown{c}.\n".format(r="\n".join([p_table(k, v) for k, v in sorted(self.repositories.items())]),
+                                                              n=sum([len(v) for v in self.repositories.values()]),
+                                                              t=self.total,
+                                                              c="; continue with '--offset={o}'".format(o=self.next_offset) if self.next_offset else "")
 
 
 class Show(Command):
@@ -516,6 +728,73 @@ class Remove(Command):
                                                            msglog=self.msglog)
 
 
+def _run_bulk(cmd, daemon, action):
+    """
+    Run repository 'action' (like 'mbd_package_migrate') for all packages on all distributions (in the given order).
+
+    Calls per repository are run in one reprepro transaction,
+    i.e., changed distributions are exported only once. Failed
+    calls are logged, and don't stop the others.
+    """
+    jobs = collections.OrderedDict()
+    for package in cmd.args["packages"].split(","):
+        for dist in cmd.args["distributions"].split(","):
+            try:
+                repository, distribution, suite, rollback = daemon.parse_distribution(dist)
+                jobs.setdefault(repository.identity, (repository, []))[1].append((package, dist, distribution, suite, rollback))
+            except Exception as e:
+                mini_buildd.setup.log_exception(cmd.msglog, "{p}/{d}: Skipped".format(p=package, d=dist), e, logging.WARN)
+                cmd.results.append({"package": package, "distribution": dist, "result": "FAILED: {e}".format(e=e)})
+
+    for repository, repository_jobs in jobs.values():
+        with repository.mbd_reprepro_transaction():
+            for package, dist, distribution, suite, rollback in repository_jobs:
+                try:
+                    getattr(repository, action)(package, distribution, suite, rollback=rollback, msglog=cmd.msglog)
+                    cmd.results.append({"package": package, "distribution": dist, "result": "OK"})
+                except Exception as e:
+                    mini_buildd.setup.log_exception(cmd.msglog, "{p}/{d}: Failed".format(p=package, d=dist), e, logging.WARN)
+                    cmd.results.append({"package": package, "distribution": dist, "result": "FAILED: {e}".format(e=e)})
+
+    cmd._plain_result = "\n".join(["{p}/{d}: {r}".format(p=r["package"], d=r["distribution"], r=r["result"]) for r in cmd.results])  # pylint: disable=protected-access
+
+
+class BulkMigrate(Command):
+    """Migrate several source packages in one go (exporting each changed distribution only once)."""
+
+    COMMAND = "bulkmigrate"
+    AUTH = Command.STAFF
+    CONFIRM = True
+    ARGUMENTS = [
+        (["packages"], {"help": "comma-separated list of source package names"}),
+        (["distributions"], {"help": "comma-separated list of distributions to migrate from (per package, in this order)"})]
+
+    def __init__(self, args, request=None, msglog=LOG):
+        super(BulkMigrate, self).__init__(args, request, msglog)
+        self.results = []
+
+    def run(self, daemon):
+        _run_bulk(self, daemon, "mbd_package_migrate")
+
+
+class BulkRemove(Command):
+    """Remove several source packages in one go (exporting each changed distribution only once)."""
+
+    COMMAND = "bulkremove"
+    AUTH = Command.ADMIN
+    CONFIRM = True
+    ARGUMENTS = [
+        (["packages"], {"help": "comma-separated list of source package names"}),
+        (["distributions"], {"help": "comma-separated list of distributions to remove from (per package, in this order)"})]
+
+    def __init__(self, args, request=None, msglog=LOG):
+        super(BulkRemove, self).__init__(args, request, msglog)
+        self.results = []
+
+    def run(self, daemon):
+        _run_bulk(self, daemon, "mbd_package_remove")
+
+
 class Port(Command):
     """Port an internal package.
 
@@ -594,6 +873,59 @@ class Retry(Command):
         self._plain_result = os.path.basename(os.path.basename(pkg_log.changes))
 
 
+class LogSearch(Command):
+    """Search package logs (latest first)."""
+
+    COMMAND = "logsearch"
+    ARGUMENTS = [
+        (["pattern"], {"help": "search source packages matching shell-like glob pattern"}),
+        (["--repository", "-R"], {"action": "store", "metavar": "REPO",
+                                  "default": "",
+                                  "help": "limit to this repository"}),
+        (["--failed", "-F"], {"action": "store_true",
+                              "default": False,
+                              "help": "only search logs of failed packages"}),
+        (["--offset", "-o"], {"action": "store", "metavar": "N", "type": int,
+                              "default": 0,
+                              "help": "skip the first N results"}),
+        (["--limit", "-l"], {"action": "store", "metavar": "N", "type": int,
+                             "default": 50,
+                             "help": "show at most N results"})]
+
+    def __init__(self, args, request=None, msglog=LOG):
+        super(LogSearch, self).__init__(args, request, msglog)
+        self.logs = []
+
+    def run(self, _daemon):
+        for e in mini_buildd.misc.PkgLogIndex.get().search(self.args["pattern"],
+                                                           repository=self.arg_false2none("repository"),
+                                                           installed=False if self.has_flag("failed") else None,
+                                                           offset=int(self.args["offset"]),
+                                                           limit=int(self.args["limit"])):
+            self.logs.append({"repository": e["repository"],
+                              "package": e["package"],
+                              "version": e["version"],
+                              "architecture": e["architecture"],
+                              "state": "installed" if e["installed"] else "failed",
+                              "status": e["status"] or "",
+                              "date": datetime.datetime.fromtimestamp(e["stamp"]).strftime("%Y-%m-%d %H:%M") if e["stamp"] else "",
+                              "url": "/mini_buildd/log/{r}/{p}/{v}/".format(r=e["repository"], p=e["package"], v=e["version"])})
+
+    def __unicode__(self):
+        if not self.logs:
+            return "No package logs found."
+
+        cols = [("date", "Date"),
+                ("repository", "Repository"),
+                ("package", "Package"),
+                ("version", "Version"),
+                ("architecture", "Architecture"),
+                ("state", "State"),
+                ("status", "Status")]
+        fmt, hdr, _fmt_tle, _sep0, sep1 = _get_table_format({"logs": self.logs}, cols)
+        return "{h}\n{s}\n{l}\n".format(h=hdr, s=sep1, l="\n".join([fmt.format(**l) for l in self.logs]))
+
+
 class SetUserKey(Command):
     """Set a user's GnuPG public key."""
 
@@ -675,19 +1007,25 @@ COMMANDS = [(COMMAND_GROUP, "Daemon commands"),
             (Stop.COMMAND, Stop),
             (PrintUploaders.COMMAND, PrintUploaders),
             (Meta.COMMAND, Meta),
+            (Blobs.COMMAND, Blobs),
+            (FlushExports.COMMAND, FlushExports),
             (COMMAND_GROUP, "Configuration convenience commands"),
             (GetKey.COMMAND, GetKey),
             (GetDputConf.COMMAND, GetDputConf),
             (GetSourcesList.COMMAND, GetSourcesList),
             (LogCat.COMMAND, LogCat),
+            (BuildLog.COMMAND, BuildLog),
             (COMMAND_GROUP, "Package management commands"),
             (List.COMMAND, List),
             (Show.COMMAND, Show),
             (Migrate.COMMAND, Migrate),
             (Remove.COMMAND, Remove),
+            (BulkMigrate.COMMAND, BulkMigrate),
+            (BulkRemove.COMMAND, BulkRemove),
             (Port.COMMAND, Port),
             (PortExt.COMMAND, PortExt),
             (Retry.COMMAND, Retry),
+            (LogSearch.COMMAND, LogSearch),
             (COMMAND_GROUP, "User management commands"),
             (SetUserKey.COMMAND, SetUserKey),
             (Subscription.COMMAND, Subscription),
@@ -194,12 +194,22 @@ class Daemon(object):
         if suites is None:
             suites = ["unstable", "testing"]
 
-        for package in packages:
-            for repository in repositories:
-                iter_codenames = codenames
-                if iter_codenames is None:
-                    iter_codenames = list(status.repositories[repository])
-                for codename in iter_codenames:
-                    for suite in suites:
-                        dist = "{c}-{r}-{s}".format(c=codename, r=repository, s=suite)
+        dists = []
+        for repository in repositories:
+            iter_codenames = codenames
+            if iter_codenames is None:
+                iter_codenames = list(status.repositories[repository])
+            for codename in iter_codenames:
+                for suite in suites:
+                    dists.append("{c}-{r}-{s}".format(c=codename, r=repository, s=suite))
+
+        try:
+            self.call("bulkmigrate", {"packages": ",".join(packages), "distributions": ",".join(dists)})
+        except urllib2.HTTPError as e:
+            # Older servers don't have 'bulkmigrate' (400: Unknown command): Migrate one by one
+            if e.getcode() == 400:
+                for package in packages:
+                    for dist in dists:
                         self.call("migrate", {"package": package, "distribution": dist}, raise_on_error=False)
+            else:
+                raise
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed blob store.
+
+Big files (like upstream tarballs or binary packages) are
+stored once per instance, keyed by their sha256 hash. Build
+requests and build results only carry a manifest of their
+blobs (changes header 'Blobs'), and only blobs the receiver
+does not have yet are actually uploaded (as
+'<sha256>.blob').
+"""
+from __future__ import unicode_literals
+
+import os
+import re
+import stat
+import time
+import shutil
+import fnmatch
+import threading
+import urllib
+import urllib2
+import logging
+
+import mini_buildd.setup
+import mini_buildd.misc
+
+LOG = logging.getLogger(__name__)
+
+# Smaller files are just put into the tar
+MIN_SIZE = 256 * 1024
+
+# Blobs not used for that long are purged
+EXPIRE = 7 * 24 * 60 * 60
+_PURGE_INTERVAL = 60 * 60
+_PURGE_LOCK = threading.Lock()
+_PURGED = 0.0
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_blob(file_name):
+    return fnmatch.fnmatch(file_name, "*.blob")
+
+
+def get_path(sha256, blob_dir=None):
+    """
+    Get path of blob in the store ('blob_dir', defaults to BLOB_DIR).
+
+    >>> get_path("e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855", blob_dir="/var/blobs")
+    u'/var/blobs/e3/e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855.blob'
+    >>> get_path("../../etc/passwd")
+    Traceback (most recent call last):
+    ...
+    Exception: Not a sha256 hash: ../../etc/passwd
+    """
+    if not _SHA256_RE.match(sha256):
+        raise Exception("Not a sha256 hash: {h}".format(h=sha256))
+    return os.path.join(mini_buildd.setup.BLOB_DIR if blob_dir is None else blob_dir, sha256[:2], "{h}.blob".format(h=sha256))
+
+
+def _touch(path):
+    """
+    Mark blob as used.
+
+    Usage is tracked via ctime, as blobs share their inode (and
+    thus mtime) with the hardlinks outside the store. chmod
+    (as well as any new hardlink) updates ctime only.
+    """
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode))
+
+
+def has(hashes):
+    """
+    Get list of the given hashes available in the store.
+    """
+    result = []
+    for h in hashes:
+        path = get_path(h)
+        if os.path.exists(path):
+            # Mark as used, so it's not purged before the upload refering to it arrives
+            _touch(path)
+            result.append(h)
+    return result
+
+
+def add(path, sha256=None, move=False):
+    """
+    Add file to the store (hardlink or copy; or move). Returns the sha256 hash.
+    """
+    if sha256 is None:
+        # Digests are cached: The same source files are added once per architecture
+        sha256 = mini_buildd.misc.sha256_of_file(path)
+
+    blob = get_path(sha256)
+    if os.path.exists(blob):
+        _touch(blob)
+        if move:
+            os.remove(path)
+    else:
+        mini_buildd.misc.mkdirs(os.path.dirname(blob))
+        # Add atomically: Only complete blobs ever appear under their hash
+        tmp = "{b}.{i}.tmp".format(b=blob, i=threading.current_thread().ident)
+        if move:
+            shutil.move(path, tmp)
+        else:
+            mini_buildd.misc.link_or_copy(path, tmp)
+        os.rename(tmp, blob)
+        LOG.debug("Blob added: {b}".format(b=blob))
+
+    _purge_maybe()
+    return sha256
+
+
+def receive(path):
+    """
+    Add a received '<sha256>.blob' file to the store, verifying its content.
+    """
+    sha256 = os.path.basename(path)[:-len(".blob")]
+    # Always hash the actual content (never from the digest cache)
+    actual = mini_buildd.misc.sha256_of_file(path, cached=False)
+    if actual != sha256:
+        os.remove(path)
+        raise Exception("Blob checksum mismatch (file removed): {f}: {a}".format(f=path, a=actual))
+    add(path, sha256=sha256, move=True)
+
+
+def link(sha256, dst):
+    """
+    Make blob available as file 'dst' (hardlink or copy).
+    """
+    blob = get_path(sha256)
+    if not os.path.exists(blob):
+        raise Exception("Blob missing in store: {h}".format(h=sha256))
+    _touch(blob)
+    mini_buildd.misc.link_or_copy(blob, dst)
+
+
+def missing(http, hashes, gnupg=None):
+    """
+    Get list of the given hashes missing on a remote mini-buildd instance (via API).
+
+    The query is signed with 'gnupg' (our daemon key), which the
+    remote checks against its remotes keyring (see api 'blobs').
+
+    If the remote can't be asked, all hashes are returned.
+    """
+    if http and hashes:
+        query = {"command": "blobs", "hashes": ",".join(hashes), "output": "plain"}
+        if gnupg:
+            query["signature"] = gnupg.sign_data(query["hashes"].encode(mini_buildd.setup.CHAR_ENCODING), detach=True)
+        try:
+            available = urllib2.urlopen("http://{h}/mini_buildd/api?{q}".format(h=http, q=urllib.urlencode(query)), timeout=10).read().split()
+            return [h for h in hashes if h not in available]
+        except Exception as e:
+            mini_buildd.setup.log_exception(LOG, "Blob query to '{h}' failed (uploading all blobs)".format(h=http), e, logging.WARNING)
+    return list(hashes)
+
+
+def purge(expire=EXPIRE):
+    """
+    Remove blobs (and stale temporary files) not used for 'expire' seconds. Returns the number of files removed.
+    """
+    removed = 0
+    if not os.path.exists(mini_buildd.setup.BLOB_DIR):
+        return removed
+
+    now = time.time()
+    for d in os.listdir(mini_buildd.setup.BLOB_DIR):
+        for f in os.listdir(os.path.join(mini_buildd.setup.BLOB_DIR, d)):
+            path = os.path.join(mini_buildd.setup.BLOB_DIR, d, f)
+            try:
+                if now - os.stat(path).st_ctime > expire:
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                LOG.warn("Blob store: Can't purge '{p}': {e}".format(p=path, e=e))
+
+    LOG.info("Blob store: {n} unused blobs purged.".format(n=removed))
+    return removed
+
+
+def _purge_maybe():
+    global _PURGED  # pylint: disable=global-statement
+    with _PURGE_LOCK:
+        if time.time() - _PURGED < _PURGE_INTERVAL:
+            return
+        _PURGED = time.time()
+    purge()
@@ -2,12 +2,20 @@
 from __future__ import unicode_literals
 
 import os
+import copy
+import collections
 import datetime
 import shutil
 import re
 import subprocess
+import threading
+import time
+import errno
+import pickle
 import logging
 
+import debian.deb822
+
 import mini_buildd.setup
 import mini_buildd.misc
 import mini_buildd.changes
@@ -15,6 +23,340 @@ import mini_buildd.changes
 LOG = logging.getLogger(__name__)
 
 
+class Journal(object):
+    """
+    Append-only journal of build job state transitions.
+
+    Each line records one transition as '<unix time> <status>
+    <priority> <breq path>'. Lines are synced to disk on write,
+    so the journal survives crashes; a torn last line is just
+    ignored on replay.
+
+    The journal is compacted (rewritten with open jobs only) on
+    replay, and at runtime whenever it has grown to
+    COMPACT_FACTOR times the lines needed for the open jobs.
+
+    >>> import tempfile
+    >>> j = Journal(tempfile.mkstemp()[1])
+    >>> j.replay()
+    []
+    >>> for n in range(100):
+    ...     j.record("breq{n}".format(n=n), Journal.QUEUED)
+    ...     j.record("breq{n}".format(n=n), Journal.CLOSED)
+    >>> j.record("open", Journal.QUEUED)
+    >>> len(open(j._path).readlines()) < Journal.COMPACT_MIN_LINES
+    True
+    >>> [p for p, _j in j.replay()]
+    [u'open']
+    """
+    QUEUED = "QUEUED"
+    CLOSED = "CLOSED"
+
+    COMPACT_FACTOR = 4
+    COMPACT_MIN_LINES = 100
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._lines = 0
+
+    def replay(self):
+        """
+        Replay and compact journal. Returns unclosed jobs (in queue order) as list of (breq_path, job_dict).
+        """
+        with self._lock:
+            jobs = {}
+            try:
+                with mini_buildd.misc.open_utf8(self._path) as f:
+                    for n, l in enumerate(f):
+                        try:
+                            stamp, status, priority, path = l.rstrip("\n").split(" ", 3)
+                            stamp, priority = float(stamp), int(priority)
+                        except ValueError:
+                            LOG.warn("Builder journal: Ignoring broken line {n}: {l}".format(n=n, l=l.strip()))
+                            continue
+                        self._apply(jobs, stamp, status, priority, path)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+            self._jobs = jobs
+            self._compact()
+            return sorted(jobs.items(), key=lambda j: j[1]["queued"])
+
+    def _compact(self):
+        "Rewrite with unclosed jobs only (call locked)."
+        tmp_path = self._path + ".new"
+        self._lines = 0
+        with mini_buildd.misc.open_utf8(tmp_path, "w") as f:
+            for path, job in sorted(self._jobs.items(), key=lambda j: j[1]["queued"]):
+                f.write(self._line(job["queued"], self.QUEUED, job["priority"], path))
+                for status, stamp in job["transitions"]:
+                    f.write(self._line(stamp, status, job["priority"], path))
+                self._lines += 1 + len(job["transitions"])
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._path)
+
+    @classmethod
+    def _line(cls, stamp, status, priority, path):
+        return "{t} {s} {p} {b}\n".format(t=stamp, s=status, p=priority, b=path)
+
+    @classmethod
+    def _apply(cls, jobs, stamp, status, priority, path):
+        if status == cls.CLOSED:
+            jobs.pop(path, None)
+        elif status == cls.QUEUED:
+            jobs[path] = {"queued": stamp, "priority": priority, "status": status, "transitions": []}
+        elif path in jobs:
+            jobs[path]["status"] = status
+            jobs[path]["transitions"].append((status, stamp))
+
+    def record(self, path, status, priority=0):
+        with self._lock:
+            stamp = time.time()
+            with mini_buildd.misc.open_utf8(self._path, "a") as f:
+                f.write(self._line(stamp, status, priority, path))
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(self._jobs, stamp, status, priority, path)
+
+            self._lines += 1
+            needed = sum(1 + len(j["transitions"]) for j in self._jobs.values())
+            if self._lines > max(self.COMPACT_MIN_LINES, self.COMPACT_FACTOR * needed):
+                LOG.debug("Builder journal: Compacting ({l} lines, {n} needed)".format(l=self._lines, n=needed))
+                self._compact()
+
+    def get(self, path):
+        """
+        Get job dict as of last replay or record, or None.
+        """
+        with self._lock:
+            return copy.deepcopy(self._jobs.get(path))
+
+
+class History(object):
+    """
+    Durable build duration history per (package, codename, architecture), exponentially smoothed.
+
+    >>> import tempfile
+    >>> h = History(tempfile.mkstemp()[1])
+    >>> h.update("mypkg", "jessie", "amd64", 100.0)
+    >>> h.update("mypkg", "jessie", "amd64", 200.0)
+    >>> h.get("mypkg", "jessie", "amd64"), h.get("mypkg", "stretch", "i386"), h.get("otherpkg", "jessie", "amd64")
+    (150.0, 150.0, None)
+    >>> h.update("otherpkg", "jessie", "amd64", 50.0)
+    >>> h.get_chroots()
+    {u'jessie:amd64': 100.0}
+    """
+    ALPHA = 0.5
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._durations = {}
+        try:
+            with open(self._path, "rb") as f:
+                self._durations = pickle.load(f)
+        except Exception as e:
+            if not isinstance(e, IOError) or e.errno != errno.ENOENT:
+                mini_buildd.setup.log_exception(LOG, "Builder: Ignoring broken build history '{p}'".format(p=self._path), e, logging.WARN)
+
+    def get(self, package, codename, architecture):
+        """
+        Get smoothed build duration in seconds. Falls back to the mean over all known durations of the package, or None.
+        """
+        with self._lock:
+            duration = self._durations.get((package, codename, architecture))
+            if duration is None:
+                durations = [d for k, d in self._durations.items() if k[0] == package]
+                if durations:
+                    duration = sum(durations) / len(durations)
+            return None if duration is None else round(duration, 1)
+
+    def get_chroots(self):
+        """
+        Get mean build duration per chroot as dict {"CODENAME:ARCH": SECONDS}.
+        """
+        with self._lock:
+            durations = {}
+            for (_package, codename, architecture), duration in self._durations.items():
+                durations.setdefault("{c}:{a}".format(c=codename, a=architecture), []).append(duration)
+            return dict((chroot, round(sum(d) / len(d), 1)) for chroot, d in durations.items())
+
+    def get_for_breq(self, path):
+        with mini_buildd.misc.open_utf8(path) as f:
+            breq = debian.deb822.Changes(f)
+        return self.get(breq["Source"], breq["Base-Distribution"], breq["Architecture"])
+
+    def update(self, package, codename, architecture, duration):
+        with self._lock:
+            key = (package, codename, architecture)
+            old = self._durations.get(key)
+            self._durations[key] = duration if old is None else self.ALPHA * duration + (1.0 - self.ALPHA) * old
+
+            # Save atomically
+            tmp_path = self._path + ".new"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self._durations, f)
+            os.rename(tmp_path, self._path)
+
+
+class Scheduler(mini_buildd.misc.JobQueue):
+    """
+    Build queue: Job queue of build request file paths, journaled to disk.
+
+    Jobs get their estimated run time from the build duration history.
+
+    A new scheduler replacing a 'previous' one (on reconfigure)
+    shares its journal and history, and does not resume jobs
+    still being worked on by the previous scheduler's workers.
+
+    >>> import tempfile
+    >>> s = Scheduler(1, tempfile.mkstemp()[1], tempfile.mkstemp()[1])
+    >>> j = s.put("breq", estimate=1.0)
+    >>> s.journal.get("breq")["status"]
+    u'QUEUED'
+    """
+    def __init__(self, workers, journal_path, history_path, discipline=None, classify=None, previous=None):
+        super(Scheduler, self).__init__(workers, discipline=discipline, classify=classify)
+        self.journal = previous.journal if previous else Journal(journal_path)
+        self.history = previous.history if previous else History(history_path)
+        # Paths of active jobs, shared with previous schedulers
+        self._active_paths = previous._active_paths if previous else set()
+
+    def get(self):
+        job = super(Scheduler, self).get()
+        if job:
+            self._active_paths.add(job.item)
+        return job
+
+    def task_done(self, job):
+        self._active_paths.discard(job.item)
+        super(Scheduler, self).task_done(job)
+
+    def _estimate(self, path):
+        try:
+            return self.history.get_for_breq(path)
+        except Exception as e:
+            mini_buildd.setup.log_exception(LOG, "Builder: Can't estimate build time for '{p}'".format(p=path), e, logging.WARN)
+
+    def put(self, item, priority=None, key=None, owners=None, group=None, estimate=None):
+        return super(Scheduler, self).put(item, priority=priority, key=key, owners=owners, group=group,
+                                          estimate=self._estimate(item) if estimate is None else estimate)
+
+    def _queued(self, job):
+        # Journal first: A worker may record the job's status (or close it) as soon as it's available
+        # Resumed jobs are already journaled (and keep their transitions)
+        if self.journal.get(job.item) is None:
+            self.journal.record(job.item, Journal.QUEUED, job.priority)
+
+    def resume(self):
+        """
+        Re-queue unclosed jobs from the journal (the breq files are still in incoming).
+        """
+        for path, job in self.journal.replay():
+            if path in self._active_paths:
+                LOG.info("Builder: Not resuming, still active: {p}".format(p=path))
+            elif os.path.exists(path):
+                LOG.info("Builder: Resuming from journal ({s}): {p}".format(s=job["status"], p=path))
+                self.put(path)
+            else:
+                LOG.warn("Builder: Dropping journaled job with missing build request: {p}".format(p=path))
+                self.journal.record(path, Journal.CLOSED, job["priority"])
+
+
+class BuildLog(object):
+    """
+    Live build log.
+
+    sbuild's output is written through to the log file, its
+    summary status is parsed on the fly, and the last lines are
+    kept in memory for live tailing (see API 'buildlog').
+
+    .. note:: In case the build log above does write the same
+    output like 'Status: xyz', sbuild's correct status at the
+    bottom will override this later. Best thing, though, would
+    be if sbuild would eventually provide a better way to get
+    these values.
+
+    >>> import tempfile, StringIO
+    >>> log = BuildLog(tempfile.mkstemp()[1], lines=3)
+    >>> log.tee(StringIO.StringIO(b"Status: failed\\nline 1\\nline 2\\nStatus: successful\\nLintian: pass\\n"))
+    >>> sorted(log.status.items())
+    [(u'Sbuild-Lintian', u'pass'), (u'Sbuild-Status', u'successful')]
+    >>> log.tail(2)
+    [u'Status: successful\\n', u'Lintian: pass\\n']
+    >>> list(log.follow(10))
+    [u'line 2\\n', u'Status: successful\\n', u'Lintian: pass\\n']
+    >>> open(log.path).read()
+    'Status: failed\\nline 1\\nline 2\\nStatus: successful\\nLintian: pass\\n'
+    """
+    STATUS_REGEX = re.compile("^(Status|Lintian): [^ ]+$")
+
+    def __init__(self, path, lines=1000):
+        self.path = path
+        self.status = {}
+        self._tail = collections.deque(maxlen=lines)
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _add(self, line):
+        if self.STATUS_REGEX.match(line):
+            LOG.debug("Build log line detected as build status: {l}".format(l=line.strip()))
+            s = line.split(":")
+            self.status["Sbuild-" + s[0]] = s[1].strip()
+
+        with self._cond:
+            self._tail.append(line)
+            self._count += 1
+            self._cond.notify_all()
+
+    def tee(self, stream):
+        """
+        Read stream until EOF, writing the log file.
+        """
+        try:
+            with open(self.path, "w") as f:
+                for l in iter(stream.readline, b""):
+                    f.write(l)
+                    self._add(l.decode(mini_buildd.setup.CHAR_ENCODING, "replace"))
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+    def tail(self, lines):
+        with self._cond:
+            return list(self._tail)[-lines:] if lines > 0 else []
+
+    def follow(self, lines):
+        """
+        Generate the last 'lines' lines, then new lines as they come until the log is closed.
+        """
+        with self._cond:
+            position = self._count - min(lines, len(self._tail))
+
+        while True:
+            with self._cond:
+                while self._count <= position and not self._closed:
+                    self._cond.wait(10.0)
+                first = self._count - len(self._tail)
+                skipped = max(0, first - position)
+                new = list(self._tail)[position + skipped - first:]
+                position = self._count
+                closed = self._closed
+
+            if skipped:
+                yield "[... {n} lines skipped ...]\n".format(n=skipped)
+            for l in new:
+                yield l
+            if closed and not new:
+                return
+
+
 class Build(mini_buildd.misc.Status):
     FAILED = -1
     CHECKING = 0
@@ -22,7 +364,7 @@ class Build(mini_buildd.misc.Status):
     UPLOADING = 2
     UPLOADED = 10
 
-    def __init__(self, breq, gnupg, sbuild_jobs):
+    def __init__(self, breq, gnupg, sbuild_jobs, journal=None, job=None):
         super(Build, self).__init__(
             stati={self.FAILED: "FAILED",
                    self.CHECKING: "CHECKING",
@@ -39,28 +381,55 @@ class Build(mini_buildd.misc.Status):
 
         self._bres = breq.gen_buildresult()
 
-        self.started = self._get_started_stamp()
-        if self.started:
-            self.set_status(self.BUILDING)
-
-        self.built = self._get_built_stamp()
-        if self.built:
-            self.set_status(self.UPLOADING)
-
+        self._journal = None
+        self.log = None
+        self.priority = job.priority if job else 0
+        self.queued = job.queued if job else None
+        self.estimate = job.estimate if job else None
         self.uploaded = None
 
+        journaled = journal.get(breq.file_path) if journal else None
+        if journaled:
+            # Resume from journal: Only an already built (and saved) build result may be re-used.
+            stamps = dict(journaled["transitions"])
+            self.started, self.built = None, None
+            if "UPLOADING" in stamps and os.path.exists(self._bres.file_path):
+                self.started = datetime.datetime.fromtimestamp(stamps.get("BUILDING", stamps["UPLOADING"]))
+                self.built = datetime.datetime.fromtimestamp(stamps["UPLOADING"])
+                self.set_status(self.UPLOADING)
+        else:
+            # No journal entry: Guess from spool dir
+            self.started = self._get_started_stamp()
+            if self.started:
+                self.set_status(self.BUILDING)
+
+            self.built = self._get_built_stamp()
+            if self.built:
+                self.set_status(self.UPLOADING)
+
+        # Journal transitions from here on
+        self._journal = journal
+
     def __unicode__(self):
         date_format = "%Y-%b-%d %H:%M:%S"
-        return "{s}: [{h}] {k} ({c}): Started {start} ({took} seconds), uploaded {uploaded}: {desc}".format(
+        return "{s}: [{h}] {k} ({c}): Queued {queued} (priority {p}), started {start} ({took} of estimated {estimate} seconds), uploaded {uploaded}: {desc}".format(
             s=self.status,
             h=self.upload_result_to,
             k=self.key,
             c=self._chroot,
+            queued=self.queued.strftime(date_format) if self.queued else "n/a",
+            p=self.priority,
             start=self.started.strftime(date_format) if self.started else "n/a",
             took=self.took,
+            estimate=self.estimate if self.estimate is not None else "n/a",
             uploaded=self.uploaded.strftime(date_format) if self.uploaded else "n/a",
             desc=self.status_desc)
 
+    def set_status(self, status, desc=""):
+        super(Build, self).set_status(status, desc)
+        if self._journal:
+            self._journal.record(self._breq.file_path, self.status, self.priority)
+
     @property
     def key(self):
         return self._breq.get_pkg_id(with_arch=True)
@@ -85,6 +454,14 @@ class Build(mini_buildd.misc.Status):
     def upload_result_to(self):
         return self._breq["Upload-Result-To"]
 
+    @property
+    def codename(self):
+        return self._breq["Base-Distribution"]
+
+    @property
+    def successful(self):
+        return self._bres.get("Sbuild-Status") == "successful"
+
     @property
     def sbuildrc_path(self):
         return os.path.join(self._build_dir, ".sbuildrc")
@@ -99,7 +476,9 @@ class Build(mini_buildd.misc.Status):
 
     @property
     def took(self):
-        return round(mini_buildd.misc.timedelta_total_seconds(self.built - self.started), 1) if self.built else "n/a"
+        if self.started:
+            return round(mini_buildd.misc.timedelta_total_seconds((self.built or datetime.datetime.now()) - self.started), 1)
+        return "n/a"
 
     def _generate_sbuildrc(self):
         """
@@ -122,26 +501,6 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
 """.format(apt_allow_unauthenticated=self._breq["Apt-Allow-Unauthenticated"],
            custom_snippet=mini_buildd.misc.open_utf8(os.path.join(self._build_dir, "sbuildrc_snippet"), 'rb').read())).save()
 
-    def _buildlog_to_buildresult(self, buildlog):
-        """
-        Parse sbuild's summary status from build log.
-
-        .. note:: This will iterate all lines of the build log,
-        and parse out the selection of sbuild's summary status
-        we need.  In case the build log above does write the
-        same output like 'Status: xyz', sbuild's correct status
-        at the bottom will override this later.  Best thing,
-        though, would be if sbuild would eventually provide a
-        better way to get these values.
-        """
-        regex = re.compile("^(Status|Lintian): [^ ]+$")
-        with open(buildlog) as f:
-            for l in f:
-                if regex.match(l):
-                    LOG.debug("Build log line detected as build status: {l}".format(l=l.strip()))
-                    s = l.split(":")
-                    self._bres["Sbuild-" + s[0]] = s[1].strip()
-
     def build(self):
         """
         .. note:: OBSOLETED SUDO WORKAROUND for http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=608840
@@ -208,17 +567,20 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
         mini_buildd.misc.sbuild_keys_workaround()
         buildlog = os.path.join(self._build_dir, self._breq.buildlog_name)
         LOG.info("{p}: Running sbuild: {c}".format(p=self.key, c=" ".join(sbuild_cmd)))
-        with open(buildlog, "w") as l:
-            retval = subprocess.call(sbuild_cmd,
-                                     cwd=self._build_dir,
-                                     env=mini_buildd.misc.taint_env({"HOME": self._build_dir,
-                                                                     "GNUPGHOME": os.path.join(mini_buildd.setup.HOME_DIR, ".gnupg"),
-                                                                     "DEB_BUILD_OPTIONS": "parallel={j}".format(j=self._sbuild_jobs)}),
-                                     stdout=l, stderr=subprocess.STDOUT)
+        self.log = BuildLog(buildlog)
+        sbuild = subprocess.Popen(sbuild_cmd,
+                                  cwd=self._build_dir,
+                                  env=mini_buildd.misc.taint_env({"HOME": self._build_dir,
+                                                                  "GNUPGHOME": os.path.join(mini_buildd.setup.HOME_DIR, ".gnupg"),
+                                                                  "DEB_BUILD_OPTIONS": "parallel={j}".format(j=self._sbuild_jobs)}),
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # We are the reader: tee to log file until sbuild closes its output
+        self.log.tee(sbuild.stdout)
+        retval = sbuild.wait()
 
         # Add build results to build request object
         self._bres["Sbuildretval"] = unicode(retval)
-        self._buildlog_to_buildresult(buildlog)
+        self._bres.update(self.log.status)
 
         LOG.info("{p}: Sbuild finished: Sbuildretval={r}, Status={s}".format(p=self.key, r=retval, s=self._bres.get("Sbuild-Status")))
         self._bres.add_file(buildlog)
@@ -228,15 +590,16 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
                                                                                             self.architecture))
         if os.path.exists(build_changes_file):
             build_changes = mini_buildd.changes.Changes(build_changes_file)
-            build_changes.tar(tar_path=self._bres.file_path + ".tar")
+            # Older requesters need the full tar (no blob manifest)
+            build_changes.tar(tar_path=self._bres.file_path + ".tar", manifest=self._bres if self._breq.get("Accept-Blobs") == "yes" else None)
             self._bres.add_file(self._bres.file_path + ".tar")
 
         self._bres.save(self._gnupg)
         self.built = self._get_built_stamp()
 
-    def upload(self):
+    def upload(self, queue=None):
         hopo = mini_buildd.misc.HoPo(self.upload_result_to)
-        self._bres.upload(hopo)
+        self._bres.upload(hopo, http=self._breq.get("Upload-Result-Http"), queue=queue, gnupg=self._gnupg)
         self.uploaded = datetime.datetime.now()
 
     def clean(self):
@@ -274,6 +637,9 @@ def build_close(daemon, build):
     Close build. Just continue on errors, but log them; guarantee to remove it from the builds dict.
     """
     try:
+        # Only successful builds give meaningful build durations
+        if build.successful and build.started and build.built:
+            daemon.build_queue.history.update(build.package, build.codename, build.architecture, build.took)
         build.clean()
         daemon.last_builds.appendleft(LastBuild(build))
     except Exception as e:
@@ -283,11 +649,14 @@ def build_close(daemon, build):
             del daemon.builds[build.key]
 
 
-def build(daemon_, breq):
+def build(daemon_, job):
     build = None
+    breq = None
     try:
+        breq = mini_buildd.changes.Changes(job.item)
+
         # First, get build object. This will automagically set the status right.
-        build = Build(breq, daemon_.model.mbd_gnupg, daemon_.model.sbuild_jobs)
+        build = Build(breq, daemon_.model.mbd_gnupg, daemon_.model.sbuild_jobs, journal=job.queue.journal, job=job)
         daemon_.builds[build.key] = build
 
         # Authorization
@@ -301,7 +670,7 @@ def build(daemon_, breq):
 
         # Try upload
         try:
-            build.upload()
+            build.upload(queue=daemon_.remotes.get_local_queue(build.upload_result_to))
             build.set_status(build.UPLOADED)
         except Exception as e:
             mini_buildd.setup.log_exception(LOG, "Upload failed (retry later)", e, logging.WARN)
@@ -311,25 +680,38 @@ def build(daemon_, breq):
         # Try to upload failure build result to remote
         if build:
             build.set_status(build.FAILED)
-        breq.upload_failed_buildresult(daemon_.model.mbd_gnupg, mini_buildd.misc.HoPo(breq["Upload-Result-To"]), 101, "builder-failed", e)
+        if breq:
+            breq.upload_failed_buildresult(daemon_.model.mbd_gnupg, mini_buildd.misc.HoPo(breq["Upload-Result-To"]), 101, "builder-failed", e,
+                                           queue=daemon_.remotes.get_local_queue(breq["Upload-Result-To"]))
         mini_buildd.setup.log_exception(LOG, "Internal error building", e)
 
     finally:
         if build:
             build_close(daemon_, build)
-        daemon_.build_queue.task_done()
+        job.queue.journal.record(job.item, Journal.CLOSED, job.priority)
+        job.queue.task_done(job)
 
 
-def run(daemon_):
+def worker(daemon_, queue):
     while True:
-        event = daemon_.build_queue.get()
-        if event == "SHUTDOWN":
+        job = queue.get()
+        if job is None:
             break
 
-        LOG.info("Builder status: {s}.".format(s=daemon_.build_queue))
+        LOG.info("Builder status: {s}.".format(s=queue))
+        build(daemon_, job)
+
 
-        mini_buildd.misc.run_as_thread(
-            build,
-            daemon=True,
-            daemon_=daemon_,
-            breq=mini_buildd.changes.Changes(event))
+def run(daemon_):
+    """
+    Run builder: A fixed pool of workers on the build queue.
+
+    Workers are daemon threads and not joined on shutdown;
+    running builds finish, while pending jobs stay in the
+    journal to be resumed on next start.
+    """
+    queue = daemon_.build_queue
+    for _n in range(queue.workers):
+        mini_buildd.misc.run_as_thread(worker, daemon=True, daemon_=daemon_, queue=queue)
+    queue.resume()
+    queue.wait_shutdown()
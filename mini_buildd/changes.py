@@ -6,10 +6,10 @@ from __future__ import unicode_literals
 import os
 import stat
 import glob
+import shutil
 import logging
 import tarfile
 import socket
-import ftplib
 import re
 import contextlib
 
@@ -18,9 +18,10 @@ import debian.deb822
 import mini_buildd.setup
 import mini_buildd.misc
 import mini_buildd.gnupg
+import mini_buildd.transfer
+import mini_buildd.blobs
 
 import mini_buildd.models.repository
-import mini_buildd.models.gnupg
 
 LOG = logging.getLogger(__name__)
 
@@ -34,6 +35,8 @@ class Changes(debian.deb822.Changes):
              TYPE_BREQ: "_mini-buildd-buildrequest",
              TYPE_BRES: "_mini-buildd-buildresult"}
 
+    _TAR_BUFSIZE = 1024 * 1024
+
     BUILDREQUEST_RE = re.compile("^.+" + TYPES[TYPE_BREQ] + "_[^_]+.changes$")
     BUILDRESULT_RE = re.compile("^.+" + TYPES[TYPE_BRES] + "_[^_]+.changes$")
 
@@ -184,6 +187,15 @@ class Changes(debian.deb822.Changes):
     def get_files(self, key=None):
         return [f[key] if key else f for f in self.get("Files", [])]
 
+    def get_blobs(self):
+        """
+        Get blob manifest (see mini_buildd.blobs) as list of dicts with keys 'sha256', 'size' and 'name'.
+        """
+        return [dict(zip(["sha256", "size", "name"], l.split())) for l in self.get("Blobs", "").splitlines() if l.strip()]
+
+    def add_blob(self, file_name, sha256):
+        self["Blobs"] = self.get("Blobs", "") + "\n {h} {s} {n}".format(h=sha256, s=os.path.getsize(file_name), n=os.path.basename(file_name))
+
     def add_file(self, file_name):
         self.setdefault("Files", [])
         self["Files"].append({"md5sum": mini_buildd.misc.md5_of_file(file_name),
@@ -217,67 +229,99 @@ class Changes(debian.deb822.Changes):
                 os.remove(self._file_path)
             raise
 
-    def upload(self, hopo):
+    def _handoff(self, queue):
+        """
+        Upload to ourselves: Link all files to incoming, and queue the changes directly.
+
+        The changes is processed exactly like one received via
+        FTP (incl. signature verification), just without the
+        FTP round trip. Blobs are already in our store.
+
+        File modes are left alone, as the inode may be shared
+        with the source file.
+        """
+        linked = []
+        try:
+            # Changes last, like via FTP
+            for f in self.get_files(key="name") + [self._file_name]:
+                dst = os.path.join(mini_buildd.setup.INCOMING_DIR, f)
+                mini_buildd.misc.link_or_copy(os.path.join(os.path.dirname(self._file_path), f), dst)
+                linked.append(dst)
+        except:
+            for f in linked:
+                os.remove(f)
+            raise
+        LOG.info("Local: Queuing '{f}'".format(f=linked[-1]))
+        queue.put(linked[-1])
+
+    def upload(self, hopo, http=None, queue=None, gnupg=None):
+        """
+        Upload via FTP.
+
+        Of the blobs, only those missing on the receiver are
+        uploaded. Without 'http' (the receiver's http hopo), we
+        can't ask the receiver, and all blobs are uploaded. The
+        query is signed with 'gnupg' (see mini_buildd.blobs.missing()).
+
+        With 'queue' (our incoming queue), the receiver is
+        ourselves, and the changes is handed over locally.
+        """
         upload = os.path.splitext(self._file_path)[0] + ".upload"
         if os.path.exists(upload):
             LOG.info("FTP: '{f}' already uploaded to '{h}'...".format(f=self._file_name, h=mini_buildd.misc.open_utf8(upload).read()))
+        elif queue is not None:
+            self._handoff(queue)
+            mini_buildd.misc.open_utf8(upload, "w").write("{h}:{p}".format(h=hopo.host, p=hopo.port))
+            LOG.info("Local: '{f}' handed over to ourselves ('{h}')...".format(f=self._file_name, h=hopo.host))
         else:
-            ftp = ftplib.FTP()
-            ftp.connect(hopo.host, hopo.port)
-            ftp.login()
-            ftp.cwd("/incoming")
-            for fd in self.get_files() + [{"name": self._file_name}]:
-                f = fd["name"]
-                LOG.debug("FTP: Uploading file: '{f}'".format(f=f))
-                ftp.storbinary("STOR {f}".format(f=f), open(os.path.join(os.path.dirname(self._file_path), f), "rb"))
+            blobs = mini_buildd.blobs.missing(http, [b["sha256"] for b in self.get_blobs()], gnupg=gnupg)
+            LOG.info("FTP: Uploading {n} of {t} blobs for '{f}'".format(n=len(blobs), t=len(self.get_blobs()), f=self._file_name))
+            mini_buildd.transfer.upload(hopo,
+                                        [os.path.join(os.path.dirname(self._file_path), f) for f in self.get_files(key="name")] + [mini_buildd.blobs.get_path(b) for b in blobs],
+                                        self._file_path)
             mini_buildd.misc.open_utf8(upload, "w").write("{h}:{p}".format(h=hopo.host, p=hopo.port))
             LOG.info("FTP: '{f}' uploaded to '{h}'...".format(f=self._file_name, h=hopo.host))
 
-    def upload_buildrequest(self, local_hopo):
+    def upload_buildrequest(self, remotes, gnupg=None):
         arch = self["Architecture"]
         codename = self["Base-Distribution"]
 
-        remotes = {}
-
-        def add_remote(remote, update):
-            status = remote.mbd_get_status(update)
-            if status.running and status.has_chroot(codename, arch):
-                remotes[status.load] = status
-                LOG.debug("Remote[{l}]={r}".format(l=status.load, r=remote))
-
-        def check_remote(remote):
-            try:
-                mini_buildd.models.gnupg.Remote.Admin.mbd_check(None, remote, force=True)
-                add_remote(remote, False)
-            except Exception as e:
-                mini_buildd.setup.log_exception(LOG, "Builder check failed", e, logging.WARNING)
-
-        # Always add our own instance as pseudo remote first
-        add_remote(mini_buildd.models.gnupg.Remote(http=local_hopo.string), True)
-
-        # Check all active or auto-deactivated remotes
-        for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
-            check_remote(r)
-
-        if not remotes:
+        builders = remotes.get_builders(codename, arch)
+        if self.get_blobs():
+            # Only builders understanding blob manifests (the decision was made when the build request was generated)
+            builders = [b for b in builders if "blobs" in getattr(b, "capabilities", [])]
+        if not builders:
             raise Exception("No builder found for {c}/{a}".format(c=codename, a=arch))
 
-        for _load, remote in sorted(remotes.items()):
+        for builder in builders:
             try:
-                self.upload(mini_buildd.misc.HoPo(remote.ftp))
-                self.remote_http_url = "http://{r}".format(r=remote.http)
+                self.upload(mini_buildd.misc.HoPo(builder.ftp), http=builder.http, queue=remotes.get_local_queue(builder.ftp), gnupg=gnupg)
+                self.remote_http_url = "http://{r}".format(r=builder.http)
+                remotes.assigned(builder, self)
                 return
             except Exception as e:
-                mini_buildd.setup.log_exception(LOG, "Uploading to '{h}' failed".format(h=remote.ftp), e, logging.WARNING)
+                mini_buildd.setup.log_exception(LOG, "Uploading to '{h}' failed".format(h=builder.ftp), e, logging.WARNING)
 
         raise Exception("Buildrequest upload failed for {a}/{c}".format(a=arch, c=codename))
 
-    def tar(self, tar_path, add_files=None):
-        with contextlib.closing(tarfile.open(tar_path, "w")) as tar:
+    def tar(self, tar_path, add_files=None, manifest=None):
+        """
+        Tar this changes with all its files (plus 'add_files').
+
+        With 'manifest' (a Changes instance), big files are
+        added to the blob store and the manifest instead.
+
+        The tar is written as uncompressed stream (one
+        sequential write, no seeks).
+        """
+        with contextlib.closing(tarfile.open(tar_path, "w|")) as tar:
             def tar_add(file_name):
-                tar.add(file_name, arcname=os.path.basename(file_name))
+                if manifest is not None and os.path.getsize(file_name) >= mini_buildd.blobs.MIN_SIZE:
+                    manifest.add_blob(file_name, mini_buildd.blobs.add(file_name))
+                else:
+                    tar.add(file_name, arcname=os.path.basename(file_name))
 
-            tar_add(self._file_path)
+            tar.add(self._file_path, arcname=self._file_name)
             for f in self.get_files():
                 tar_add(os.path.join(os.path.dirname(self._file_path), f["name"]))
             if add_files:
@@ -285,13 +329,31 @@ class Changes(debian.deb822.Changes):
                     tar_add(f)
 
     def untar(self, path):
+        """
+        Extract tar to path, and link blobs from the store.
+
+        The tar is read as stream (one sequential read, no
+        seeks). Only plain files are extracted, ignoring any
+        directory parts of member names.
+        """
         tar_file = self._file_path + ".tar"
         if os.path.exists(tar_file):
-            with contextlib.closing(tarfile.open(tar_file, "r")) as tar:
-                tar.extractall(path=path)
+            with contextlib.closing(tarfile.open(tar_file, "r|")) as tar:
+                for member in tar:
+                    if not member.isfile():
+                        LOG.warn("Ignoring non-file tar member: {f}: {m}".format(f=tar_file, m=member.name))
+                        continue
+                    dst = os.path.join(path, os.path.basename(member.name))
+                    with open(dst, "wb") as f:
+                        shutil.copyfileobj(tar.extractfile(member), f, self._TAR_BUFSIZE)
+                    os.chmod(dst, member.mode & (stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO))
+                    os.utime(dst, (member.mtime, member.mtime))
         else:
             LOG.info("No tar file (skipping): {f}".format(f=tar_file))
 
+        for b in self.get_blobs():
+            mini_buildd.blobs.link(b["sha256"], os.path.join(path, b["name"]))
+
     def move_to_pkglog(self, installed):
         logdir = self.get_pkglog_dir(installed, relative=False)
         if logdir and not os.path.exists(logdir):
@@ -305,7 +367,7 @@ class Changes(debian.deb822.Changes):
             # If installed, only save buildlogs and changes.
             if logdir and (not installed or re.match(r"(.*\.buildlog$|.*changes$)", f)):
                 LOG.info("Moving '{f}' to '{d}'". format(f=f, d=logdir))
-                os.rename(f_abs, os.path.join(logdir, f))
+                mini_buildd.misc.PkgLog.archive(f_abs, logdir, status=self.get("Sbuild-Status"))
             else:
                 LOG.info("Removing '{f}'". format(f=f))
                 mini_buildd.misc.skip_if_keep_in_debug(os.remove, f_abs)
@@ -317,7 +379,7 @@ class Changes(debian.deb822.Changes):
             LOG.debug("Removing: '{f}'".format(f=fd["name"]))
             os.remove(f)
 
-    def gen_buildrequests(self, daemon, repository, dist, suite_option):
+    def gen_buildrequests(self, daemon, repository, dist, suite_option, blobs_supported=None):
         """
         Build buildrequest files for all architectures.
         """
@@ -354,6 +416,9 @@ class Changes(debian.deb822.Changes):
             if breq.is_new():
                 for v in ["Distribution", "Source", "Version"]:
                     breq[v] = self[v]
+                # Informational, for fair share queueing
+                if "Changed-By" in self:
+                    breq["Changed-By"] = self["Changed-By"]
 
                 # Generate sources.list et.al. to be used
                 mini_buildd.misc.open_utf8(os.path.join(path, "apt_sources.list"), "w").write(dist.mbd_get_apt_sources_list(repository, suite_option))
@@ -372,16 +437,22 @@ class Changes(debian.deb822.Changes):
                                     os.path.join(path, "apt_preferences"),
                                     os.path.join(path, "apt_keys"),
                                     chroot_setup_script,
-                                    os.path.join(path, "sbuildrc_snippet")] + files_from_pool)
+                                    os.path.join(path, "sbuildrc_snippet")] + files_from_pool,
+                         # Offload big files to blobs only if all possible builders understand that
+                         manifest=breq if blobs_supported and blobs_supported(ao.architecture.name) else None)
                 breq.add_file(breq.file_path + ".tar")
+                # We understand blob manifests in the build result
+                breq["Accept-Blobs"] = "yes"
 
                 breq["Upload-Result-To"] = daemon.mbd_get_ftp_hopo().string
+                breq["Upload-Result-Http"] = daemon.mbd_get_http_hopo().string
                 breq["Base-Distribution"] = dist.base_source.codename
                 breq["Architecture"] = ao.architecture.name
                 if ao.build_architecture_all:
                     breq["Arch-All"] = "Yes"
                 breq["Build-Dep-Resolver"] = dist.get_build_dep_resolver_display()
                 breq["Apt-Allow-Unauthenticated"] = "1" if dist.apt_allow_unauthenticated else "0"
+                breq["Build-Priority"] = "{p}".format(p=repository.mbd_get_build_priority(suite_option) + daemon.mbd_get_queue_boost(self, suite_option.experimental))
                 if dist.lintian_mode != dist.LINTIAN_DISABLED:
                     # Generate lintian options
                     modeargs = {
@@ -411,7 +482,7 @@ class Changes(debian.deb822.Changes):
 
         return bres
 
-    def upload_failed_buildresult(self, gnupg, hopo, retval, status, exception):
+    def upload_failed_buildresult(self, gnupg, hopo, retval, status, exception, queue=None):
         with contextlib.closing(mini_buildd.misc.TmpDir()) as t:
             bres = self.gen_buildresult(path=t.tmpdir)
 
@@ -425,4 +496,4 @@ Build request failed: {r} ({s}): {e}
 """.format(h=socket.getfqdn(), r=retval, s=status, e=exception))
             bres.add_file(buildlog)
             bres.save(gnupg)
-            bres.upload(hopo)
+            bres.upload(hopo, queue=queue, gnupg=gnupg)
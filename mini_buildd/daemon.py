@@ -9,7 +9,6 @@ import glob
 import tempfile
 import threading
 import subprocess
-import Queue
 import collections
 import urllib2
 import logging
@@ -25,6 +24,8 @@ import mini_buildd.changes
 import mini_buildd.gnupg
 import mini_buildd.api
 import mini_buildd.ftpd
+import mini_buildd.transfer
+import mini_buildd.reprepro
 import mini_buildd.packager
 import mini_buildd.builder
 
@@ -283,12 +284,18 @@ class DSTPackage(mini_buildd.misc.TmpDir):
 class Keyrings(object):
     """
     Hold/manage all gnupg keyrings (for remotes and all repository uploaders).
+
+    Keyrings are kept in a persistent key store (VAR_DIR/keyrings),
+    so an update only needs to dearmor keys not seen before.
     """
+    _UPDATE_LOCK = threading.Lock()
+
     def __init__(self):
-        self._our_pub_key = get().model.mbd_get_pub_key()
-        self._remotes = self._gen_remotes()
-        self._uploaders = self._gen_uploaders()
-        self._needs_update = False
+        self._store = mini_buildd.gnupg.KeyStore(os.path.join(mini_buildd.setup.VAR_DIR, "keyrings"))
+        self._remotes = None
+        self._uploaders = {}
+        self._needs_update = True
+        self._update()
 
     def set_needs_update(self):
         self._needs_update = True
@@ -299,9 +306,20 @@ class Keyrings(object):
             u.close()
 
     def _update(self):
-        if self._needs_update:
-            self.close()
-            self.__init__()
+        with self._UPDATE_LOCK:
+            if self._needs_update:
+                # Reset up front so a set_needs_update() while generating is not lost; set again on failure
+                self._needs_update = False
+                try:
+                    our_pub_key = get().model.mbd_get_pub_key()
+                    remotes = self._gen_remotes(our_pub_key)
+                    uploaders = self._gen_uploaders(our_pub_key)
+                    # Also removes keyrings of gone repositories
+                    self._store.purge(keep=[remotes] + list(uploaders.values()))
+                    self._remotes, self._uploaders = remotes, uploaders
+                except:
+                    self._needs_update = True
+                    raise
 
     def get_remotes(self):
         self._update()
@@ -311,61 +329,242 @@ class Keyrings(object):
         self._update()
         return self._uploaders
 
-    def _gen_remotes(self):
-        remotes = mini_buildd.gnupg.TmpGnuPG()
+    def _gen_remotes(self, our_pub_key):
         # keyring["remotes"]: Remotes keyring to authorize buildrequests and buildresults
         # Always add our own key
-        if self._our_pub_key:
-            remotes.add_pub_key(self._our_pub_key)
+        keys = [our_pub_key]
         for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
-            remotes.add_pub_key(r.key)
-            LOG.info("Remote key added for '{r}': {k}: {n}".format(r=r, k=r.key_long_id, n=r.key_name))
-        return remotes
+            keys.append(r.key)
+            LOG.debug("Remote key for '{r}': {k}: {n}".format(r=r, k=r.key_long_id, n=r.key_name))
+        return self._store.keyring("remotes", keys)
 
-    def _gen_uploaders(self):
+    def _gen_uploaders(self, our_pub_key):
         "All uploader keyrings for each repository."
         uploaders = {}
         for r in mini_buildd.models.repository.Repository.mbd_get_active():
-            uploaders[r.identity] = r.mbd_get_uploader_keyring()
             # Always add our key too for internal builds
-            if self._our_pub_key:
-                uploaders[r.identity].add_pub_key(self._our_pub_key)
+            uploaders[r.identity] = r.mbd_get_uploader_keyring(self._store, extra_keys=[our_pub_key])
         return uploaders
 
 
-def run():
+class Remotes(object):
     """
-    mini-buildd 'daemon engine' run.
+    Registry of builders (our own instance and all active remotes) for build request placement.
+
+    Builder status is cached, and refreshed every 'ttl' seconds
+    in the background (see run()). Between refreshes, build
+    requests assigned by us are counted as 'in flight' for the
+    builder. Turnaround times (build request upload to build
+    result) observed by us are smoothed per builder.
+
+    Builders are selected by expected completion time, i.e., the
+    work queued on the builder (plus our in-flight assignments)
+    divided by its number of workers, times its average build
+    time. The build time used is the builder's average for the
+    requested chroot if known (per-chroot capacity: the same
+    builder may be fast for amd64, but slow for an emulated
+    architecture), else its overall average, else our observed
+    turnaround.
     """
+    ALPHA = 0.3
+
+    def __init__(self, ttl, incoming_queue):
+        self.ttl = ttl
+        self._incoming_queue = incoming_queue
+        self._lock = threading.Lock()
+        self._stati = []
+        self._updated = None
+        self._inflight = {}
+        self._turnaround = {}
+        self._assignments = {}
+        self._shutdown = threading.Event()
 
-    ftpd_thread = mini_buildd.misc.run_as_thread(
-        mini_buildd.ftpd.run,
-        bind=get().model.ftpd_bind,
-        queue=get().incoming_queue)
+    def __unicode__(self):
+        with self._lock:
+            return ", ".join(["{h} (load {l}, {i} in flight, turnaround {t})".format(h=s.http,
+                                                                                  l=s.load,
+                                                                                  i=self._inflight.get(s.http, 0),
+                                                                                  t=self._turnaround.get(s.http, "n/a")) for s in self._stati])
+
+    def refresh(self):
+        stati = []
+
+        # Always add our own instance first (no need to go via http)
+        try:
+            stati.append(get().get_status())
+        except Exception as e:
+            mini_buildd.setup.log_exception(LOG, "Remotes: Own status failed", e, logging.WARNING)
+
+        # Check all active or auto-deactivated remotes
+        for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
+            try:
+                mini_buildd.models.gnupg.Remote.Admin.mbd_check(None, r, force=True)
+                stati.append(r.mbd_get_status())
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Remotes: Builder check failed", e, logging.WARNING)
+
+        with self._lock:
+            self._stati = stati
+            self._updated = time.time()
+            # Fresh stati include all our assignments so far
+            self._inflight = {}
+        LOG.debug("Remotes refreshed: {r}".format(r=self))
+
+    def _runtime(self, status, chroot):
+        return getattr(status, "chroot_runtimes", {}).get(chroot) or getattr(status, "build_runtime", None) or self._turnaround.get(status.http)
+
+    def _expected_completion(self, status, chroot, use_runtime):
+        workers = max(1, getattr(status, "build_workers", 1))
+        queued = status.load * workers + self._inflight.get(status.http, 0)
+        return (queued + 1.0) / workers * (self._runtime(status, chroot) if use_runtime else 1.0)
+
+    def get_builders(self, codename, arch):
+        """
+        Get stati of running builders with the given chroot, best first.
+        """
+        with self._lock:
+            stale = self._updated is None or time.time() - self._updated > 2 * self.ttl
+        if stale:
+            self.refresh()
+
+        with self._lock:
+            builders = [s for s in self._stati if s.running and s.has_chroot(codename, arch)]
+            chroot = "{c}:{a}".format(c=codename, a=arch)
+            # Compare by build times only if known for all builders, else just by queued work
+            use_runtime = all([self._runtime(b, chroot) for b in builders])
+            return sorted(builders, key=lambda b: (self._expected_completion(b, chroot, use_runtime), b.http))
+
+    def blobs_supported(self, codename, arch):
+        """
+        Whether all builders for the chroot understand blob manifests (older ones need build requests as full tar).
+        """
+        return all(["blobs" in getattr(s, "capabilities", []) for s in self.get_builders(codename, arch)])
+
+    def get_local_queue(self, ftp):
+        """
+        Get our incoming queue if ftp hopo (string) is our own instance (local upload), else None.
+        """
+        return self._incoming_queue if ftp == get().model.mbd_get_ftp_hopo().string else None
+
+    def assigned(self, status, breq):
+        "Build request was uploaded to builder."
+        with self._lock:
+            self._inflight[status.http] = self._inflight.get(status.http, 0) + 1
+            self._assignments[breq.get_pkg_id(with_arch=True)] = (status.http, time.time())
+
+    def completed(self, bres):
+        "Build result received."
+        with self._lock:
+            http, stamp = self._assignments.pop(bres.get_pkg_id(with_arch=True), (None, None))
+            if http:
+                turnaround = time.time() - stamp
+                old = self._turnaround.get(http)
+                self._turnaround[http] = round(turnaround if old is None else self.ALPHA * turnaround + (1.0 - self.ALPHA) * old, 1)
+
+    def run(self):
+        "Background refresh."
+        while not self._shutdown.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Remotes: Refresh failed", e, logging.WARNING)
+            self._shutdown.wait(self.ttl)
+
+    def shutdown(self):
+        self._shutdown.set()
+
+
+def _queue_owners(changes):
+    "Fair share owners of changes: Repository and uploader."
+    owners = []
+    try:
+        owners.append("repository:" + mini_buildd.misc.Distribution(changes["Distribution"]).repository)
+    except Exception as e:
+        LOG.debug("No repository owner for queue item: {e}".format(e=e))
+    if "Changed-By" in changes:
+        owners.append("uploader:" + changes["Changed-By"])
+    return owners
+
+
+def classify_incoming(path):
+    "Get queue priority, owners and group for incoming changes."
+    with mini_buildd.misc.open_utf8(path) as f:
+        changes = debian.deb822.Changes(f)
+    priority = 0
+    file_name = os.path.basename(path)
+    if mini_buildd.changes.Changes.BUILDREQUEST_RE.match(file_name):
+        # Build requests are just handed over to the builder, no need to serialize
+        group = None
+    else:
+        # Serialize user uploads and build results per package
+        group = "{s}_{v}".format(s=changes["Source"], v=changes["Version"])
+    if not (mini_buildd.changes.Changes.BUILDREQUEST_RE.match(file_name) or mini_buildd.changes.Changes.BUILDRESULT_RE.match(file_name)):
+        experimental = True
+        try:
+            dist = mini_buildd.misc.Distribution(changes["Distribution"])
+            repository = mini_buildd.models.repository.Repository.objects.get(identity=dist.repository)
+            experimental = repository.layout.suiteoption_set.get(suite__name=dist.suite).experimental
+        except Exception as e:
+            LOG.debug("Can't determine suite option for queue item (no boost): {e}".format(e=e))
+        priority = get().model.mbd_get_queue_boost(changes, experimental)
+    return priority, _queue_owners(changes), group
+
+
+def classify_buildrequest(path):
+    "Get queue priority, owners and group for build requests."
+    with mini_buildd.misc.open_utf8(path) as f:
+        breq = debian.deb822.Changes(f)
+    return int(breq.get("Build-Priority", "0")), _queue_owners(breq), None
+
+
+def _reject_incoming_notify(file_name, content, reason):
+    changes = debian.deb822.Changes(content)
+    repository = None
+    try:
+        repository = mini_buildd.models.repository.Repository.objects.get(identity=mini_buildd.misc.Distribution(changes["Distribution"]).repository)
+    except Exception as e:
+        LOG.debug("No repository for rejected changes (notifying uploader only): {e}".format(e=e))
+    get().model.mbd_notify("REJECTED: {f}: {r}".format(f=file_name, r=reason),
+                           "Upload rejected: {r}\n\n{c}".format(r=reason, c=content),
+                           repository,
+                           changes)
 
-    builder_thread = mini_buildd.misc.run_as_thread(
-        mini_buildd.builder.run,
-        daemon_=get())
 
+def reject_incoming(file_name, content, reason):
+    """
+    Report incoming changes rejected by ftpd (missing or corrupt files).
+
+    Notification is like for any rejected package (uploader
+    and maintainer as configured for the repository), and runs
+    in the background (not to block ftpd).
+    """
+    mini_buildd.misc.run_as_thread(_reject_incoming_notify, file_name=file_name, content=content, reason=reason)
+
+
+def incoming_worker(queue):
+    """
+    Process events from the incoming queue.
+
+    Several of these run in parallel; the queue's job groups
+    (the package id) make sure events of the same package are
+    processed one after the other.
+    """
     while True:
-        event = get().incoming_queue.get()
-        if event == "SHUTDOWN":
+        job = queue.get()
+        if job is None:
             break
 
+        event = job.item
         try:
             LOG.info("Status: {0} active packages, {1} changes waiting in incoming.".
-                     format(len(get().packages), get().incoming_queue.qsize()))
+                     format(len(get().packages), queue.depth))
 
             changes = None
             changes = mini_buildd.changes.Changes(event)
 
             if changes.type == changes.TYPE_BREQ:
-                # Build request: builder
-
-                def queue_buildrequest(event):
-                    "Queue in extra thread so we don't block here in case builder is busy."
-                    get().build_queue.put(event)
-                mini_buildd.misc.run_as_thread(queue_buildrequest, daemon=True, event=event)
+                # Build request: builder (non-blocking)
+                get().build_queue.put(event)
 
             else:
                 # User upload or build result: packager
@@ -394,15 +593,47 @@ def run():
                 mini_buildd.setup.log_exception(LOG, "Invalid changes cleanup failed", e)
 
         finally:
-            get().incoming_queue.task_done()
+            job.queue.task_done(job)
 
-    get().build_queue.put("SHUTDOWN")
+
+def run():
+    """
+    mini-buildd 'daemon engine' run.
+    """
+
+    ftpd_thread = mini_buildd.misc.run_as_thread(
+        mini_buildd.ftpd.run,
+        bind=get().model.ftpd_bind,
+        queue=get().incoming_queue,
+        reject=reject_incoming)
+
+    builder_thread = mini_buildd.misc.run_as_thread(
+        mini_buildd.builder.run,
+        daemon_=get())
+
+    remotes_thread = mini_buildd.misc.run_as_thread(get().remotes.run)
+
+    exporter_thread = mini_buildd.misc.run_as_thread(mini_buildd.reprepro.EXPORTER.run)
+
+    incoming_queue = get().incoming_queue
+    incoming_threads = [mini_buildd.misc.run_as_thread(incoming_worker, queue=incoming_queue) for _n in range(incoming_queue.workers)]
+    incoming_queue.wait_shutdown()
+    for t in incoming_threads:
+        t.join()
+
+    # Pending builds are journaled, and resumed on next start
+    get().build_queue.shutdown(drain=False)
+    get().remotes.shutdown()
     mini_buildd.ftpd.shutdown()
     builder_thread.join()
+    remotes_thread.join()
     ftpd_thread.join()
 
-    # keyrings.close() is not called implicitly; this leaves tmp files around.
-    # There should be a nicer way, really...
+    # Last, as packagers may still have scheduled exports
+    mini_buildd.reprepro.EXPORTER.shutdown()
+    exporter_thread.join()
+
+    # Keyrings are persistent (see mini_buildd.gnupg.KeyStore); close() is just for symmetry
     try:
         get().keyrings.close()
     except:
@@ -423,6 +654,7 @@ class Daemon(object):
         # Vars that are (re)generated when the daemon model is updated
         self.model = None
         self.keyrings = None
+        self.remotes = None
         self.incoming_queue = None
         self.build_queue = None
         self.packages = None
@@ -454,8 +686,20 @@ class Daemon(object):
             self.keyrings = Keyrings()
         else:
             self.keyrings.set_needs_update()
-        self.incoming_queue = Queue.Queue()
-        self.build_queue = mini_buildd.misc.BlockQueue(maxsize=self.model.build_queue_size)
+        self.incoming_queue = mini_buildd.misc.JobQueue(workers=int(self.model.mbd_get_extra_option("Packager-Workers", mini_buildd.misc.get_cpus())),
+                                                        discipline=self.model.mbd_get_queue_discipline(),
+                                                        classify=classify_incoming)
+        self.build_queue = mini_buildd.builder.Scheduler(workers=self.model.build_queue_size,
+                                                         journal_path=os.path.join(mini_buildd.setup.VAR_DIR, "builder.journal"),
+                                                         history_path=os.path.join(mini_buildd.setup.VAR_DIR, "builder.history"),
+                                                         discipline=self.model.mbd_get_queue_discipline(),
+                                                         classify=classify_buildrequest,
+                                                         previous=self.build_queue)
+        self.remotes = Remotes(ttl=int(self.model.mbd_get_extra_option("Remotes-Status-TTL", "60")),
+                               incoming_queue=self.incoming_queue)
+        mini_buildd.transfer.configure(block_size=int(self.model.mbd_get_extra_option("FTP-Block-Size", "0")),
+                                       parallel=int(self.model.mbd_get_extra_option("FTP-Parallel", "0")))
+        mini_buildd.reprepro.EXPORTER.configure(delay=float(self.model.mbd_get_extra_option("Export-Delay", "0")))
         self.packages = {}
         self.builds = {}
         self.last_packages = collections.deque(maxlen=self.model.show_last_packages)
@@ -506,7 +750,7 @@ class Daemon(object):
                 self.update_to_model(model)
                 model.save()
 
-                self.incoming_queue.put("SHUTDOWN")
+                self.incoming_queue.shutdown()
                 self.thread.join()
                 self.thread = None
                 self._update_from_model()
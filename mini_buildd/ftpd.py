@@ -3,20 +3,24 @@ from __future__ import unicode_literals
 
 import os
 import stat
+import time
 import glob
 import shutil
 import fnmatch
+import hashlib
 import logging
 
 import debian.deb822
 
 import pyftpdlib.handlers
 import pyftpdlib.authorizers
+import pyftpdlib.filesystems
 import pyftpdlib.servers
 
 import mini_buildd
 import mini_buildd.setup
 import mini_buildd.misc
+import mini_buildd.blobs
 
 LOG = logging.getLogger(__name__)
 
@@ -32,10 +36,19 @@ class Incoming(object):
     def get_changes(cls):
         return glob.glob(os.path.join(mini_buildd.setup.INCOMING_DIR, "*.changes"))
 
+    # Unreferenced files younger than this are kept: They may
+    # be part of an upload still in progress (see transfer.py)
+    CRUFT_EXPIRE = 24 * 60 * 60
+    # Expired cruft is checked for at most that often (see remove_cruft_maybe())
+    CRUFT_INTERVAL = 10 * 60
+    _CRUFT_CHECKED = 0.0
+
     @classmethod
-    def remove_cruft_files(cls, files):
+    def remove_cruft_files(cls, files, expire=None):
         """
         Remove all files from list of files not mentioned in a changes file.
+
+        With 'expire' (seconds), only remove files not modified for that long.
         """
         valid_files = []
         for changes_file in files:
@@ -50,8 +63,15 @@ class Incoming(object):
                 except Exception as e:
                     mini_buildd.setup.log_exception(LOG, "Invalid changes file: {f}".format(f=changes_file), e, logging.WARNING)
 
+        now = time.time()
         for f in files:
             if os.path.basename(f) not in valid_files:
+                if not os.path.lexists(f):
+                    # Already processed (and removed) by the packager
+                    continue
+                if expire and now - os.lstat(f).st_mtime < expire:
+                    LOG.debug("Keeping unreferenced file (upload in progress?): {f}".format(f=f))
+                    continue
                 # Be sure to never ever fail, just because cruft removal fails (instead log accordingly)
                 try:
                     if os.path.isdir(f):
@@ -63,11 +83,53 @@ class Incoming(object):
                     mini_buildd.setup.log_exception(LOG, "Can't remove cruft from incoming: {f}".format(f=f), e, logging.CRITICAL)
 
     @classmethod
-    def remove_cruft(cls):
+    def remove_cruft(cls, expire=None):
         """
         Remove cruft files from incoming.
         """
-        cls.remove_cruft_files(["{p}/{f}".format(p=mini_buildd.setup.INCOMING_DIR, f=f) for f in os.listdir(mini_buildd.setup.INCOMING_DIR)])
+        cls.remove_cruft_files(["{p}/{f}".format(p=mini_buildd.setup.INCOMING_DIR, f=f) for f in os.listdir(mini_buildd.setup.INCOMING_DIR)], expire=expire)
+
+    @classmethod
+    def remove_cruft_maybe(cls):
+        """
+        Remove expired cruft files from incoming, unless already done within the last CRUFT_INTERVAL seconds.
+        """
+        if time.time() - cls._CRUFT_CHECKED > cls.CRUFT_INTERVAL:
+            cls._CRUFT_CHECKED = time.time()
+            cls.remove_cruft(expire=cls.CRUFT_EXPIRE)
+
+    @classmethod
+    def check_changes(cls, changes_file):
+        """
+        Check that all files of a changes are in place, with size and checksums as given in the changes.
+
+        Returns a list of (PATH, PROBLEM); PROBLEM is 'missing' or 'corrupt'.
+
+        >>> d = mini_buildd.misc.TmpDir()
+        >>> with open(os.path.join(d.tmpdir, "a.tar"), "w") as f: f.write("a\\n")
+        >>> with open(os.path.join(d.tmpdir, "a.changes"), "w") as f: f.write("Files:\\n 60b725f10c9c85c70d97880dfe8191b3 2 x y a.tar\\n 60b725f10c9c85c70d97880dfe8191b3 2 x y b.tar\\n")
+        >>> [(os.path.basename(p), e) for p, e in Incoming.check_changes(os.path.join(d.tmpdir, "a.changes"))]
+        [(u'b.tar', u'missing')]
+        >>> with open(os.path.join(d.tmpdir, "b.tar"), "w") as f: f.write("b\\n")
+        >>> [(os.path.basename(p), e) for p, e in Incoming.check_changes(os.path.join(d.tmpdir, "a.changes"))]
+        [(u'b.tar', u'corrupt')]
+        >>> d.close()
+        """
+        problems = {}
+        with mini_buildd.misc.open_utf8(changes_file) as f:
+            changes = debian.deb822.Changes(f)
+        for field, key, digest in [("Files", "md5sum", "md5"), ("Checksums-Sha1", "sha1", "sha1"), ("Checksums-Sha256", "sha256", "sha256")]:
+            for fd in changes.get(field, []):
+                path = os.path.join(os.path.dirname(changes_file), fd["name"])
+                if path in problems:
+                    continue
+                if not os.path.exists(path):
+                    problems[path] = "missing"
+                else:
+                    digests = mini_buildd.misc.get_file_digests(path)
+                    if int(fd["size"]) != digests["size"] or fd[key] != digests[digest]:
+                        problems[path] = "corrupt"
+        return sorted(problems.items())
 
     @classmethod
     def requeue_changes(cls, queue):
@@ -83,7 +145,74 @@ class Incoming(object):
             queue.put(c)
 
 
+class HashingFile(object):
+    """
+    File object wrapper computing digests (see mini_buildd.misc.DIGESTS) of all data written.
+
+    On resume (seek) or append, the data already in the file is
+    hashed first. When closed, the digests are passed to 'on_close'.
+    """
+    def __init__(self, file_obj, on_close):
+        self._file = file_obj
+        self._on_close = on_close
+        self._hashes = [hashlib.new(d) for d in mini_buildd.misc.DIGESTS]
+        self._size = 0
+        if "a" in file_obj.mode and os.path.exists(file_obj.name):
+            self._hash_existing(os.path.getsize(file_obj.name))
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def _update(self, data):
+        for h in self._hashes:
+            h.update(data)
+        self._size += len(data)
+
+    def _hash_existing(self, size):
+        with open(self._file.name, "rb") as f:
+            while self._size < size:
+                data = f.read(min(1024 * 1024, size - self._size))
+                if not data:
+                    break
+                self._update(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 0 and offset > 0 and self._size == 0:
+            self._hash_existing(offset)
+        self._file.seek(offset, whence)
+
+    def write(self, data):
+        self._file.write(data)
+        self._update(data)
+
+    def close(self):
+        self._file.close()
+        self._on_close(self._file.name, dict(zip(mini_buildd.misc.DIGESTS, [h.hexdigest() for h in self._hashes]), size=self._size))
+
+
+class HashingFS(pyftpdlib.filesystems.AbstractedFS):
+    """
+    Filesystem hashing all files received (see HashingFile), so received files never need to be read again for checksums.
+    """
+    def __init__(self, *args, **kwargs):
+        pyftpdlib.filesystems.AbstractedFS.__init__(self, *args, **kwargs)
+        self.mbd_digests = {}
+
+    def _mbd_on_close(self, file_name, digests):
+        self.mbd_digests[file_name] = digests
+
+    def open(self, filename, mode):
+        file_obj = pyftpdlib.filesystems.AbstractedFS.open(self, filename, mode)
+        return HashingFile(file_obj, self._mbd_on_close) if "w" in mode or "a" in mode or "+" in mode else file_obj
+
+
 class FtpDHandler(pyftpdlib.handlers.FTPHandler):
+    abstracted_fs = HashingFS
+
+    proto_cmds = dict(pyftpdlib.handlers.FTPHandler.proto_cmds,
+                      XSHA256=dict(perm="l", auth=True, arg=True,
+                                   help="Syntax: XSHA256 <SP> file-name (get sha256 of file, see transfer.py)."))
+
     def __init__(self, *args, **kwargs):
         # Note: FTPHandler is not a new style class, so we can't use 'super' here
         pyftpdlib.handlers.FTPHandler.__init__(self, *args, **kwargs)
@@ -92,23 +221,95 @@ class FtpDHandler(pyftpdlib.handlers.FTPHandler):
     def on_file_received(self, file_name):
         """
         Make any incoming file read-only as soon as it arrives; avoids overriding uploads of the same file.
+
+        The digests computed while receiving are put into the
+        digest cache, so neither the checks on disconnect nor
+        the blob store or packager need to read the file again.
         """
         os.chmod(file_name, stat.S_IRUSR | stat.S_IRGRP)
-        self._mbd_files_received.append(file_name)
+        digests = self.fs.mbd_digests.pop(file_name, None)
+        if digests and digests["size"] == os.path.getsize(file_name):
+            mini_buildd.misc.set_file_digests(file_name, digests)
         LOG.info("File received: {f}".format(f=file_name))
+        if mini_buildd.blobs.is_blob(file_name):
+            # Blobs go to the blob store right away (the referring changes is uploaded last)
+            try:
+                mini_buildd.blobs.receive(file_name)
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Invalid blob received", e, logging.WARNING)
+        else:
+            self._mbd_files_received.append(file_name)
+
+    def ftp_XSHA256(self, path):
+        """
+        Return sha256 of a file; lets clients verify files already on the server before skipping or resuming them.
+        """
+        if not self.fs.isfile(self.fs.realpath(path)):
+            self.respond("550 {f} is not retrievable.".format(f=self.fs.fs2ftp(path)))
+            return
+        try:
+            self.respond("213 {h}".format(h=mini_buildd.misc.sha256_of_file(path)))
+        except (IOError, OSError) as e:
+            self.respond("550 {e}.".format(e=e))
 
     def on_incomplete_file_received(self, file_name):
+        """
+        Keep incomplete files (writable) so the client may resume the upload; expired ones are removed as cruft.
+        """
+        self.fs.mbd_digests.pop(file_name, None)
         LOG.warning("Incomplete file received: {f}".format(f=file_name))
-        self._mbd_files_received.append(file_name)
+
+    def _mbd_reject(self, changes_file, problems):
+        """
+        Reject changes: Remove it, and its corrupt files (these are read-only, and would block a new upload).
+
+        The rejection is then handed over to 'mini_buildd_reject' (see run()) for notification.
+        """
+        reason = ", ".join(["{f}: {p}".format(f=os.path.basename(path), p=problem) for path, problem in problems])
+        LOG.error("Rejecting '{c}': {r}".format(c=changes_file, r=reason))
+
+        with mini_buildd.misc.open_utf8(changes_file) as f:
+            content = f.read()
+        for path, problem in problems:
+            if problem == "corrupt":
+                os.remove(path)
+        os.remove(changes_file)
+
+        if self.mini_buildd_reject:
+            self.mini_buildd_reject(os.path.basename(changes_file), content, reason)
 
     def on_disconnect(self):
+        """
+        Check and queue received changes.
+
+        Changes with missing or corrupt files are rejected right
+        away, and never reach the queue.
+
+        Files of one upload may arrive via several sessions (see
+        transfer.py), so other files not (yet) in any changes
+        file are only removed when expired (see run()).
+        """
         for file_name in (f for f in self._mbd_files_received if Incoming.is_changes(f)):
+            problems = []
+            try:
+                problems = Incoming.check_changes(file_name)
+            except Exception as e:
+                # Invalid changes are left to the packager (which also reports them)
+                mini_buildd.setup.log_exception(LOG, "Can't check incoming changes file: {f}".format(f=file_name), e, logging.WARNING)
+            if problems:
+                self._mbd_reject(file_name, problems)
+                continue
             LOG.info("Queuing incoming changes file: {f}".format(f=file_name))
             self.mini_buildd_queue.put(file_name)
-        Incoming.remove_cruft_files(self._mbd_files_received)
 
 
-def run(bind, queue):
+def run(bind, queue, reject=None):
+    """
+    Run ftpd: Received changes are put into 'queue'.
+
+    Changes with missing or corrupt files are rejected, and
+    reported via 'reject(FILE_NAME, CONTENT, REASON)'.
+    """
     mini_buildd.misc.clone_log("pyftpdlib")
 
     ba = mini_buildd.misc.HoPo(bind)
@@ -120,8 +321,10 @@ def run(bind, queue):
 
     handler.banner = "mini-buildd {v} ftp server ready (pyftpdlib {V}).".format(v=mini_buildd.__version__, V=pyftpdlib.__ver__)
     handler.mini_buildd_queue = queue
+    handler.mini_buildd_reject = staticmethod(reject) if reject else None
 
     Incoming.remove_cruft()
+    mini_buildd.blobs.purge()
     Incoming.requeue_changes(queue)
 
     ftpd = pyftpdlib.servers.FTPServer(ba.tuple, handler)
@@ -132,6 +335,7 @@ def run(bind, queue):
 
     while _RUN:
         ftpd.serve_forever(timeout=5.0, blocking=False, handle_exit=False)
+        Incoming.remove_cruft_maybe()
 
     ftpd.close_all()
 
@@ -6,6 +6,10 @@ import re
 import tempfile
 import shutil
 import subprocess
+import time
+import hashlib
+import threading
+import collections
 import logging
 
 import mini_buildd.misc
@@ -13,6 +17,23 @@ import mini_buildd.setup
 
 LOG = logging.getLogger(__name__)
 
+# Signing statistics (all homes)
+_SIGN_STATS_LOCK = threading.Lock()
+_SIGN_STATS = {"signatures": 0, "seconds": 0.0, "max": 0.0}
+
+# Homes with an already started gpg-agent
+_WARM_HOMES = set()
+
+
+def get_sign_stats():
+    """
+    Get signing statistics as dict: {"signatures": N, "latency": SECONDS, "max": SECONDS}.
+    """
+    with _SIGN_STATS_LOCK:
+        return {"signatures": _SIGN_STATS["signatures"],
+                "latency": round(_SIGN_STATS["seconds"] / _SIGN_STATS["signatures"], 3) if _SIGN_STATS["signatures"] else None,
+                "max": round(_SIGN_STATS["max"], 3)}
+
 
 class Colons(object):
     """
@@ -118,24 +139,56 @@ class BaseGnuPG(object):
         except:
             raise Exception("GnuPG authorization failed.")
 
+    def _warm_up(self):
+        """
+        Start the gpg-agent for this home once (gnupg >= 2.1), so signing does not pay for the agent start.
+        """
+        with _SIGN_STATS_LOCK:
+            if self.home in _WARM_HOMES:
+                return
+            _WARM_HOMES.add(self.home)
+        try:
+            mini_buildd.misc.call(["gpg-connect-agent", "--homedir={h}".format(h=self.home), "/bye"], error_log_on_fail=False)
+        except Exception as e:
+            LOG.debug("No gpg-agent started for {h}: {e}".format(h=self.home, e=e))
+
+    def _cool_down(self):
+        "Forget about the warm agent of this home (see _warm_up())."
+        with _SIGN_STATS_LOCK:
+            _WARM_HOMES.discard(self.home)
+
+    def sign_data(self, data, identity=None, detach=False, textmode=False):
+        """
+        Sign data in memory (via stdin/stdout). Returns the armored signature (detach), or the clearsigned data.
+        """
+        self._warm_up()
+        start = time.time()
+        gpg = subprocess.Popen(self.gpg_cmd +
+                               ["--armor", "--detach-sign" if detach else "--clearsign"] +
+                               (["--textmode"] if textmode else []) +
+                               (["--local-user={i}".format(i=identity)] if identity else []),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        signed, stderr = gpg.communicate(data)
+        if gpg.returncode != 0:
+            LOG.error("gpg signing failed: {e}".format(e=stderr.decode(mini_buildd.setup.CHAR_ENCODING, "replace")))
+            raise Exception("GnuPG signing failed (retval {r}).".format(r=gpg.returncode))
+
+        seconds = time.time() - start
+        with _SIGN_STATS_LOCK:
+            _SIGN_STATS["signatures"] += 1
+            _SIGN_STATS["seconds"] += seconds
+            _SIGN_STATS["max"] = max(_SIGN_STATS["max"], seconds)
+        return signed
+
     def sign(self, file_name, identity=None):
-        # 1st: copy the unsigned file and add an extra new line
-        # (Like 'debsign' from devscripts does: dpkg-source <= squeeze will have problems without the newline)
-        unsigned_file = file_name + ".asc"
-        shutil.copyfile(file_name, unsigned_file)
-        with open(unsigned_file, "a") as unsigned:
-            unsigned.write("\n")
-
-        # 2nd: Sign the file copy
-        signed_file = file_name + ".signed"
-        mini_buildd.misc.call(self.gpg_cmd +
-                              ["--armor", "--textmode", "--clearsign", "--output={f}".format(f=signed_file)] +
-                              (["--local-user={i}".format(i=identity)] if identity else []) +
-                              [unsigned_file])
+        # Add an extra new line (like 'debsign' from devscripts does: dpkg-source <= squeeze will have problems without the newline)
+        with open(file_name, "rb") as f:
+            signed = self.sign_data(f.read() + b"\n", identity=identity, textmode=True)
 
-        # 3rd: Success, move to orig file and cleanup
+        signed_file = file_name + ".signed"
+        with open(signed_file, "wb") as f:
+            f.write(signed)
         os.rename(signed_file, file_name)
-        os.remove(unsigned_file)
 
 
 class GnuPG(BaseGnuPG):
@@ -193,3 +246,228 @@ class TmpGnuPG(BaseGnuPG, mini_buildd.misc.TmpDir):
     def __init__(self):
         mini_buildd.misc.TmpDir.__init__(self)
         super(TmpGnuPG, self).__init__(home=self.tmpdir)
+
+    def close(self):
+        self._cool_down()
+        mini_buildd.misc.TmpDir.close(self)
+
+
+class Verifier(object):
+    """
+    Signature verification with 'gpgv' against keyring files.
+
+    Successful verifications are cached by the sha256 of the
+    signed file(s) and the keyring generation, so a file
+    verified again (and unchanged, with unchanged keys) needs no
+    gpgv run at all. Concurrent gpgv runs are limited to
+    'workers'.
+    """
+    CACHE_SIZE = 1000
+
+    def __init__(self, workers=4):
+        self._semaphore = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._stats = {"verifications": 0, "cached": 0, "failed": 0, "seconds": 0.0, "max": 0.0}
+
+    def _update_stats(self, cached=False, failed=False, seconds=0.0):
+        with self._lock:
+            self._stats["verifications"] += 1
+            self._stats["cached"] += int(cached)
+            self._stats["failed"] += int(failed)
+            self._stats["seconds"] += seconds
+            self._stats["max"] = max(self._stats["max"], seconds)
+
+    def get_stats(self):
+        """
+        Get verification statistics as dict: {"verifications": N, "cached": N, "failed": N, "latency": SECONDS, "max": SECONDS}.
+
+        'latency' is the average time of actual (uncached) gpgv runs.
+        """
+        with self._lock:
+            runs = self._stats["verifications"] - self._stats["cached"]
+            return {"verifications": self._stats["verifications"],
+                    "cached": self._stats["cached"],
+                    "failed": self._stats["failed"],
+                    "latency": round(self._stats["seconds"] / runs, 3) if runs else None,
+                    "max": round(self._stats["max"], 3)}
+
+    def verify(self, keyrings, generation, signature, data=None):
+        """
+        Verify 'signature' (with detached 'data') against the keyring files. Raises on failure.
+        """
+        # Always hash the actual content (never from the digest cache): This key decides on skipping verification
+        key = (mini_buildd.misc.sha256_of_file(signature, cached=False), mini_buildd.misc.sha256_of_file(data, cached=False) if data else None, generation)
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = self._cache.pop(key)
+                cached = True
+            else:
+                cached = False
+        if cached:
+            self._update_stats(cached=True)
+            return
+
+        start = time.time()
+        try:
+            with self._semaphore:
+                mini_buildd.misc.call(["gpgv"] + ["--keyring={k}".format(k=k) for k in keyrings] + [signature] + ([data] if data else []),
+                                      error_log_on_fail=False)
+        except:
+            self._update_stats(failed=True, seconds=time.time() - start)
+            raise Exception("GnuPG authorization failed.")
+        self._update_stats(seconds=time.time() - start)
+
+        with self._lock:
+            self._cache[key] = True
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+
+VERIFIER = Verifier()
+
+
+class Keyring(BaseGnuPG):
+    """
+    Read-only view on one keyring file of a KeyStore (plus optional extra keyring files).
+
+    'generation' changes whenever the set of keys changes.
+    """
+    def __init__(self, home, keyring, extra_keyrings, generation):
+        super(Keyring, self).__init__(home=home)
+        self.keyring = keyring
+        self.generation = generation
+        self.gpg_cmd += ["--no-default-keyring", "--keyring={k}".format(k=keyring)]
+        self.keyrings = [keyring]
+        for k in extra_keyrings:
+            self.add_keyring(k)
+            self.keyrings.append(k)
+
+    def verify(self, signature, data=None):
+        "Fast path: Verify via gpgv, with cached results (see Verifier)."
+        VERIFIER.verify(self.keyrings, self.generation, signature, data)
+
+    def close(self):
+        "Compatibility with TmpGnuPG: Nothing to clean up, the keyring file persists."
+        pass
+
+
+class KeyStore(object):
+    """
+    Persistent, content-hashed store of public keys, and keyrings made from them.
+
+    Each distinct (armored) key is dearmored only once, and
+    stored as 'keys/<sha256>.gpg'. A keyring is just the
+    concatenation of its binary keys ('<name>.gpg', listed in
+    '<name>.keys'), and is only rewritten when its set of keys
+    changed. Adding or removing a key thus never re-imports any
+    of the other keys.
+
+    >>> d = mini_buildd.misc.TmpDir()
+    >>> gnupg = TmpGnuPG()
+    >>> gnupg.gen_secret_key("Key-Type: DSA\\nKey-Length: 1024\\nName-Real: Test\\nName-Email: test@key.org")
+    >>> store = KeyStore(d.tmpdir)
+    >>> keyring = store.keyring("test", [gnupg.get_pub_key(identity="test@key.org")])
+    >>> [c.user_id for c in keyring.get_pub_colons(type_regex="uid")]
+    [u'Test <test@key.org>']
+    >>> store.keyring("test", [gnupg.get_pub_key(identity="test@key.org")]).generation == keyring.generation
+    True
+    >>> store.keyring("test", []).generation == keyring.generation
+    False
+    >>> store.purge()
+    1
+    >>> store.purge(keep=[]), sorted(os.listdir(d.tmpdir)) == ["home", "keys"]
+    (0, True)
+    >>> gnupg.close()
+    >>> d.close()
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        mini_buildd.misc.mkdirs(os.path.join(self.path, "keys"))
+
+    def _get_home(self, name):
+        home = os.path.join(self.path, "home", name)
+        if not os.path.exists(home):
+            mini_buildd.misc.mkdirs(home)
+            os.chmod(home, 0o700)
+        return home
+
+    def _add_key(self, key):
+        "Add armored key to the store. Returns its hash."
+        data = key.strip().encode(mini_buildd.setup.CHAR_ENCODING)
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.path, "keys", "{h}.gpg".format(h=sha256))
+        if not os.path.exists(path):
+            with tempfile.TemporaryFile() as t:
+                t.write(data + b"\n")
+                t.seek(0)
+                mini_buildd.misc.call(["gpg", "--batch", "--dearmor", "--output={o}".format(o=path + ".new")], stdin=t)
+            os.rename(path + ".new", path)
+            LOG.debug("Key stored: {p}".format(p=path))
+        return sha256
+
+    def keyring(self, name, keys, extra_keyrings=None):
+        """
+        Get keyring 'name' with the given armored keys (and extra keyring files), updating it as needed.
+        """
+        existing_keyrings = []
+        for k in extra_keyrings or []:
+            if os.path.exists(k):
+                existing_keyrings.append(k)
+            else:
+                LOG.warn("Skipping non-existing keyring file: {k}".format(k=k))
+
+        with self._lock:
+            hashes = sorted(set(self._add_key(k) for k in keys if k))
+            manifest = os.path.join(self.path, "{n}.keys".format(n=name))
+            keyring = os.path.join(self.path, "{n}.gpg".format(n=name))
+
+            old = []
+            if os.path.exists(manifest):
+                with mini_buildd.misc.open_utf8(manifest) as f:
+                    old = f.read().split()
+            if old != hashes or not os.path.exists(keyring):
+                with open(keyring + ".new", "wb") as f:
+                    for h in hashes:
+                        with open(os.path.join(self.path, "keys", "{h}.gpg".format(h=h)), "rb") as key:
+                            f.write(key.read())
+                os.rename(keyring + ".new", keyring)
+                with mini_buildd.misc.open_utf8(manifest, "w") as f:
+                    f.write("\n".join(hashes))
+                LOG.info("Keyring '{n}' updated: {k} keys (+{a} -{r})".format(n=name, k=len(hashes),
+                                                                            a=len(set(hashes) - set(old)),
+                                                                            r=len(set(old) - set(hashes))))
+
+            # Extra keyrings may change anytime: Add their size and mtime to the generation
+            generation = hashlib.sha256("\n".join(hashes + ["{k} {s.st_size} {s.st_mtime}".format(k=k, s=os.stat(k)) for k in existing_keyrings]).encode(mini_buildd.setup.CHAR_ENCODING)).hexdigest()
+            return Keyring(self._get_home(name), keyring, existing_keyrings, generation)
+
+    def purge(self, keep=None):
+        """
+        Remove stored keys no longer used by any keyring. Returns the number of keys removed.
+
+        With 'keep' (list of Keyring of this store), all other
+        keyrings (i.e., of gone repositories) are removed first.
+        """
+        removed = 0
+        with self._lock:
+            if keep is not None:
+                kept = [os.path.splitext(os.path.basename(k.keyring))[0] for k in keep]
+                for name in set(os.path.splitext(f)[0] for f in os.listdir(self.path) if os.path.splitext(f)[1] in [".keys", ".gpg"]) - set(kept):
+                    for f in [name + ".keys", name + ".gpg"]:
+                        if os.path.exists(os.path.join(self.path, f)):
+                            os.remove(os.path.join(self.path, f))
+                    shutil.rmtree(os.path.join(self.path, "home", name), ignore_errors=True)
+                    LOG.info("Keyring '{n}' removed".format(n=name))
+
+            used = set()
+            for f in os.listdir(self.path):
+                if f.endswith(".keys"):
+                    with mini_buildd.misc.open_utf8(os.path.join(self.path, f)) as m:
+                        used |= set(m.read().split())
+            for f in os.listdir(os.path.join(self.path, "keys")):
+                if f[:-len(".gpg")] not in used:
+                    os.remove(os.path.join(self.path, "keys", f))
+                    removed += 1
+        return removed
@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 import os
 import re
 import stat
+import gzip
 import email.utils
 import logging
 
@@ -89,7 +90,7 @@ class StaticWithIndex(cherrypy._cptools.HandlerTool):  # pylint: disable=protect
            cp_version=cherrypy.__version__)
 
     @classmethod
-    def _mbd_serve_index(cls, _section, directory, root="", match="", **_kwargs):
+    def _mbd_get_path(cls, directory, root, match):
         if match and not re.search(match, cherrypy.request.path_info):
             raise cherrypy.HTTPError(403, "Requested path does not match allowed regex.")
 
@@ -99,6 +100,29 @@ class StaticWithIndex(cherrypy._cptools.HandlerTool):  # pylint: disable=protect
         if not path.startswith(os.path.normpath(root)):
             raise cherrypy.HTTPError(403, "Requested path outside root directory.")
 
+        return path
+
+    @classmethod
+    def _mbd_serve_gz(cls, _section, directory, root="", match="", content_types=None, **_kwargs):
+        "Serve FILE as decompressed on the fly from FILE.gz (for gzip-compressed build logs)."
+        path = cls._mbd_get_path(directory, root, match)
+        if os.path.exists(path) or not os.path.exists(path + ".gz"):
+            return False
+
+        path_stat = os.stat(path + ".gz")
+        cherrypy.response.headers["Last-Modified"] = cherrypy.lib.httputil.HTTPDate(path_stat.st_mtime)
+        cherrypy.lib.cptools.validate_since()
+
+        ext = os.path.splitext(path)[1].lstrip(".")
+        cherrypy.response.headers["Content-Type"] = (content_types or {}).get(ext, "application/octet-stream")
+        cherrypy.response.body = cherrypy.lib.file_generator(gzip.open(path + ".gz", "rb"))
+        cherrypy.response.stream = True
+        return True
+
+    @classmethod
+    def _mbd_serve_index(cls, _section, directory, root="", match="", **_kwargs):
+        path = cls._mbd_get_path(directory, root, match)
+
         # Check that the path actually exists
         try:
             path_stat = os.stat(path)
@@ -130,6 +154,8 @@ class StaticWithIndex(cherrypy._cptools.HandlerTool):  # pylint: disable=protect
         "Try cherrypy static serve, fallback to . Try built-in static dir first"
         if cherrypy.lib.static.staticdir(section, directory, **kwargs):
             return True
+        if cls._mbd_serve_gz(section, directory, **kwargs):
+            return True
         return cls._mbd_serve_index(section, directory, **kwargs)
 
     def __init__(self):
@@ -0,0 +1,733 @@
+# -*- coding: utf-8 -*-
+"""
+Native writer for repository indices (Packages, Sources, Release).
+
+This is an alternative to reprepro's own export (see
+repository extra option 'Native-Index'). reprepro is then
+only used as package database (run with '--export=never'),
+and the indices are written here:
+
+ * Index stanzas are cached per pool file (and override values),
+   so only new packages need to be read and hashed.
+ * Index files are only rewritten (and compressed) when their
+   content actually changed; compression runs in parallel.
+ * Release files are only rewritten (and signed) for
+   distributions with changed indices. Indices that don't match
+   the hashes in the current Release (i.e., a previous export
+   failed half-way) count as changed.
+ * Changes of uncompressed indices are additionally published
+   as pdiffs ('Packages.diff/Index'), and all indices are
+   available via 'by-hash/SHA256/' ('Acquire-By-Hash: yes'),
+   so apt clients only need to download what changed.
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import gzip
+import bz2
+import shutil
+import sqlite3
+import hashlib
+import contextlib
+import subprocess
+import distutils.spawn
+import multiprocessing.pool
+import collections
+import logging
+
+import mini_buildd.setup
+import mini_buildd.misc
+import mini_buildd.gnupg
+
+LOG = logging.getLogger(__name__)
+
+# Names of the Release files (not to be listed in Release)
+RELEASE_FILES = ["Release", "InRelease", "Release.gpg"]
+
+# Number of pdiffs to keep per index
+PDIFF_KEEP = 20
+
+# Unreferenced by-hash files are removed after that many seconds (clients may still have an older Release)
+BY_HASH_EXPIRE = 24 * 60 * 60
+
+
+def parse_stanza(text):
+    """
+    Parse one control stanza into a list of (FIELD, VALUE) pairs, keeping order and multi-line values as-is.
+
+    >>> parse_stanza("Package: a\\nFiles:\\n 00 1 a.dsc\\nDescription: x\\n y\\n")
+    [(u'Package', u'a'), (u'Files', u'\\n 00 1 a.dsc'), (u'Description', u'x\\n y')]
+    """
+    result = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        elif line[0] in " \t" and result:
+            result[-1] = (result[-1][0], "{v}\n{l}".format(v=result[-1][1], l=line))
+        else:
+            key, _sep, value = line.partition(":")
+            result.append((key, value.strip()))
+    return result
+
+
+def format_stanza(fields):
+    """
+    Format (FIELD, VALUE) pairs as control stanza (see parse_stanza()).
+
+    >>> format_stanza([("Package", "a"), ("Files", "\\n 00 1 a.dsc")])
+    u'Package: a\\nFiles:\\n 00 1 a.dsc\\n'
+    """
+    return "".join(["{k}:{s}{v}\n".format(k=k, s="" if v.startswith("\n") else " ", v=v) for k, v in fields])
+
+
+def strip_signature(text):
+    """
+    Get the payload of an (optionally) OpenPGP clearsigned text.
+
+    >>> strip_signature("-----BEGIN PGP SIGNED MESSAGE-----\\nHash: SHA256\\n\\nSource: a\\n- -dashed\\n\\n-----BEGIN PGP SIGNATURE-----\\nxyz\\n-----END PGP SIGNATURE-----\\n")
+    u'Source: a\\n-dashed\\n'
+    >>> strip_signature("Source: a\\n")
+    u'Source: a\\n'
+    """
+    lines = text.splitlines()
+    if not lines or lines[0] != "-----BEGIN PGP SIGNED MESSAGE-----":
+        return text
+
+    payload = []
+    # Skip armor headers (up to the first empty line)
+    for line in lines[lines.index("") + 1:]:
+        if line == "-----BEGIN PGP SIGNATURE-----":
+            break
+        payload.append(line[2:] if line.startswith("- ") else line)
+    return "\n".join(payload).strip("\n") + "\n"
+
+
+def get_hashes(path):
+    """
+    Get size, md5, sha1 and sha256 of a file in one pass (see mini_buildd.misc.get_file_digests()).
+    """
+    digests = mini_buildd.misc.get_file_digests(path)
+    return [digests["size"], digests["md5"], digests["sha1"], digests["sha256"]]
+
+
+def _compress_gz(src, dst):
+    with open(src, "rb") as i, open(dst, "wb") as raw, contextlib.closing(gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=raw, mtime=0)) as o:
+        shutil.copyfileobj(i, o, 1024 * 1024)
+
+
+def _compress_bz2(src, dst):
+    with open(src, "rb") as i, contextlib.closing(bz2.BZ2File(dst, "wb", compresslevel=9)) as o:
+        shutil.copyfileobj(i, o, 1024 * 1024)
+
+
+def _compress_xz(src, dst):
+    with open(src, "rb") as i, open(dst, "wb") as o:
+        subprocess.check_call(["xz", "--stdout", "-6"], stdin=i, stdout=o)
+
+
+def get_compressions():
+    "Get list of (EXTENSION, FUNCTION) of available compressions."
+    return [(".gz", _compress_gz), (".bz2", _compress_bz2)] + ([(".xz", _compress_xz)] if distutils.spawn.find_executable("xz") else [])
+
+
+def write_index(path, content):
+    """
+    Write index file atomically, only if its content changed. Returns True if written.
+
+    >>> d = mini_buildd.misc.TmpDir()
+    >>> p = os.path.join(d.tmpdir, "Packages")
+    >>> write_index(p, "Package: a\\n"), write_index(p, "Package: a\\n"), write_index(p, "Package: b\\n")
+    (True, False, True)
+    >>> d.close()
+    """
+    data = content.encode(mini_buildd.setup.CHAR_ENCODING)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+
+    mini_buildd.misc.mkdirs(os.path.dirname(path))
+    with open(path + ".new", "wb") as f:
+        f.write(data)
+    os.rename(path + ".new", path)
+    return True
+
+
+def compress(path, compressions=None):
+    """
+    Write all compressed variants of an index file.
+
+    >>> d = mini_buildd.misc.TmpDir()
+    >>> p = os.path.join(d.tmpdir, "Packages")
+    >>> write_index(p, "Package: a\\n")
+    True
+    >>> compress(p, [(".gz", _compress_gz), (".bz2", _compress_bz2)])
+    >>> gzip.open(p + ".gz").read(), bz2.BZ2File(p + ".bz2").read()
+    ('Package: a\\n', 'Package: a\\n')
+    >>> d.close()
+    """
+    for ext, func in get_compressions() if compressions is None else compressions:
+        func(path, path + ext + ".new")
+        os.rename(path + ext + ".new", path + ext)
+
+
+def release_text(fields, files):
+    """
+    Get text of a Release file from (FIELD, VALUE) pairs, and the index files as dict {PATH: [SIZE, MD5, SHA1, SHA256]}.
+
+    >>> print(release_text([("Codename", "sid-test-unstable")], {"main/source/Sources": [2, "m", "s1", "s256"]}).strip())
+    Codename: sid-test-unstable
+    MD5Sum:
+     m 2 main/source/Sources
+    SHA1:
+     s1 2 main/source/Sources
+    SHA256:
+     s256 2 main/source/Sources
+    """
+    hashes = []
+    for n, name in enumerate(["MD5Sum", "SHA1", "SHA256"], 1):
+        hashes.append((name, "".join(["\n {h} {s} {p}".format(h=files[p][n], s=files[p][0], p=p) for p in sorted(files)])))
+    return format_stanza(list(fields) + hashes)
+
+
+def parse_release_hashes(text):
+    """
+    Get the files listed in a Release as dict {PATH: SHA256}.
+
+    >>> parse_release_hashes(release_text([("Codename", "sid-test-unstable")], {"main/source/Sources": [2, "m", "s1", "s256"]}))
+    {u'main/source/Sources': u's256'}
+    """
+    return dict((p, h) for h, _s, p in [l.split() for l in dict(parse_stanza(text)).get("SHA256", "").splitlines() if l.strip()])
+
+
+def _get_data_hashes(data):
+    return len(data), hashlib.sha1(data).hexdigest(), hashlib.sha256(data).hexdigest()
+
+
+def parse_pdiff_index(text):
+    """
+    Parse a pdiff 'Index' file. Returns current (SIZE, SHA1, SHA256), and the patches as list of dicts (oldest first).
+
+    >>> current, patches = parse_pdiff_index(pdiff_index_text((2, "c1", "c256"), [{"name": "p0", "old": (1, "o1", "o256"), "patch": (3, "p1", "p256"), "download": (4, "d1", "d256")}]))
+    >>> current
+    (2, u'c1', u'c256')
+    >>> patches[0]["name"], patches[0]["old"], patches[0]["patch"], patches[0]["download"]
+    (u'p0', (1, u'o1', u'o256'), (3, u'p1', u'p256'), (4, u'd1', u'd256'))
+    """
+    fields = dict(parse_stanza(text))
+    sha1, size = fields.get("SHA1-Current", " ").split(" ", 1)
+    current = (int(size) if size else 0, sha1, fields.get("SHA256-Current", " ").split(" ")[0])
+
+    patches = collections.OrderedDict()
+    for key, part in [("History", "old"), ("Patches", "patch"), ("Download", "download")]:
+        for i, algo in enumerate(["SHA1", "SHA256"], 1):
+            for line in fields.get("{a}-{k}".format(a=algo, k=key), "").splitlines():
+                if line.strip():
+                    h, size, name = line.split()
+                    patch = patches.setdefault(name[:-len(".gz")] if key == "Download" else name, {})
+                    value = patch.setdefault(part, [int(size), "", ""])
+                    value[i] = h
+
+    result = []
+    for name, patch in patches.items():
+        patch["name"] = name
+        for part in ["old", "patch", "download"]:
+            patch[part] = tuple(patch.get(part, [0, "", ""]))
+        result.append(patch)
+    return current, result
+
+
+def pdiff_index_text(current, patches):
+    """
+    Get text of a pdiff 'Index' file (see parse_pdiff_index()).
+    """
+    fields = [("SHA1-Current", "{h} {s}".format(h=current[1], s=current[0])),
+              ("SHA256-Current", "{h} {s}".format(h=current[2], s=current[0]))]
+    for key, part, suffix in [("History", "old", ""), ("Patches", "patch", ""), ("Download", "download", ".gz")]:
+        for i, algo in enumerate(["SHA1", "SHA256"], 1):
+            fields.append(("{a}-{k}".format(a=algo, k=key),
+                           "".join(["\n {h} {s} {n}{x}".format(h=p[part][i], s=p[part][0], n=p["name"], x=suffix) for p in patches])))
+    return format_stanza(fields)
+
+
+def update_pdiffs(path, old, keep=PDIFF_KEEP, name=None):
+    """
+    Add a pdiff (ed script) from old content 'old' to the current content of index 'path' to 'path.diff/'.
+
+    History is reset if the 'Index' does not match the old content (for example, when it was written by another tool).
+
+    >>> d = mini_buildd.misc.TmpDir()
+    >>> p = os.path.join(d.tmpdir, "Packages")
+    >>> write_index(p, "Package: a\\n")
+    True
+    >>> for n, c in enumerate(["Package: a\\n\\nPackage: b\\n", "Package: b\\n", "Package: c\\n"]):
+    ...     old = open(p, "rb").read()
+    ...     _w = write_index(p, c)
+    ...     update_pdiffs(p, old, keep=2, name="p{n}".format(n=n))
+    >>> sorted(os.listdir(p + ".diff"))
+    [u'Index', u'p1.gz', u'p2.gz']
+    >>> print(gzip.open(os.path.join(p + ".diff", "p1.gz")).read().strip())
+    1,2d
+    >>> current, patches = parse_pdiff_index(open(os.path.join(p + ".diff", "Index")).read())
+    >>> current == _get_data_hashes(open(p, "rb").read()), [p["name"] for p in patches]
+    (True, [u'p1', u'p2'])
+    >>> d.close()
+    """
+    diff_dir = path + ".diff"
+    index = os.path.join(diff_dir, "Index")
+    mini_buildd.misc.mkdirs(diff_dir)
+
+    patches = []
+    if os.path.exists(index):
+        current, patches = parse_pdiff_index(open(index).read().decode(mini_buildd.setup.CHAR_ENCODING))
+        if current != _get_data_hashes(old):
+            LOG.info("Resetting pdiff history (does not match old index): {i}".format(i=index))
+            patches = []
+
+    # Make ed script
+    with open(path + ".old", "wb") as f:
+        f.write(old)
+    try:
+        diff = subprocess.Popen(["diff", "--ed", path + ".old", path], stdout=subprocess.PIPE)
+        script = diff.communicate()[0]
+        if diff.returncode not in [0, 1]:
+            raise Exception("diff failed with {r}: {p}".format(r=diff.returncode, p=path))
+    finally:
+        os.remove(path + ".old")
+
+    if name is None:
+        name = time.strftime("%Y-%m-%d-%H%M.%S", time.gmtime())
+        while os.path.exists(os.path.join(diff_dir, name + ".gz")):
+            name += "x"
+    patch_file = os.path.join(diff_dir, name + ".gz")
+    with open(patch_file, "wb") as raw, contextlib.closing(gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=raw, mtime=0)) as o:
+        o.write(script)
+    patches.append({"name": name,
+                    "old": _get_data_hashes(old),
+                    "patch": _get_data_hashes(script),
+                    "download": _get_data_hashes(open(patch_file, "rb").read())})
+    patches = patches[-keep:]
+
+    # Remove obsolete patches (including such from an unknown history)
+    names = ["{n}.gz".format(n=p["name"]) for p in patches]
+    for f in os.listdir(diff_dir):
+        if f != "Index" and f not in names and os.path.isfile(os.path.join(diff_dir, f)):
+            os.remove(os.path.join(diff_dir, f))
+
+    with open(index + ".new", "wb") as f:
+        f.write(pdiff_index_text(_get_data_hashes(open(path, "rb").read()), patches).encode(mini_buildd.setup.CHAR_ENCODING))
+    os.rename(index + ".new", index)
+
+
+def update_by_hash(dist_dir, files, expire=BY_HASH_EXPIRE):
+    """
+    Make index files available as 'DIR/by-hash/SHA256/HASH' (hardlinks), and remove expired unreferenced ones.
+
+    'files' is a dict like for release_text().
+
+    >>> d = mini_buildd.misc.TmpDir()
+    >>> p = os.path.join(d.tmpdir, "main", "source", "Sources")
+    >>> write_index(p, "Source: a\\n")
+    True
+    >>> update_by_hash(d.tmpdir, {"main/source/Sources": get_hashes(p)})
+    >>> os.listdir(os.path.join(d.tmpdir, "main", "source", "by-hash", "SHA256"))
+    [u'9088000e0d72a91504fa949ff4f3da847d7e42fa98345f9c8f003ef6ead0964f']
+    >>> update_by_hash(d.tmpdir, {}, expire=-1)
+    >>> os.listdir(os.path.join(d.tmpdir, "main", "source", "by-hash", "SHA256"))
+    []
+    >>> d.close()
+    """
+    referenced = set()
+    for rel_path, hashes in files.items():
+        by_hash = os.path.join(dist_dir, os.path.dirname(rel_path), "by-hash", "SHA256")
+        target = os.path.join(by_hash, hashes[3])
+        referenced.add(target)
+        if not os.path.exists(target):
+            mini_buildd.misc.mkdirs(by_hash)
+            mini_buildd.misc.link_or_copy(os.path.join(dist_dir, rel_path), target)
+
+    # Unreferenced files: ctime is the time the last other hardlink was removed (i.e., when it became obsolete)
+    now = time.time()
+    for root, _dirs, names in os.walk(dist_dir):
+        if os.path.basename(root) == "SHA256" and os.path.basename(os.path.dirname(root)) == "by-hash":
+            for name in names:
+                path = os.path.join(root, name)
+                if path not in referenced and now - os.stat(path).st_ctime > expire:
+                    os.remove(path)
+
+
+class StanzaCache(object):
+    """
+    Persistent cache of index stanzas, by pool file (relative path) and override values (section, priority), validated by size and mtime.
+
+    >>> t = mini_buildd.misc.TmpDir()
+    >>> pool_file = os.path.join(t.tmpdir, "pool_file")
+    >>> open(pool_file, "wb").close()
+    >>> cache = StanzaCache(os.path.join(t.tmpdir, "cache.sqlite"))
+    >>> with cache.session() as db:
+    ...     cache.get(db, "pool_file", pool_file, ("devel", "optional"), lambda: "Section: devel")
+    ...     cache.get(db, "pool_file", pool_file, ("devel", "optional"), lambda: "Never made")
+    ...     cache.get(db, "pool_file", pool_file, ("utils", "optional"), lambda: "Section: utils")
+    u'Section: devel'
+    u'Section: devel'
+    u'Section: utils'
+    >>> t.close()
+    """
+    def __init__(self, path):
+        self._path = path
+        with self.session() as db:
+            # Table 'stanzas' is the old layout without overrides
+            db.execute("DROP TABLE IF EXISTS stanzas")
+            db.execute("CREATE TABLE IF NOT EXISTS override_stanzas "
+                       "(filename TEXT, override TEXT, size INTEGER, mtime REAL, stanza TEXT, PRIMARY KEY (filename, override))")
+        self._used = set()
+
+    @contextlib.contextmanager
+    def session(self):
+        db = sqlite3.connect(self._path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, db, filename, path, overrides, make):
+        st = os.stat(path)
+        override = "|".join(overrides)
+        self._used.add((filename, override))
+        row = db.execute("SELECT stanza FROM override_stanzas WHERE filename=? AND override=? AND size=? AND mtime=?",
+                         (filename, override, st.st_size, st.st_mtime)).fetchone()
+        if row:
+            return row[0]
+        stanza = make()
+        db.execute("INSERT OR REPLACE INTO override_stanzas VALUES (?, ?, ?, ?, ?)", (filename, override, st.st_size, st.st_mtime, stanza))
+        return stanza
+
+    def prune(self):
+        "Remove all entries not used in this cache's lifetime."
+        with self.session() as db:
+            for filename, override in db.execute("SELECT filename, override FROM override_stanzas").fetchall():
+                if (filename, override) not in self._used:
+                    db.execute("DELETE FROM override_stanzas WHERE filename=? AND override=?", (filename, override))
+
+
+class Indexer(object):
+    """
+    Write indices of a reprepro repository (see module doc).
+    """
+    _LIST_FORMAT = "${$type}|${$component}|${$architecture}|${package}|${version}|${$fullfilename}|${Section}|${Priority}\n"
+
+    def __init__(self, basedir):
+        self._basedir = basedir
+        self._cache = StanzaCache(os.path.join(basedir, "db", "mini-buildd-stanzas.sqlite"))
+
+    def _read_conf(self):
+        "Get dict {CODENAME: {FIELD: VALUE}} from reprepro's distributions config."
+        with open(os.path.join(self._basedir, "conf", "distributions"), "rb") as f:
+            text = f.read().decode(mini_buildd.setup.CHAR_ENCODING)
+        return dict((c["Codename"], c) for c in [dict(parse_stanza(p)) for p in text.split("\n\n")] if "Codename" in c)
+
+    def _get_gnupg(self):
+        "Get GnuPG for signing (as configured for reprepro)."
+        options = os.path.join(self._basedir, "conf", "options")
+        if os.path.exists(options):
+            with open(options, "rb") as f:
+                for line in f.read().decode(mini_buildd.setup.CHAR_ENCODING).splitlines():
+                    key, _sep, value = line.partition(" ")
+                    if key == "gnupghome":
+                        return mini_buildd.gnupg.BaseGnuPG(value.strip())
+        return mini_buildd.gnupg.BaseGnuPG(os.path.join(mini_buildd.setup.HOME_DIR, ".gnupg"))
+
+    def _list(self, distribution):
+        return mini_buildd.misc.call(["reprepro", "--waitforlock=10", "--basedir={b}".format(b=self._basedir),
+                                      "--list-format={f}".format(f=self._LIST_FORMAT),
+                                      "list", distribution],
+                                     log_output=False).splitlines()
+
+    @classmethod
+    def _deb_stanza(cls, path, filename, section, priority):
+        control = parse_stanza(mini_buildd.misc.call(["dpkg-deb", "--field", path], log_output=False))
+        control_dict = dict(control)
+        size, md5, sha1, sha256 = get_hashes(path)
+        return format_stanza([(k, v) for k, v in control if k not in ["Section", "Priority", "Description"]] +
+                             [("Priority", priority or control_dict.get("Priority", "optional")),
+                              ("Section", section or control_dict.get("Section", "misc")),
+                              ("Filename", filename),
+                              ("Size", "{s}".format(s=size)),
+                              ("MD5sum", md5),
+                              ("SHA1", sha1),
+                              ("SHA256", sha256)] +
+                             ([("Description", control_dict["Description"])] if "Description" in control_dict else []))
+
+    @classmethod
+    def _dsc_stanza(cls, path, filename, section, priority):
+        with open(path, "rb") as f:
+            dsc = parse_stanza(strip_signature(f.read().decode(mini_buildd.setup.CHAR_ENCODING)))
+        dsc_dict = dict(dsc)
+        size, md5, sha1, sha256 = get_hashes(path)
+        name = os.path.basename(filename)
+        return format_stanza([("Package", dsc_dict["Source"])] +
+                             [(k, v) for k, v in dsc if k not in ["Source", "Files", "Checksums-Sha1", "Checksums-Sha256"]] +
+                             [("Directory", os.path.dirname(filename)),
+                              ("Files", "\n {h} {s} {n}{o}".format(h=md5, s=size, n=name, o=dsc_dict.get("Files", ""))),
+                              ("Checksums-Sha1", "\n {h} {s} {n}{o}".format(h=sha1, s=size, n=name, o=dsc_dict.get("Checksums-Sha1", ""))),
+                              ("Checksums-Sha256", "\n {h} {s} {n}{o}".format(h=sha256, s=size, n=name, o=dsc_dict.get("Checksums-Sha256", ""))),
+                              ("Priority", priority or "source"),
+                              ("Section", section or "misc")])
+
+    @classmethod
+    def _targets(cls, conf):
+        """
+        Get all index files of a distribution as dict {(TYPE, COMPONENT, ARCH): PATH}, PATH relative to the dist dir.
+        """
+        archs = conf.get("Architectures", "").split()
+        result = {}
+        for c in conf.get("Components", "").split():
+            if "source" in archs:
+                result[("dsc", c, "source")] = os.path.join(c, "source", "Sources")
+            for a in [a for a in archs if a != "source"]:
+                result[("deb", c, a)] = os.path.join(c, "binary-{a}".format(a=a), "Packages")
+        for c in conf.get("UDebComponents", "").split():
+            for a in [a for a in archs if a != "source"]:
+                result[("udeb", c, a)] = os.path.join(c, "debian-installer", "binary-{a}".format(a=a), "Packages")
+        return result
+
+    def _write_distribution(self, db, distribution, conf):
+        """
+        Write all indices of one distribution.
+
+        Returns list of (absolute) paths of changed indices (to
+        be compressed), and whether Release needs to be rewritten.
+        """
+        dist_dir = os.path.join(self._basedir, "dists", distribution)
+        release = os.path.join(dist_dir, "Release")
+        released = {}
+        if os.path.exists(release):
+            with mini_buildd.misc.open_utf8(release) as f:
+                released = parse_release_hashes(f.read())
+        targets = self._targets(conf)
+        stanzas = dict((k, []) for k in targets)
+
+        for item in self._list(distribution):
+            typ, component, architecture, package, version, path, section, priority = item.split("|")
+            key = (typ, component, architecture)
+            if key in stanzas:
+                filename = os.path.relpath(path, self._basedir)
+                make = self._dsc_stanza if typ == "dsc" else self._deb_stanza
+                stanzas[key].append((package, version, self._cache.get(db, filename, path, (section, priority), lambda: make(path, filename, section, priority))))
+
+        def stale(path):
+            "Whether index differs from what's in Release (a previous export did not finish)."
+            return released.get(os.path.relpath(path, dist_dir)) != get_hashes(path)[3]
+
+        changed, release_needed = [], False
+        for key, path in targets.items():
+            abs_path = os.path.join(dist_dir, path)
+            old = open(abs_path, "rb").read() if os.path.exists(abs_path) else None
+            if write_index(abs_path, "\n".join([s for _p, _v, s in sorted(stanzas[key])])):
+                if old is not None:
+                    update_pdiffs(abs_path, old)
+                changed.append(abs_path)
+            elif not os.path.exists(abs_path + ".gz") or stale(abs_path):
+                changed.append(abs_path)
+
+            # Per-index Release file (like reprepro's 'Release' in DebIndices/DscIndices)
+            if key[0] != "udeb":
+                index_release = os.path.join(os.path.dirname(abs_path), "Release")
+                if write_index(index_release,
+                               format_stanza([("Archive", conf.get("Suite", distribution)),
+                                              ("Origin", conf.get("Origin", "")),
+                                              ("Label", conf.get("Label", "")),
+                                              ("Component", key[1]),
+                                              ("Architecture", key[2])])) or stale(index_release):
+                    release_needed = True
+        return changed, release_needed or bool(changed)
+
+    def _write_release(self, distribution, conf):
+        dist_dir = os.path.join(self._basedir, "dists", distribution)
+        files = {}
+        for root, _dirs, names in os.walk(dist_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, dist_dir)
+                # pdiffs are only listed via their Index, by-hash files not at all
+                if rel_path not in RELEASE_FILES and not name.endswith(".new") and \
+                   "by-hash" not in rel_path.split(os.sep) and \
+                   not (root.endswith(".diff") and name != "Index"):
+                    files[rel_path] = get_hashes(path)
+        update_by_hash(dist_dir, files)
+
+        fields = [("Origin", conf.get("Origin", "")),
+                  ("Label", conf.get("Label", "")),
+                  ("Suite", conf.get("Suite", distribution)),
+                  ("Codename", distribution),
+                  ("Date", time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime())),
+                  ("Architectures", " ".join([a for a in conf.get("Architectures", "").split() if a != "source"])),
+                  ("Components", conf.get("Components", "")),
+                  ("Description", conf.get("Description", "")),
+                  ("Acquire-By-Hash", "yes")]
+        for flag in ["NotAutomatic", "ButAutomaticUpgrades"]:
+            if conf.get(flag) == "yes":
+                fields.append((flag, "yes"))
+
+        # Sign in memory (if configured, like reprepro's 'SignWith'), then write all files
+        # Release goes last: Its hashes mark the export as complete (see _write_distribution())
+        release = release_text(fields, files).encode(mini_buildd.setup.CHAR_ENCODING)
+        signed = []
+        sign_with = conf.get("SignWith")
+        if sign_with:
+            gnupg = self._get_gnupg()
+            identity = None if sign_with in ["default", "yes"] else sign_with
+            signed = [("Release.gpg", gnupg.sign_data(release, identity=identity, detach=True)),
+                      ("InRelease", gnupg.sign_data(release, identity=identity))]
+        for name, data in signed + [("Release", release)]:
+            path = os.path.join(dist_dir, name)
+            with open(path + ".new", "wb") as f:
+                f.write(data)
+            os.rename(path + ".new", path)
+
+    def export(self, distributions, prune=False):
+        """
+        Export distributions. Returns export times per distribution as dict: {DIST: SECONDS}.
+        """
+        confs = self._read_conf()
+        timings = collections.OrderedDict()
+        changed = collections.OrderedDict()
+        release_needed = {}
+
+        # Write indices (stanzas of new packages read in one db transaction)
+        with self._cache.session() as db:
+            for d in distributions:
+                start = time.time()
+                changed[d], release_needed[d] = self._write_distribution(db, d, confs[d])
+                timings[d] = time.time() - start
+
+        # Compress all changed indices in parallel
+        indices = [i for c in changed.values() for i in c]
+        if indices:
+            start = time.time()
+            pool = multiprocessing.pool.ThreadPool(min(mini_buildd.misc.get_cpus(), len(indices)))
+            try:
+                pool.map(compress, indices)
+            finally:
+                pool.close()
+                pool.join()
+            LOG.debug("Indexer: {n} indices compressed in {s}s".format(n=len(indices), s=round(time.time() - start, 1)))
+
+        # Write and sign Release of changed distributions
+        for d, c in changed.items():
+            if release_needed[d] or not os.path.exists(os.path.join(self._basedir, "dists", d, "InRelease" if confs[d].get("SignWith") else "Release")):
+                start = time.time()
+                self._write_release(d, confs[d])
+                timings[d] += time.time() - start
+            LOG.info("Indexer: {d}: {n} indices changed".format(d=d, n=len(c)))
+
+        if prune:
+            self._cache.prune()
+
+        return collections.OrderedDict((d, round(s, 1)) for d, s in timings.items())
+
+
+def _parse_index(path):
+    "Parse index file into dict {PACKAGE: {FIELD: VALUE}}."
+    with open(path, "rb") as f:
+        stanzas = [dict(parse_stanza(p)) for p in f.read().decode(mini_buildd.setup.CHAR_ENCODING).split("\n\n") if p.strip()]
+    return dict((s["Package"], s) for s in stanzas)
+
+
+def compare_with_reprepro():
+    """
+    Export a small test repository with both reprepro and the native indexer. Returns list of differences.
+
+    Skipped (empty list) if reprepro or dpkg-deb are not installed.
+
+    >>> compare_with_reprepro()
+    []
+    """
+    if not (distutils.spawn.find_executable("reprepro") and distutils.spawn.find_executable("dpkg-deb")):
+        LOG.info("Skipping reprepro comparison: reprepro or dpkg-deb not installed")
+        return []
+
+    with contextlib.closing(mini_buildd.misc.TmpDir()) as t:
+        basedir = os.path.join(t.tmpdir, "repo")
+        dist = "sid-test-unstable"
+        mini_buildd.misc.mkdirs(os.path.join(basedir, "conf"))
+        with mini_buildd.misc.open_utf8(os.path.join(basedir, "conf", "distributions"), "w") as f:
+            f.write(format_stanza([("Codename", dist),
+                                   ("Suite", dist),
+                                   ("Label", dist),
+                                   ("Origin", "mini-buildd"),
+                                   ("Components", "main"),
+                                   ("Architectures", "source amd64"),
+                                   ("Description", "Test")]))
+
+        # Binary package
+        pkg_dir = os.path.join(t.tmpdir, "pkg")
+        mini_buildd.misc.mkdirs(os.path.join(pkg_dir, "DEBIAN"))
+        with mini_buildd.misc.open_utf8(os.path.join(pkg_dir, "DEBIAN", "control"), "w") as f:
+            f.write(format_stanza([("Package", "mbd-test"),
+                                   ("Version", "1.0"),
+                                   ("Architecture", "amd64"),
+                                   ("Maintainer", "mini-buildd <mini-buildd@localhost>"),
+                                   ("Section", "devel"),
+                                   ("Priority", "optional"),
+                                   ("Description", "mini-buildd test package\n Long description.")]))
+        deb = os.path.join(t.tmpdir, "mbd-test_1.0_amd64.deb")
+        mini_buildd.misc.call(["dpkg-deb", "--build", pkg_dir, deb])
+
+        # Source package (native, built by hand)
+        tar = os.path.join(t.tmpdir, "mbd-test_1.0.tar.gz")
+        mini_buildd.misc.call(["tar", "--create", "--gzip", "--file", tar, "--directory", t.tmpdir, "pkg"])
+        size, md5, sha1, sha256 = get_hashes(tar)
+        name = os.path.basename(tar)
+        dsc = os.path.join(t.tmpdir, "mbd-test_1.0.dsc")
+        with mini_buildd.misc.open_utf8(dsc, "w") as f:
+            f.write(format_stanza([("Format", "3.0 (native)"),
+                                   ("Source", "mbd-test"),
+                                   ("Binary", "mbd-test"),
+                                   ("Architecture", "any"),
+                                   ("Version", "1.0"),
+                                   ("Maintainer", "mini-buildd <mini-buildd@localhost>"),
+                                   ("Standards-Version", "3.9.8"),
+                                   ("Checksums-Sha1", "\n {h} {s} {n}".format(h=sha1, s=size, n=name)),
+                                   ("Checksums-Sha256", "\n {h} {s} {n}".format(h=sha256, s=size, n=name)),
+                                   ("Files", "\n {h} {s} {n}".format(h=md5, s=size, n=name))]))
+
+        reprepro = ["reprepro", "--basedir={b}".format(b=basedir)]
+        mini_buildd.misc.call(reprepro + ["includedeb", dist, deb])
+        mini_buildd.misc.call(reprepro + ["--section=devel", "--priority=optional", "includedsc", dist, dsc])
+
+        # Export with reprepro, move away, and export natively
+        mini_buildd.misc.call(reprepro + ["export", dist])
+        reprepro_dir = os.path.join(t.tmpdir, "reprepro")
+        os.rename(os.path.join(basedir, "dists", dist), reprepro_dir)
+        Indexer(basedir).export([dist])
+        native_dir = os.path.join(basedir, "dists", dist)
+
+        result = []
+        for index in ["main/binary-amd64/Packages", "main/source/Sources"]:
+            expected, got = _parse_index(os.path.join(reprepro_dir, index)), _parse_index(os.path.join(native_dir, index))
+            for package in sorted(set(expected) | set(got)):
+                for field in sorted(set(expected.get(package, {})) | set(got.get(package, {}))):
+                    e, g = expected.get(package, {}).get(field), got.get(package, {}).get(field)
+                    if e != g:
+                        result.append("{i}: {p}: {f}: reprepro={e!r} native={g!r}".format(i=index, p=package, f=field, e=e, g=g))
+
+        # Release: Compare all fields but the date, our extensions, and the file lists (we add more compressions)...
+        releases = []
+        for d in [reprepro_dir, native_dir]:
+            with open(os.path.join(d, "Release"), "rb") as f:
+                releases.append(f.read().decode(mini_buildd.setup.CHAR_ENCODING))
+        expected, got = [dict(parse_stanza(r)) for r in releases]
+        for field in sorted(set(expected) | set(got)):
+            if field not in ["Date", "Acquire-By-Hash", "MD5Sum", "SHA1", "SHA256"] and expected.get(field) != got.get(field):
+                result.append("Release: {f}: reprepro={e!r} native={g!r}".format(f=field, e=expected.get(field), g=got.get(field)))
+
+        # ...but all uncompressed files listed by reprepro must be listed with the same hash
+        expected, got = [parse_release_hashes(r) for r in releases]
+        for path in sorted([p for p in expected if os.path.splitext(p)[1] not in [".gz", ".bz2", ".xz"]]):
+            if expected[path] != got.get(path):
+                result.append("Release: {p}: reprepro={e} native={g}".format(p=path, e=expected[path], g=got.get(path)))
+
+        return result
@@ -6,12 +6,18 @@ import copy
 import datetime
 import shutil
 import codecs
-import glob
+import contextlib
+import time
+import sqlite3
+import gzip
 import errno
 import subprocess
 import threading
+import itertools
+import collections
+import heapq
+import math
 import socket
-import Queue
 import multiprocessing
 import tempfile
 import hashlib
@@ -25,6 +31,7 @@ import logging
 import logging.handlers
 
 import debian.debian_support
+import debian.deb822
 
 # Workaround: Avoid warning 'No handlers could be found for logger "keyring"'
 KEYRING_LOG = logging.getLogger("keyring")
@@ -163,41 +170,327 @@ class ConfFile(object):
         open_utf8(self._file_path, "w").write(self._content)
 
 
-class BlockQueue(Queue.Queue):
+class QueueDiscipline(object):
     """
-    Wrapper around Queue to get put() block until <= maxsize tasks are actually done.
-    In Queue.Queue, task_done() is only used together with join().
+    Queue discipline: Highest priority first, then first come first served.
 
-    This way can use the Queue directly to limit the number of
-    actually worked-on items for incoming and builds.
+    With aging, jobs gain one priority point for every 'aging'
+    seconds they have been waiting, preventing starvation.
     """
-    def __init__(self, maxsize):
-        self._maxsize = maxsize
-        self._pending = 0
-        self._active = Queue.Queue(maxsize=maxsize)
-        Queue.Queue.__init__(self, maxsize=maxsize)
+    NAME = "fifo"
+
+    def __init__(self, aging=0):
+        self.aging = aging
+
+    def __unicode__(self):
+        return "{n} (aging {a})".format(n=self.NAME, a=self.aging)
+
+    def score(self, job, now):
+        return job.priority + (timedelta_total_seconds(now - job.queued) / self.aging if self.aging else 0)
+
+    def key(self, job, now):
+        "Sort key: The job with the smallest key is selected next."
+        return (-self.score(job, now), job.seq)
+
+    def started(self, job, now):
+        "Called when a job is handed out to a worker."
+        pass
+
+    def order(self, jobs, now):
+        "Order in which jobs would be selected."
+        return sorted(jobs, key=lambda j: self.key(j, now))
+
+
+class FairShareDiscipline(QueueDiscipline):
+    """
+    Fair share queue discipline: Jobs are penalized by the recent usage of their owners.
+
+    Each started job adds one to the usage of all of its owners
+    (like repository and uploader), decaying by half every
+    'half_life' seconds.
+
+    >>> d = FairShareDiscipline(half_life=3600)
+    >>> q = JobQueue(workers=1, discipline=d)
+    >>> for n in range(3):
+    ...     j = q.put("big{n}".format(n=n), owners=["team:big"])
+    >>> j = q.put("small", owners=["team:small"])
+    >>> [j.item for j in q.pending()] == ["big0", "small", "big1", "big2"]
+    True
+    """
+    NAME = "fair"
+
+    def __init__(self, aging=0, half_life=3600):
+        super(FairShareDiscipline, self).__init__(aging=aging)
+        self.half_life = half_life
+        self._usage = {}
+
+    def __unicode__(self):
+        return "{n} (aging {a}, half life {h})".format(n=self.NAME, a=self.aging, h=self.half_life)
+
+    @classmethod
+    def _usage_at(cls, usage, owner, now, half_life):
+        value, stamp = usage.get(owner, (0.0, now))
+        return value * 0.5 ** (timedelta_total_seconds(now - stamp) / half_life)
+
+    def _score(self, usage, job, now):
+        return super(FairShareDiscipline, self).score(job, now) - sum([self._usage_at(usage, o, now, self.half_life) for o in job.owners])
+
+    def score(self, job, now):
+        return self._score(self._usage, job, now)
+
+    def _use(self, usage, job, now):
+        for o in job.owners:
+            usage[o] = (self._usage_at(usage, o, now, self.half_life) + 1.0, now)
+
+    def started(self, job, now):
+        self._use(self._usage, job, now)
+
+    def order(self, jobs, now):
+        # Simulate selection, as each selected job changes the scores of the remaining ones
+        usage, jobs, result = dict(self._usage), list(jobs), []
+        while jobs:
+            job = min(jobs, key=lambda j: (-self._score(usage, j, now), j.seq))
+            jobs.remove(job)
+            result.append(job)
+            self._use(usage, job, now)
+        return result
+
+
+class ShortestJobFirstDiscipline(QueueDiscipline):
+    """
+    Shortest job first: Within the same (integer) priority, jobs with the smallest estimated run time come first.
+
+    Jobs without estimate come last. Aging still lifts long
+    waiting (long) jobs to the next priority level, so these
+    can't starve.
+
+    >>> q = JobQueue(workers=1, discipline=ShortestJobFirstDiscipline())
+    >>> for i, e in [("long", 10800), ("unknown", None), ("short", 300)]:
+    ...     j = q.put(i, owners=[], estimate=e)
+    >>> [j.item for j in q.pending()] == ["short", "long", "unknown"]
+    True
+    """
+    NAME = "sjf"
+
+    def key(self, job, now):
+        return (-int(math.floor(self.score(job, now))), float("inf") if job.estimate is None else job.estimate, job.seq)
+
+
+class JobQueue(object):
+    """
+    Job queue to be worked on by a fixed number of workers, with pluggable queue discipline.
+
+    Items already pending or active (compared via key) are not
+    queued twice. Jobs of the same group are never active at the
+    same time. Without explicit priority and owners,
+    'classify(item)' is used to get priority, owners and group
+    for an item.
+
+    >>> q = JobQueue(workers=2)
+    >>> [q.put("a") is not None, q.put("b", priority=10) is not None, q.put("a") is not None]
+    [True, True, False]
+    >>> q.depth
+    2
+    >>> j = q.get()
+    >>> j.item == "b", q.load
+    (True, 1.0)
+    >>> q.task_done(j)
+    >>> q.get().item == "a"
+    True
+    >>> q.shutdown()
+    >>> q.get() is None
+    True
+
+    >>> q = JobQueue(workers=1)
+    >>> j = q.put("a")
+    >>> q.shutdown()
+    >>> q.get().item == "a", q.get() is None
+    (True, True)
+    >>> q = JobQueue(workers=1)
+    >>> j = q.put("a")
+    >>> q.shutdown(drain=False)
+    >>> q.get() is None
+    True
+
+    >>> q = JobQueue(workers=2)
+    >>> for i in ["x1", "x2", "y1"]:
+    ...     j = q.put(i, owners=[], group=i[0])
+    >>> q.get().item == "x1", q.get().item == "y1"
+    (True, True)
+    """
+    class Job(object):
+        def __init__(self, queue, item, priority, key, owners, group, estimate, seq):
+            # Owning queue (call task_done() there: the queue may have been replaced meanwhile)
+            self.queue = queue
+            self.item = item
+            self.priority = priority
+            self.key = key
+            self.owners = owners
+            self.group = group
+            self.estimate = estimate
+            self.seq = seq
+            self.queued = datetime.datetime.now()
+            self.started = None
+            # Set on pending()
+            self.position = None
+            self.eta = None
+
+        def __unicode__(self):
+            return "{k} (priority {p}): position {n}, waiting {w} seconds, estimated start in {e} seconds".format(
+                k=self.key,
+                p=self.priority,
+                n=self.position if self.position else "n/a",
+                w=self.waited,
+                e=self.eta if self.eta is not None else "n/a")
+
+        @property
+        def waited(self):
+            return round(timedelta_total_seconds((self.started or datetime.datetime.now()) - self.queued), 1)
+
+        @property
+        def running(self):
+            return round(timedelta_total_seconds(datetime.datetime.now() - self.started), 1) if self.started else 0.0
+
+    def __init__(self, workers, discipline=None, classify=None):
+        self.workers = workers
+        self.discipline = discipline if discipline else QueueDiscipline()
+        self._classify = classify if classify else lambda item: (0, [], None)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._count = itertools.count()
+        self._active = []
+        self._shutdown = False
+        self._drain = True
+        # Average run time of jobs (exponentially smoothed), used for start time estimates
+        self._runtime = None
 
     def __unicode__(self):
         return "{l}: {n}/{m} ({p} pending)".format(
             l=self.load,
-            n=self._active.qsize(),
-            m=self._maxsize,
-            p=self._pending)
+            n=len(self._active),
+            m=self.workers,
+            p=len(self._pending))
 
     @property
     def load(self):
-        return round(float(self._active.qsize() + self._pending) / self._maxsize, 2)
+        return round(float(len(self._active) + len(self._pending)) / self.workers, 2)
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    @property
+    def runtime(self):
+        "Average run time of jobs in seconds (None if unknown)."
+        return self._runtime
 
-    def put(self, item, **kwargs):
-        self._pending += 1
-        self._active.put(item)
-        Queue.Queue.put(self, item, **kwargs)
-        self._pending -= 1
+    def has_key(self, key):
+        with self._cond:
+            return key in [j.key for j in self._pending + self._active]
 
-    def task_done(self):
-        self._active.get()
-        self._active.task_done()
-        return Queue.Queue.task_done(self)
+    def put(self, item, priority=None, key=None, owners=None, group=None, estimate=None):
+        """
+        Queue item (non-blocking). Returns the new job, or None if an item with the same key is already pending or active.
+        """
+        if priority is None and owners is None:
+            try:
+                priority, owners, group = self._classify(item)
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Can't classify queue item '{i}' (using defaults)".format(i=item), e, logging.WARN)
+        if priority is None:
+            priority = 0
+
+        with self._cond:
+            job = self.Job(self, item, priority, item if key is None else key, owners if owners else [], group, estimate, next(self._count))
+            if self.has_key(job.key):
+                return None
+            self._queued(job)
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def _queued(self, job):
+        "Hook: Called (locked) for a new job, before it is available to workers."
+        pass
+
+    def get(self):
+        """
+        Get next job (blocking), or None on shutdown (when drained, see shutdown()).
+        """
+        with self._cond:
+            while not self._stopped() and not self._eligible():
+                self._cond.wait()
+            if self._stopped():
+                return None
+            now = datetime.datetime.now()
+            job = min(self._eligible(), key=lambda j: self.discipline.key(j, now))
+            self._pending.remove(job)
+            self.discipline.started(job, now)
+            job.started = now
+            self._active.append(job)
+            if self._shutdown:
+                # Other workers may need to stop now
+                self._cond.notify_all()
+            return job
+
+    def _stopped(self):
+        return self._shutdown and not (self._drain and self._pending)
+
+    def _eligible(self):
+        "Pending jobs whose group is not active."
+        active_groups = [j.group for j in self._active if j.group is not None]
+        return [j for j in self._pending if j.group is None or j.group not in active_groups]
+
+    def task_done(self, job):
+        with self._cond:
+            self._active.remove(job)
+            self._cond.notify_all()
+            self._runtime = job.running if self._runtime is None else round(0.7 * self._runtime + 0.3 * job.running, 1)
+
+    def shutdown(self, drain=True):
+        """
+        Shutdown queue: With 'drain', workers still get all pending jobs first; else, pending jobs are dropped.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._drain = drain
+            self._cond.notify_all()
+
+    def wait_shutdown(self):
+        with self._cond:
+            while not self._shutdown:
+                self._cond.wait()
+
+    def estimate(self, job):
+        "Estimated run time of a job in seconds (None if unknown)."
+        return self._runtime if job.estimate is None else job.estimate
+
+    def pending(self):
+        """
+        Pending jobs in selection order, with position and estimated start time (seconds from now) set.
+        """
+        with self._cond:
+            jobs = self.discipline.order(self._pending, datetime.datetime.now())
+
+            # Simulate workers getting free; unknown estimates make all later start times unknown
+            unknown = float("inf")
+            free = [0.0] * max(0, self.workers - len(self._active))
+            for a in self._active:
+                estimate = self.estimate(a)
+                free.append(unknown if estimate is None else max(0.0, estimate - a.running))
+            heapq.heapify(free)
+
+            for n, j in enumerate(jobs):
+                j.position = n + 1
+                start = heapq.heappop(free) if free else unknown
+                j.eta = None if start == unknown else round(start, 1)
+                estimate = self.estimate(j)
+                heapq.heappush(free, unknown if estimate is None else start + estimate)
+            return jobs
+
+    def active(self):
+        with self._cond:
+            return list(self._active)
 
 
 class HoPo(object):
@@ -389,7 +682,160 @@ def pkg_fmt(status, distribution, package, version, extra=None, message=None):
     return fmt
 
 
+class PkgLogIndex(object):
+    """
+    Index (sqlite3) of all package logs: One row per package log dir (LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/).
+
+    Paths of build log and changes are relative to LOG_DIR;
+    'status' is the Sbuild-Status of the build result, and
+    'stamp' the time of archiving.
+
+    >>> import tempfile
+    >>> i = PkgLogIndex(tempfile.mkstemp()[1])
+    >>> i.update("repo", True, "pkg", "1.0", "amd64", buildlog="repo/pkg/1.0/amd64/pkg_1.0_amd64.buildlog.gz", status="successful", stamp=1)
+    >>> i.update("repo", True, "pkg", "1.0", "source", changes="repo/pkg/1.0/source/pkg_1.0_source.changes", stamp=2)
+    >>> i.update("repo", False, "pkg", "1.1", "amd64", buildlog="repo/_failed/pkg/1.1/amd64/pkg_1.1_amd64.buildlog.gz", status="failed", stamp=3)
+    >>> i.update("repo", True, "other", "2.0", "i386", status="successful", stamp=4)
+    >>> [(r["package"], r["version"], r["architecture"], r["status"]) for r in i.find(package="pkg", installed=True)]
+    [(u'pkg', u'1.0', u'amd64', u'successful'), (u'pkg', u'1.0', u'source', None)]
+    >>> [(r["package"], r["version"]) for r in i.search("p*", limit=1)]
+    [(u'pkg', u'1.1')]
+    >>> [(r["package"], r["version"]) for r in i.search("*", offset=1, limit=2)]
+    [(u'pkg', u'1.1'), (u'pkg', u'1.0')]
+    >>> sorted(i.versions("repo", True).items())
+    [(u'other', [u'2.0']), (u'pkg', [u'1.0'])]
+    >>> i.versions("repo", False, package="pkg")
+    {u'pkg': [u'1.1']}
+    >>> i.remove("repo", True, "pkg", "1.0")
+    >>> sorted(i.versions("repo", True).items())
+    [(u'other', [u'2.0'])]
+    """
+    _SCHEMA = """\
+CREATE TABLE IF NOT EXISTS pkglog (
+  repository TEXT NOT NULL,
+  installed INTEGER NOT NULL,
+  package TEXT NOT NULL,
+  version TEXT NOT NULL,
+  architecture TEXT NOT NULL,
+  buildlog TEXT,
+  changes TEXT,
+  status TEXT,
+  stamp REAL,
+  PRIMARY KEY (repository, installed, package, version, architecture));
+CREATE INDEX IF NOT EXISTS pkglog_package ON pkglog (package, version);
+CREATE INDEX IF NOT EXISTS pkglog_stamp ON pkglog (stamp);
+"""
+    _COLUMNS = ["repository", "installed", "package", "version", "architecture", "buildlog", "changes", "status", "stamp"]
+
+    _INSTANCE = None
+    _INSTANCE_LOCK = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        "Get the global index (VAR_DIR/pkglog.sqlite), rebuilding it from LOG_DIR when missing."
+        with cls._INSTANCE_LOCK:
+            if cls._INSTANCE is None:
+                path = os.path.join(mini_buildd.setup.VAR_DIR, "pkglog.sqlite")
+                rebuild = not os.path.exists(path)
+                cls._INSTANCE = cls(path)
+                if rebuild:
+                    cls._INSTANCE.rebuild()
+            return cls._INSTANCE
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.executescript(self._SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    @classmethod
+    def _update(cls, db, repository, installed, package, version, architecture, buildlog=None, changes=None, status=None, stamp=None):
+        key = [repository, 1 if installed else 0, package, version, architecture]
+        db.execute("INSERT OR IGNORE INTO pkglog (repository, installed, package, version, architecture) VALUES (?, ?, ?, ?, ?)", key)
+        for column, value in [("buildlog", buildlog), ("changes", changes), ("status", status), ("stamp", stamp)]:
+            if value is not None:
+                db.execute("UPDATE pkglog SET {c}=? WHERE repository=? AND installed=? AND package=? AND version=? AND architecture=?".format(c=column),
+                           [value] + key)
+
+    def update(self, *args, **kwargs):
+        "Add or update a package log entry (None values don't overwrite)."
+        with self._connect() as db:
+            self._update(db, *args, **kwargs)
+
+    @classmethod
+    def _where(cls, repository=None, installed=None, package=None, version=None):
+        conditions, values = [], []
+        for column, value in [("repository", repository), ("installed", installed), ("package", package), ("version", version)]:
+            if value is not None:
+                conditions.append("{c}=?".format(c=column))
+                values.append((1 if value else 0) if column == "installed" else value)
+        return " WHERE " + " AND ".join(conditions) if conditions else "", values
+
+    def find(self, repository=None, installed=None, package=None, version=None):
+        where, values = self._where(repository, installed, package, version)
+        with self._connect() as db:
+            return [dict(r) for r in db.execute("SELECT * FROM pkglog{w} ORDER BY repository, installed DESC, package, version, architecture".format(w=where), values)]
+
+    def search(self, pattern="*", repository=None, installed=None, version=None, offset=0, limit=50):
+        "Search (shell glob pattern on package name), latest first."
+        where, values = self._where(repository, installed, None, version)
+        where += " AND " if where else " WHERE "
+        with self._connect() as db:
+            return [dict(r) for r in db.execute("SELECT * FROM pkglog{w}package GLOB ? ORDER BY stamp DESC, package, version, architecture LIMIT ? OFFSET ?".format(w=where),
+                                                values + [pattern, limit, offset])]
+
+    def versions(self, repository, installed, package=None):
+        "Get all logged versions per package (or only for the given package) as dict."
+        where, values = self._where(repository, installed, package)
+        result = {}
+        with self._connect() as db:
+            for p, v in db.execute("SELECT DISTINCT package, version FROM pkglog{w}".format(w=where), values):
+                result.setdefault(p, []).append(v)
+        return result
+
+    def remove(self, repository, installed, package, version=None):
+        where, values = self._where(repository, installed, package, version)
+        with self._connect() as db:
+            db.execute("DELETE FROM pkglog{w}".format(w=where), values)
+
+    def rebuild(self):
+        "Rebuild index from scratch by scanning LOG_DIR."
+        start = time.time()
+        n = 0
+        with self._connect() as db:
+            db.execute("DELETE FROM pkglog")
+            for path, _dirs, files in os.walk(mini_buildd.setup.LOG_DIR):
+                key = PkgLog.parse_path(path)
+                if key is None:
+                    continue
+                for f in files:
+                    PkgLog.index_file(lambda *args, **kwargs: self._update(db, *args, **kwargs), key, os.path.join(path, f))
+                    n += 1
+        LOG.info("Package log index rebuilt: {n} files in {s} seconds.".format(n=n, s=round(time.time() - start, 1)))
+
+
 class PkgLog(object):
+    """
+    Package log: LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/.
+
+    Build logs are stored gzip-compressed (see archive()). All
+    package logs are indexed (see PkgLogIndex), so lookups
+    don't need to glob the file system.
+
+    The files in LOG_DIR are authoritative; the index is only
+    derived from them (and may always be rebuilt, see
+    PkgLogIndex.rebuild()).
+    """
+
     @classmethod
     def get_path(cls, repository, installed, package, version=None, architecture=None, relative=False):
         return os.path.join("" if relative else mini_buildd.setup.LOG_DIR,
@@ -400,24 +846,90 @@ class PkgLog(object):
                             architecture if architecture else "")
 
     @classmethod
-    def make_relative(cls, path):
-        return path.replace(mini_buildd.setup.LOG_DIR, "")
+    def parse_path(cls, path, log_dir=None):
+        """
+        Parse package log dir path (absolute) into (repository, installed, package, version, architecture); None if not a package log dir.
+
+        >>> PkgLog.parse_path("/var/log/repo/_failed/pkg/1.0/amd64", log_dir="/var/log")
+        (u'repo', False, u'pkg', u'1.0', u'amd64')
+        >>> PkgLog.parse_path("/var/log/repo/pkg/1.0/amd64/", log_dir="/var/log")
+        (u'repo', True, u'pkg', u'1.0', u'amd64')
+        >>> PkgLog.parse_path("/var/log/repo/pkg/1.0", log_dir="/var/log")
+        """
+        parts = cls.make_relative(path, log_dir).strip("/").split("/")
+        installed = len(parts) == 4
+        if installed or (len(parts) == 5 and parts[1] == "_failed"):
+            return parts[0], installed, parts[-3], parts[-2], parts[-1]
+
+    @classmethod
+    def make_relative(cls, path, log_dir=None):
+        "Path relative to the log dir ('log_dir', defaults to LOG_DIR)."
+        return path.replace(mini_buildd.setup.LOG_DIR if log_dir is None else log_dir, "")
+
+    @classmethod
+    def is_buildlog(cls, file_name):
+        return re.match(r".*\.buildlog(\.gz)?$", file_name) is not None
+
+    @classmethod
+    def is_changes(cls, file_name):
+        "Changes in the package log, excluding build requests and build results."
+        return file_name.endswith(".changes") and not ("mini-buildd-buildrequest" in file_name or "mini-buildd-buildresult" in file_name)
+
+    @classmethod
+    def index_file(cls, update, key, file_path, status=None):
+        "Add file to the index via update function (if relevant)."
+        file_name = os.path.basename(file_path)
+        stamp = os.path.getmtime(file_path)
+        if cls.is_buildlog(file_name):
+            update(*key, buildlog=cls.make_relative(file_path).lstrip("/"), stamp=stamp)
+        elif cls.is_changes(file_name):
+            update(*key, changes=cls.make_relative(file_path).lstrip("/"), stamp=stamp)
+        elif "mini-buildd-buildresult" in file_name:
+            if status is None:
+                status = debian.deb822.Changes(open_utf8(file_path)).get("Sbuild-Status")
+            update(*key, status=status, stamp=stamp)
+
+    @classmethod
+    def archive(cls, file_path, logdir, status=None):
+        """
+        Move file to package log dir LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/, and add it to the index.
+
+        Build logs are gzip-compressed. Returns the new path.
+        """
+        file_name = os.path.basename(file_path)
+        if file_name.endswith(".buildlog"):
+            file_name += ".gz"
+            with open(file_path, "rb") as src, gzip.open(os.path.join(logdir, file_name), "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.remove(file_path)
+        else:
+            os.rename(file_path, os.path.join(logdir, file_name))
+
+        key = cls.parse_path(logdir)
+        if key:
+            cls.index_file(PkgLogIndex.get().update, key, os.path.join(logdir, file_name), status=status)
+
+        return os.path.join(logdir, file_name)
+
+    @classmethod
+    def purge(cls, repository, installed, package, version):
+        "Remove package log dir (and from the index)."
+        shutil.rmtree(cls.get_path(repository, installed, package, version), ignore_errors=True)
+        PkgLogIndex.get().remove(repository, installed, package, version)
 
     def __init__(self, repository, installed, package, version):
+        """
+        Package log for version (repository may be '*' for any).
+        """
         self.path = self.get_path(repository, installed, package, version)
 
-        # Find build logs: "LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/PACKAGE_VERSION_ARCH.buildlog"
         self.buildlogs = {}
-        for buildlog in glob.glob("{p}/*/*.buildlog".format(p=self.path)):
-            arch = os.path.basename(os.path.dirname(buildlog))
-            self.buildlogs[arch] = buildlog
-
-        # Find changes: "LOG_DIR/REPO/[_failed/]PACKAGE/VERSION/ARCH/PACKAGE_VERSION_ARCH.changes"
         self.changes = None
-        for c in glob.glob("{p}/*/*.changes".format(p=self.path)):
-            if not ("mini-buildd-buildrequest" in c or "mini-buildd-buildresult" in c):
-                self.changes = c
-                break
+        for entry in PkgLogIndex.get().find(repository=None if repository == "*" else repository, installed=installed, package=package, version=version):
+            if entry["buildlog"]:
+                self.buildlogs[entry["architecture"]] = os.path.join(mini_buildd.setup.LOG_DIR, entry["buildlog"])
+            if entry["changes"] and not self.changes:
+                self.changes = os.path.join(mini_buildd.setup.LOG_DIR, entry["changes"])
 
 
 def subst_placeholders(template, placeholders):
@@ -453,18 +965,133 @@ def run_as_thread(thread_func=None, daemon=False, **kwargs):
     return thread
 
 
-def hash_of_file(file_name, hash_type="md5"):
+# File digests, by (device, inode, size, mtime, ctime); see get_file_digests()
+DIGESTS = ["md5", "sha1", "sha256"]
+_DIGESTS_LOCK = threading.Lock()
+_DIGESTS = collections.OrderedDict()
+_DIGESTS_CACHE_SIZE = 10000
+_DIGESTS_READ_SIZE = 1024 * 1024
+
+
+def _get_digests_key(file_name):
+    st = os.stat(file_name)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def set_file_digests(file_name, digests):
+    """
+    Seed the digest cache for a file whose digests are already known (like computed while it was written).
+    """
+    key = _get_digests_key(file_name)
+    with _DIGESTS_LOCK:
+        _DIGESTS[key] = dict(digests, size=key[2])
+        while len(_DIGESTS) > _DIGESTS_CACHE_SIZE:
+            _DIGESTS.popitem(last=False)
+
+
+def get_file_digests(file_name):
+    """
+    Get size, md5, sha1 and sha256 of a file as dict (a copy, the cached dict is never handed out).
+
+    All digests are computed in one pass with large reads, and
+    cached by (device, inode, size, mtime, ctime) -- so files
+    hashed several times (changes, pool files, blobs) are only
+    read once. A file rewritten in place with its mtime kept
+    (or within mtime granularity) still changes ctime.
+
+    Don't use cached digests where a stale hash would be a
+    security problem (see hash_of_file()).
+
+    >>> t = tempfile.NamedTemporaryFile()
+    >>> t.write("A test file\\n")
+    >>> t.flush()
+    >>> d = get_file_digests(t.name)
+    >>> d["size"], d["md5"], d["sha1"]
+    (12, 'f51cd7c734370c646f9af5677dfd2d90', '957f7a69e05032e61571f0c260466cf5525eb273')
+    >>> d["md5"] = "modified"
+    >>> get_file_digests(t.name) == d, get_file_digests(t.name)["md5"]
+    (False, 'f51cd7c734370c646f9af5677dfd2d90')
+    """
+    key = _get_digests_key(file_name)
+    with _DIGESTS_LOCK:
+        digests = _DIGESTS.get(key)
+        if digests is not None:
+            _DIGESTS[key] = _DIGESTS.pop(key)
+            return dict(digests)
+
+    hashes = [hashlib.new(d) for d in DIGESTS]
+    with open(file_name, "rb") as f:
+        while True:
+            data = f.read(_DIGESTS_READ_SIZE)
+            if not data:
+                break
+            for h in hashes:
+                h.update(data)
+    digests = dict(zip(DIGESTS, [h.hexdigest() for h in hashes]), size=key[2])
+
+    with _DIGESTS_LOCK:
+        _DIGESTS[key] = digests
+        while len(_DIGESTS) > _DIGESTS_CACHE_SIZE:
+            _DIGESTS.popitem(last=False)
+    return dict(digests)
+
+
+def benchmark_file_digests(size=256 * 1024 * 1024):
+    """
+    Compare get_file_digests() to one pass per digest with small (128 byte) reads, on a random file of 'size' bytes.
+
+    Returns seconds per method as list of (METHOD, SECONDS).
+
+    >>> for m, s in benchmark_file_digests():  # doctest: +SKIP
+    ...     print("{m}: {s}s".format(m=m, s=s))
+    one pass per digest, 128 byte reads: 9.25s
+    sha256 only, 128 byte reads: 3.44s
+    all digests in one pass: 4.37s
+    all digests in one pass (cached): 0.0s
+    """
+    def small_reads(file_name, hash_type):
+        h = hashlib.new(hash_type)
+        with open(file_name, "rb") as f:
+            while True:
+                data = f.read(128)
+                if not data:
+                    break
+                h.update(data)
+        return h.hexdigest()
+
+    def timed(func):
+        start = time.time()
+        func()
+        return round(time.time() - start, 2)
+
+    with tempfile.NamedTemporaryFile(dir=mini_buildd.setup.TMP_DIR) as t:
+        for _n in range(0, size, _DIGESTS_READ_SIZE):
+            t.write(os.urandom(_DIGESTS_READ_SIZE))
+        t.flush()
+        return [("one pass per digest, 128 byte reads", timed(lambda: [small_reads(t.name, d) for d in DIGESTS])),
+                ("sha256 only, 128 byte reads", timed(lambda: small_reads(t.name, "sha256"))),
+                ("all digests in one pass", timed(lambda: get_file_digests(t.name))),
+                ("all digests in one pass (cached)", timed(lambda: get_file_digests(t.name)))]
+
+
+def hash_of_file(file_name, hash_type="md5", cached=True):
     """
     Helper to get any hash from file contents.
+
+    With 'cached' (the default), DIGESTS come from the digest
+    cache (see get_file_digests()); else, the file is always read.
     """
-    md5 = hashlib.new(hash_type)
+    if cached and hash_type in DIGESTS:
+        return get_file_digests(file_name)[hash_type]
+
+    h = hashlib.new(hash_type)
     with open(file_name, "rb") as f:
         while True:
-            data = f.read(128)
+            data = f.read(_DIGESTS_READ_SIZE)
             if not data:
                 break
-            md5.update(data)
-    return md5.hexdigest()
+            h.update(data)
+    return h.hexdigest()
 
 
 def md5_of_file(file_name):
@@ -475,6 +1102,10 @@ def sha1_of_file(file_name):
     return hash_of_file(file_name, hash_type="sha1")
 
 
+def sha256_of_file(file_name, cached=True):
+    return hash_of_file(file_name, hash_type="sha256", cached=cached)
+
+
 def u2b64(unicode_string):
     """
     Convert unicode string to base46.
@@ -522,6 +1153,19 @@ def list_get(list_, index, default=None):
         return default
 
 
+def link_or_copy(src, dst):
+    """
+    Hardlink file, or copy if that's not possible (like on different file systems).
+    """
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+        LOG.debug("Can't hardlink '{s}' (copying instead): {e}".format(s=src, e=e))
+        shutil.copyfile(src, dst)
+
+
 def mkdirs(path):
     """
     .. note:: Needed for python 2.x only. For 3.x, just use 'exist_ok' parameter.
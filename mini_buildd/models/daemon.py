@@ -142,7 +142,42 @@ prepare/remove actions will generate/remove the GnuPG key.
             ("FTP (incoming) Options", {"fields": ("ftpd_bind", "ftpd_options")}),
             ("Load Options", {"fields": ("build_queue_size", "sbuild_jobs")}),
             ("E-Mail Options", {"fields": ("smtp_server", "notify", "allow_emails_to")}),
-            ("Other Options", {"fields": ("gnupg_keyserver", "custom_hooks_directory", "show_last_packages", "show_last_builds")}))
+            ("Other Options", {"fields": ("gnupg_keyserver", "custom_hooks_directory", "show_last_packages", "show_last_builds")}),
+            ("Extra Options", {"classes": ("collapse",),
+                               "description": """
+<b>Supported extra options</b>
+<p><em>Queue-Discipline: fifo|fair|sjf</em>: Discipline for the incoming and build queues.</p>
+<p>
+'fifo' (the default) just orders by priority, then by time queued.
+'fair' additionally penalizes jobs by the recent usage of their
+repository and uploader ('Changed-By'), so one big upload batch
+does not starve everybody else. 'sjf' (shortest job first) orders
+builds of the same priority by their estimated build time, taken
+from the build duration history; use aging with this.
+</p>
+<p><em>Queue-Aging: SECONDS</em>: Jobs gain one priority point for every SECONDS they wait (default 0: no aging).</p>
+<p><em>Queue-Half-Life: SECONDS</em>: Half life of recent usage for the 'fair' discipline (default 3600).</p>
+<p><em>Queue-Boost: N</em>: Priority boost for uploads to non-experimental suites, or with urgency high or above (default 0).</p>
+<p>
+<em>Example</em>:
+<tt>Queue-Discipline: fair</tt>
+</p>
+<p><em>Remotes-Status-TTL: SECONDS</em>: Refresh interval for the cached status of remote builders (default 60).</p>
+<p><em>FTP-Block-Size: BYTES</em>: Block size for FTP uploads to other instances (default 1048576).</p>
+<p><em>FTP-Parallel: N</em>: Maximum number of files of one upload transferred in parallel (default 4).</p>
+<p><em>Packager-Workers: N</em>: Number of incoming changes (user uploads, build results) processed in parallel (default: number of CPUs).</p>
+<p>
+Changes of the same package are always processed one after the
+other, and installs to the same repository are serialized.
+</p>
+<p><em>Export-Delay: SECONDS</em>: Defer export (and signing) of repository indices after package changes, so that changes within that window are exported in one go (default 0: export immediately).</p>
+<p>
+Note that changes only become visible to apt (including
+builds) after the export; use the 'flushexports' API call to
+export immediately.
+</p>
+""",
+                               "fields": ("extra_options",)}))
 
         filter_horizontal = ("notify",)
 
@@ -219,6 +254,23 @@ prepare/remove actions will generate/remove the GnuPG key.
         if not self.mbd_get_daemon().get_active_repositories() and not self.mbd_get_daemon().get_active_chroots():
             MsgLog(LOG, request).warn("No active chroot or repository.")
 
+    def mbd_get_queue_discipline(self):
+        name = self.mbd_get_extra_option("Queue-Discipline", mini_buildd.misc.QueueDiscipline.NAME)
+        aging = int(self.mbd_get_extra_option("Queue-Aging", "0"))
+        if name == mini_buildd.misc.FairShareDiscipline.NAME:
+            return mini_buildd.misc.FairShareDiscipline(aging=aging, half_life=int(self.mbd_get_extra_option("Queue-Half-Life", "3600")))
+        elif name == mini_buildd.misc.ShortestJobFirstDiscipline.NAME:
+            return mini_buildd.misc.ShortestJobFirstDiscipline(aging=aging)
+        elif name != mini_buildd.misc.QueueDiscipline.NAME:
+            LOG.warn("Unknown queue discipline '{n}' (using '{d}')".format(n=name, d=mini_buildd.misc.QueueDiscipline.NAME))
+        return mini_buildd.misc.QueueDiscipline(aging=aging)
+
+    def mbd_get_queue_boost(self, changes, experimental):
+        "Priority boost for uploads to non-experimental suites, or uploads with urgency high or above."
+        if not experimental or changes.get("Urgency", "").split(" ")[0].lower() in ["high", "emergency", "critical"]:
+            return int(self.mbd_get_extra_option("Queue-Boost", "0"))
+        return 0
+
     def mbd_get_ftp_hopo(self):
         return mini_buildd.misc.HoPo("{h}:{p}".format(h=self.hostname, p=mini_buildd.misc.HoPo(self.ftpd_bind).port))
 
@@ -9,6 +9,8 @@ import contextlib
 import shutil
 import glob
 import re
+import time
+import multiprocessing.pool
 import logging
 
 import debian.debian_support
@@ -19,7 +21,6 @@ import django.contrib.auth.models
 
 import mini_buildd.setup
 import mini_buildd.misc
-import mini_buildd.gnupg
 import mini_buildd.reprepro
 
 import mini_buildd.models.source
@@ -128,6 +129,11 @@ lintian) as non-lethal, and will install anyway.
         " Rollback field temporarily implemented as extra_option. "
         return int(self.mbd_get_extra_option("Rollback", "0"))
 
+    @property
+    def build_priority(self):
+        " Build priority temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Build-Priority", "0"))
+
     def mbd_get_distribution_string(self, repository, distribution, rollback=None):
         dist_string = "{c}-{i}-{s}".format(
             c=distribution.base_source.codename,
@@ -681,7 +687,37 @@ Example:
     class Admin(mini_buildd.models.base.StatusModel.Admin):
         fieldsets = (
             ("Basics", {"fields": ("identity", "layout", "distributions", "allow_unauthenticated_uploads", "extra_uploader_keyrings")}),
-            ("Notify and extra options", {"fields": ("notify", "notify_changed_by", "notify_maintainer", "reprepro_morguedir", "external_home_url")}),)
+            ("Notify and extra options", {"fields": ("notify", "notify_changed_by", "notify_maintainer", "reprepro_morguedir", "external_home_url")}),
+            ("Extra Options", {"classes": ("collapse",),
+                               "description": """
+<b>Supported extra options</b>
+<p><em>Build-Priority: N</em>: Priority of build requests for this repository in the builders' queues.</p>
+<p>
+Build requests with higher priority are built first; the default
+is 0. The value is added to the 'Build-Priority' extra option
+of the suite option (see layout), if any.
+</p>
+<p>
+<em>Example</em>:
+<tt>Build-Priority: 10</tt>: Prefer builds for this repository.
+</p>
+<p><em>Native-Index: yes|no</em>: Write indices with mini-buildd's native indexer rather than reprepro's export (default no).</p>
+<p>
+The native indexer caches index entries per package file, only
+rewrites indices that actually changed, compresses them in
+parallel (gz, bz2, and xz if available), and signs each
+distribution's Release once. Prepare the repository again after
+changing this.
+</p>
+<p>
+It also publishes index changes as pdiffs ('Packages.diff/Index')
+and all indices via 'by-hash' ('Acquire-By-Hash: yes'), so apt
+clients only download what changed after an upload. With
+reprepro's export, pdiffs are only written if reprepro's
+'rredtool' is installed; 'by-hash' is not supported.
+</p>
+""",
+                               "fields": ("extra_options",)}),)
         readonly_fields = []
         filter_horizontal = ("distributions", "notify",)
 
@@ -692,6 +728,55 @@ Example:
                 fields.append("identity")
             return fields
 
+        @classmethod
+        def mbd_action(cls, request, queryset, action, **kwargs):
+            """
+            Prepare several repositories, reindexing them in parallel (at most one per CPU), as this may take long.
+
+            Only the reindex itself (reprepro, no database access)
+            runs in the pool; all model checks and saves and the
+            logging happen in the calling thread.
+            """
+            repositories = list(queryset)
+            if action != "prepare" or len(repositories) < 2:
+                return super(Repository.Admin, cls).mbd_action(request, repositories, action, **kwargs)
+
+            # Shared dependencies (layouts, distributions) are prepared one by one first
+            for r in repositories:
+                try:
+                    cls._mbd_run_dependencies(request, r, cls.mbd_prepare)
+                except Exception as e:
+                    LOG.debug("Dependencies of {r} failed (will fail again on prepare): {e}".format(r=r, e=e))
+
+            # Config for all repositories to be (re-)prepared
+            reindex = []
+            for r in repositories:
+                if not r.mbd_is_prepared() or r.mbd_is_changed():
+                    try:
+                        r._mbd_prepare_config()
+                        reindex.append(r)
+                    except Exception as e:
+                        LOG.debug("Config of {r} failed (will fail again on prepare): {e}".format(r=r, e=e))
+
+            def run_reindex(reprepro):
+                try:
+                    return reprepro.reindex()
+                except Exception as e:
+                    return e
+
+            if reindex:
+                pool = multiprocessing.pool.ThreadPool(min(mini_buildd.misc.get_cpus(), len(reindex)))
+                try:
+                    results = pool.map(run_reindex, [r._mbd_reprepro() for r in reindex])
+                finally:
+                    pool.close()
+                    pool.join()
+                for r, result in zip(reindex, results):
+                    r._mbd_reindexed = result
+
+            # The actual prepare (using the reindex results)
+            super(Repository.Admin, cls).mbd_action(request, repositories, action, **kwargs)
+
         @classmethod
         def mbd_meta_build_keyring_packages(cls, msglog):
             if not Repository.mbd_get_daemon().is_running():
@@ -763,8 +848,11 @@ Example:
             with contextlib.closing(self.mbd_get_daemon().get_test_package(t)) as package:
                 self._mbd_portext2keyring_suites(request, "file://" + package.dsc)
 
-    def mbd_get_uploader_keyring(self):
-        gpg = mini_buildd.gnupg.TmpGnuPG()
+    def mbd_get_uploader_keyring(self, store, extra_keys=None):
+        """
+        Get uploader keyring (from the given mini_buildd.gnupg.KeyStore) for this repository.
+        """
+        keys = list(extra_keys or [])
         # Add keys from django users
         for u in django.contrib.auth.models.User.objects.filter(is_active=True):
             LOG.debug("Checking user: {u}".format(u=u))
@@ -776,20 +864,23 @@ Example:
                 LOG.warn("User '{u}' does not have an uploader profile (deliberately removed?)".format(u=u))
 
             if uploader and uploader.mbd_is_active() and uploader.may_upload_to.all().filter(identity=self.identity):
-                LOG.info("Adding uploader key for '{r}': {k}: {n}".format(r=self, k=uploader.key_long_id, n=uploader.key_name))
-                gpg.add_pub_key(uploader.key)
+                LOG.debug("Uploader key for '{r}': {k}: {n}".format(r=self, k=uploader.key_long_id, n=uploader.key_name))
+                keys.append(uploader.key)
 
         # Add configured extra keyrings
+        keyrings = []
         for l in self.extra_uploader_keyrings.splitlines():
             l = l.strip()
             if l and l[0] != "#":
-                LOG.info("Adding keyring: {k}".format(k=l))
-                gpg.add_keyring(l)
-        return gpg
+                keyrings.append(l)
+        return store.keyring("uploaders-{i}".format(i=self.identity), keys, keyrings)
 
     def mbd_get_path(self):
         return os.path.join(mini_buildd.setup.REPOSITORIES_DIR, self.identity)
 
+    def mbd_get_build_priority(self, suite_option):
+        return int(self.mbd_get_extra_option("Build-Priority", "0")) + suite_option.build_priority
+
     def mbd_get_description(self, distribution, suite_option):
         return "{s} packages for {d}-{i}".format(s=suite_option.suite.name, d=distribution.base_source.codename, i=self.identity)
 
@@ -864,9 +955,12 @@ Description: {desc}
 SignWith: default
 NotAutomatic: {na}
 ButAutomaticUpgrades: {bau}
-DebIndices: Packages Release . .gz .bz2
-DscIndices: Sources Release . .gz .bz2
+DebIndices: Packages Release . .gz .bz2{pdiff}
+DscIndices: Sources Release . .gz .bz2{pdiff}
 """
+        # reprepro's own export can only do pdiffs (via its rredtool); by-hash needs the native indexer
+        pdiff = " /usr/bin/rredtool" if os.path.exists("/usr/bin/rredtool") else ""
+
         result = ""
         for d in self.distributions.all():
             for s in self.layout.suiteoption_set.all():
@@ -878,7 +972,8 @@ DscIndices: Sources Release . .gz .bz2
                     architectures=" ".join([x.name for x in d.architectures.all()]),  # pylint: disable=no-member
                     desc=self.mbd_get_description(d, s),
                     na="yes" if s.not_automatic else "no",
-                    bau="yes" if s.but_automatic_upgrades else "no")
+                    bau="yes" if s.but_automatic_upgrades else "no",
+                    pdiff=pdiff)
 
                 for r in range(s.rollback):
                     result += dist_template.format(
@@ -889,23 +984,30 @@ DscIndices: Sources Release . .gz .bz2
                         architectures=" ".join([x.name for x in d.architectures.all()]),  # pylint: disable=no-member
                         desc="{d}: Automatic rollback distribution #{r}".format(d=self.mbd_get_description(d, s), r=r),
                         na="yes",
-                        bau="no")
+                        bau="no",
+                        pdiff=pdiff)
 
         return result
 
     def _mbd_reprepro(self):
-        return mini_buildd.reprepro.Reprepro(basedir=self.mbd_get_path())
+        return mini_buildd.reprepro.Reprepro(basedir=self.mbd_get_path(),
+                                             native_index=self.mbd_get_extra_option("Native-Index", "no") == "yes")
 
-    def mbd_package_list(self, pattern, typ=None, with_rollbacks=False, dist_regex=""):
-        result = []
-        for d in self.distributions.all():
-            for s in self.layout.suiteoption_set.all():
-                rollbacks = s.rollback if with_rollbacks else 0
-                for rollback in [None] + range(rollbacks):
-                    dist_str = s.mbd_get_distribution_string(self, d, rollback)
-                    if re.search(dist_regex, dist_str):
-                        result.extend(self._mbd_reprepro().list(pattern, dist_str, typ=typ))
-        return result
+    def mbd_reprepro_transaction(self):
+        """
+        Context manager to run several package operations with only one export of all changed distributions at the end.
+        """
+        return self._mbd_reprepro().transaction()
+
+    def mbd_package_list(self, pattern, typ=None, with_rollbacks=False, dist_regex="", architecture=None, component=None, regex=False):
+        """
+        Generate all packages matching pattern (shell-like glob, or regex), from the repository's package index.
+        """
+        match = re.compile(pattern) if regex else mini_buildd.reprepro.Reprepro.glob2regex(pattern)
+        reprepro = self._mbd_reprepro()
+        distributions = [d for d in reprepro.index.get_distributions()
+                         if (with_rollbacks or not mini_buildd.misc.Distribution(d).is_rollback) and re.search(dist_regex, d)]
+        return reprepro.iter_packages(match, distributions, typ=typ, architecture=architecture, component=component)
 
     def mbd_get_dsc_url(self, distribution, package, version):
         """
@@ -1029,20 +1131,38 @@ DscIndices: Sources Release . .gz .bz2
                                                distribution=distribution,
                                                msglog=msglog)
 
-    def _mbd_package_purge_orphaned_logs(self, package, msglog=LOG):
+    def _mbd_package_purge_orphaned_logs(self, package, versions, msglog=LOG):
         pkg_show = self._mbd_reprepro().show(package)
-        for pkg_log in glob.glob(mini_buildd.misc.PkgLog.get_path(self.identity, True, package, "*")):
-            msglog.debug("Checking package log: {p}".format(p=pkg_log))
-            if not self._mbd_package_find(pkg_show, version=os.path.basename(os.path.realpath(pkg_log))):
-                shutil.rmtree(pkg_log, ignore_errors=True)
-                msglog.info("Purging orphaned package log: {p}".format(p=pkg_log))
+        for version in versions:
+            msglog.debug("Checking package log: {p}_{v}".format(p=package, v=version))
+            if not self._mbd_package_find(pkg_show, version=version):
+                mini_buildd.misc.PkgLog.purge(self.identity, True, package, version)
+                msglog.info("Purging orphaned package log: {p}_{v}".format(p=package, v=version))
 
     def mbd_package_purge_orphaned_logs(self, package=None, msglog=LOG):
+        """
+        Purge package logs of versions no longer in any distribution.
+
+        Without package, this runs in bulk: All versions are read
+        from the exported Sources indices in one pass, and
+        compared to the package log index.
+        """
+        logged = mini_buildd.misc.PkgLogIndex.get().versions(self.identity, True, package=package)
         if package:
-            self._mbd_package_purge_orphaned_logs(package, msglog=msglog)
+            if package in logged:
+                self._mbd_package_purge_orphaned_logs(package, logged[package], msglog=msglog)
         else:
-            for pkg_dir in glob.glob(mini_buildd.misc.PkgLog.get_path(self.identity, True, "[!_]*")):
-                self._mbd_package_purge_orphaned_logs(os.path.basename(os.path.realpath(pkg_dir)), msglog=msglog)
+            start = time.time()
+            available = set((s["source"], s["sourceversion"]) for s in self._mbd_reprepro().get_sources())
+            checked, purged = 0, 0
+            for p, versions in logged.items():
+                for v in versions:
+                    checked += 1
+                    if (p, v) not in available:
+                        mini_buildd.misc.PkgLog.purge(self.identity, True, p, v)
+                        purged += 1
+                        msglog.info("Purging orphaned package log: {p}_{v}".format(p=p, v=v))
+            msglog.info("Orphaned package logs: {n} of {c} purged ({s} seconds).".format(n=purged, c=checked, s=round(time.time() - start, 2)))
 
     def _mbd_package_shift_rollbacks(self, distribution, suite_option, package_name):
         reprepro_output = ""
@@ -1059,45 +1179,47 @@ DscIndices: Sources Release . .gz .bz2
     def mbd_package_migrate(self, package, distribution, suite, rollback=None, version=None, msglog=LOG):
         reprepro_output = ""
 
-        src_dist = suite.mbd_get_distribution_string(self, distribution)
-        pkg_show = self._mbd_reprepro().show(package)
-        src_pkg = None
-
-        if rollback is not None:
-            dst_dist = src_dist
-            msglog.info("Rollback restore of '{p}' from rollback {r} to '{d}'".format(p=package, r=rollback, d=dst_dist))
-            if self._mbd_package_find(pkg_show, distribution=dst_dist):
-                raise Exception("Package '{p}' exists in '{d}': Remove first to restore rollback".format(p=package, d=dst_dist))
-
-            rob_dist = suite.mbd_get_distribution_string(self, distribution, rollback=rollback)
-            src_pkg = self._mbd_package_find(pkg_show, distribution=rob_dist, version=version)
-            if src_pkg is None:
-                raise Exception("Package '{p}' has no such version in rollback '{r}'".format(p=package, r=rollback))
-
-            # Actually migrate package in reprepro
-            reprepro_output += self._mbd_reprepro().migrate(package, rob_dist, dst_dist, version)
-        else:
-            # Get src and dst dist strings, and check we are configured to migrate
-            if not suite.migrates_to:
-                raise Exception("You can't migrate from '{d}'".format(d=src_dist))
-            dst_dist = suite.migrates_to.mbd_get_distribution_string(self, distribution)
+        # Run all reprepro calls in one go (holding the repository lock), with only one export at the end
+        with self._mbd_reprepro().transaction():
+            src_dist = suite.mbd_get_distribution_string(self, distribution)
+            pkg_show = self._mbd_reprepro().show(package)
+            src_pkg = None
+
+            if rollback is not None:
+                dst_dist = src_dist
+                msglog.info("Rollback restore of '{p}' from rollback {r} to '{d}'".format(p=package, r=rollback, d=dst_dist))
+                if self._mbd_package_find(pkg_show, distribution=dst_dist):
+                    raise Exception("Package '{p}' exists in '{d}': Remove first to restore rollback".format(p=package, d=dst_dist))
+
+                rob_dist = suite.mbd_get_distribution_string(self, distribution, rollback=rollback)
+                src_pkg = self._mbd_package_find(pkg_show, distribution=rob_dist, version=version)
+                if src_pkg is None:
+                    raise Exception("Package '{p}' has no such version in rollback '{r}'".format(p=package, r=rollback))
+
+                # Actually migrate package in reprepro
+                reprepro_output += self._mbd_reprepro().migrate(package, rob_dist, dst_dist, version)
+            else:
+                # Get src and dst dist strings, and check we are configured to migrate
+                if not suite.migrates_to:
+                    raise Exception("You can't migrate from '{d}'".format(d=src_dist))
+                dst_dist = suite.migrates_to.mbd_get_distribution_string(self, distribution)
 
-            # Check if package is in src_dst
-            src_pkg = self._mbd_package_find(pkg_show, distribution=src_dist, version=version)
-            if src_pkg is None:
-                raise Exception("Package '{p}' not in '{d}'".format(p=package, d=src_dist))
+                # Check if package is in src_dst
+                src_pkg = self._mbd_package_find(pkg_show, distribution=src_dist, version=version)
+                if src_pkg is None:
+                    raise Exception("Package '{p}' not in '{d}'".format(p=package, d=src_dist))
 
-            # Check that version is not already migrated
-            dst_pkg = self._mbd_package_find(pkg_show, distribution=dst_dist)
-            if dst_pkg is not None and src_pkg["sourceversion"] == dst_pkg["sourceversion"]:
-                raise Exception("Version '{v}' already migrated to '{d}'".format(v=src_pkg["sourceversion"], d=dst_dist))
+                # Check that version is not already migrated
+                dst_pkg = self._mbd_package_find(pkg_show, distribution=dst_dist)
+                if dst_pkg is not None and src_pkg["sourceversion"] == dst_pkg["sourceversion"]:
+                    raise Exception("Version '{v}' already migrated to '{d}'".format(v=src_pkg["sourceversion"], d=dst_dist))
 
-            # Shift rollbacks in the destination distributions
-            if dst_pkg is not None:
-                reprepro_output += self._mbd_package_shift_rollbacks(distribution, suite.migrates_to, package)
+                # Shift rollbacks in the destination distributions
+                if dst_pkg is not None:
+                    reprepro_output += self._mbd_package_shift_rollbacks(distribution, suite.migrates_to, package)
 
-            # Actually migrate package in reprepro
-            reprepro_output += self._mbd_reprepro().migrate(package, src_dist, dst_dist, version)
+                # Actually migrate package in reprepro
+                reprepro_output += self._mbd_reprepro().migrate(package, src_dist, dst_dist, version)
 
         # Finally, purge any now-maybe-orphaned package logs
         self.mbd_package_purge_orphaned_logs(package, msglog=msglog)
@@ -1110,32 +1232,34 @@ DscIndices: Sources Release . .gz .bz2
     def mbd_package_remove(self, package, distribution, suite, rollback=None, version=None, msglog=LOG):
         reprepro_output = ""
 
-        dist_str = suite.mbd_get_distribution_string(self, distribution, rollback)
-        src_pkg = self.mbd_package_find(package, distribution=dist_str, version=version)
-        if not src_pkg:
-            raise Exception("Package '{p}' not in '{d}'".format(p=package, d=dist_str))
-
-        if rollback is None:
-            # Shift rollbacks
-            reprepro_output += self._mbd_package_shift_rollbacks(distribution, suite, package)
-            # Remove package
-            reprepro_output += self._mbd_reprepro().remove(package, dist_str, version)
-        else:
-            # Rollback removal
-            reprepro_output += self._mbd_reprepro().remove(package, dist_str, version)
-
-            # Fix up empty rollback dist
-            for r in range(rollback, suite.rollback - 1):
-                src = suite.mbd_get_distribution_string(self, distribution, r + 1)
-                dst = suite.mbd_get_distribution_string(self, distribution, r)
-                try:
-                    reprepro_output += self._mbd_reprepro().migrate(package, src, dst)
-                    reprepro_output += self._mbd_reprepro().remove(package, src)
-                except Exception as e:
-                    mini_buildd.setup.log_exception(msglog,
-                                                    "Rollback: Moving '{p}' from '{s}' to '{d}' FAILED (ignoring)".format(p=package, s=src, d=dst),
-                                                    e,
-                                                    logging.WARN)
+        # Run all reprepro calls in one go (holding the repository lock), with only one export at the end
+        with self._mbd_reprepro().transaction():
+            dist_str = suite.mbd_get_distribution_string(self, distribution, rollback)
+            src_pkg = self.mbd_package_find(package, distribution=dist_str, version=version)
+            if not src_pkg:
+                raise Exception("Package '{p}' not in '{d}'".format(p=package, d=dist_str))
+
+            if rollback is None:
+                # Shift rollbacks
+                reprepro_output += self._mbd_package_shift_rollbacks(distribution, suite, package)
+                # Remove package
+                reprepro_output += self._mbd_reprepro().remove(package, dist_str, version)
+            else:
+                # Rollback removal
+                reprepro_output += self._mbd_reprepro().remove(package, dist_str, version)
+
+                # Fix up empty rollback dist
+                for r in range(rollback, suite.rollback - 1):
+                    src = suite.mbd_get_distribution_string(self, distribution, r + 1)
+                    dst = suite.mbd_get_distribution_string(self, distribution, r)
+                    try:
+                        reprepro_output += self._mbd_reprepro().migrate(package, src, dst)
+                        reprepro_output += self._mbd_reprepro().remove(package, src)
+                    except Exception as e:
+                        mini_buildd.setup.log_exception(msglog,
+                                                        "Rollback: Moving '{p}' from '{s}' to '{d}' FAILED (ignoring)".format(p=package, s=src, d=dst),
+                                                        e,
+                                                        logging.WARN)
 
         # Finally, purge any now-maybe-orphaned package logs
         self.mbd_package_purge_orphaned_logs(package, msglog=msglog)
@@ -1193,28 +1317,28 @@ DscIndices: Sources Release . .gz .bz2
         package = changes["Source"]
         LOG.debug("Package install: Package={p}".format(p=package))
 
-        # Shift current package up in the rollback distributions (unless this is the initial install)
-        if self.mbd_package_find(package, distribution=dist_str):
-            self._mbd_package_shift_rollbacks(distribution, suite_option, package)
+        # Hold the repository lock, so parallel packagers don't interleave; export only once at the end
+        with self._mbd_reprepro().transaction():
+            # Shift current package up in the rollback distributions (unless this is the initial install)
+            if self.mbd_package_find(package, distribution=dist_str):
+                self._mbd_package_shift_rollbacks(distribution, suite_option, package)
 
-        # First, install the dsc
-        self._mbd_reprepro().install_dsc(changes.dsc_file_name, dist_str)
+            # First, install the dsc
+            self._mbd_reprepro().install_dsc(changes.dsc_file_name, dist_str)
 
-        # Second, install all build results
-        for bres in bresults.values():
-            # Don't try install if skipped
-            if bres.get("Sbuild-Status") == "skipped":
-                LOG.info("Skipped: {p} ({d})".format(p=bres.get_pkg_id(with_arch=True), d=bres["Distribution"]))
-            else:
-                self._mbd_package_install(bres, dist_str)
+            # Second, install all build results
+            for bres in bresults.values():
+                # Don't try install if skipped
+                if bres.get("Sbuild-Status") == "skipped":
+                    LOG.info("Skipped: {p} ({d})".format(p=bres.get_pkg_id(with_arch=True), d=bres["Distribution"]))
+                else:
+                    self._mbd_package_install(bres, dist_str)
 
         # Finally, purge any now-maybe-orphaned package logs
         self.mbd_package_purge_orphaned_logs(package)
 
-    def mbd_prepare(self, _request):
-        """
-        Idempotent repository preparation. This may be used as-is as mbd_sync.
-        """
+    def _mbd_prepare_config(self):
+        "Sanity checks, and (re-)build reprepro config files."
         # Architecture sanity checks
         for d in self.distributions.all():
             if not d.architectureoption_set.all().filter(optional=False):
@@ -1245,8 +1369,18 @@ gnupghome {h}
 {m}
 """.format(h=os.path.join(mini_buildd.setup.HOME_DIR, ".gnupg"), m="morguedir +b/morguedir" if self.reprepro_morguedir else "")).save()
 
-        # (Re-)index
-        self._mbd_reprepro().reindex()
+    def mbd_prepare(self, request):
+        """
+        Idempotent repository preparation. This may be used as-is as mbd_sync.
+        """
+        self._mbd_prepare_config()
+
+        # (Re-)index, unless already done in parallel (see Admin.mbd_action())
+        reindexed, self._mbd_reindexed = getattr(self, "_mbd_reindexed", None), None
+        if isinstance(reindexed, Exception):
+            raise reindexed
+        timings = reindexed if reindexed is not None else self._mbd_reprepro().reindex()
+        MsgLog(LOG, request).info("Reindexed {r}: {t}".format(r=self.identity, t=", ".join(["{d} {s}s".format(d=d, s=s) for d, s in timings.items()])))
 
     def mbd_sync(self, request):
         self.mbd_prepare(request)
@@ -1259,11 +1393,7 @@ gnupghome {h}
         # Reprepro check
         MsgLog(LOG, request).log_text(self._mbd_reprepro().check())
 
-        # Purge orphaned logs.
-        # Note: This may take some time on bigger repos. We
-        # usually run this per package on install/remove/migrate
-        # anyway, so maybe this could eventually be moved to a
-        # better place.
+        # Purge orphaned logs (bulk mode: one pass over the exported indices)
         self.mbd_package_purge_orphaned_logs(msglog=MsgLog(LOG, request))
 
     def mbd_get_dependencies(self):
@@ -87,12 +87,13 @@ class Package(mini_buildd.misc.Status):
         self.repository.mbd_package_precheck(self.distribution, self.suite, self.changes["Source"], self.changes["Version"])
 
         # Generate build requests
-        self.requests = self.changes.gen_buildrequests(self.daemon.model, self.repository, self.distribution, self.suite)
+        self.requests = self.changes.gen_buildrequests(self.daemon.model, self.repository, self.distribution, self.suite,
+                                                       blobs_supported=lambda arch: self.daemon.remotes.blobs_supported(self.distribution.base_source.codename, arch))
 
         # Upload buildrequests
         for _key, breq in self.requests.items():
             try:
-                breq.upload_buildrequest(self.daemon.model.mbd_get_http_hopo())
+                breq.upload_buildrequest(self.daemon.remotes, gnupg=self.daemon.model.mbd_gnupg)
             except Exception as e:
                 mini_buildd.setup.log_exception(LOG,
                                                 "{i}: Buildrequest upload failed".format(i=breq.get_pkg_id()),
@@ -102,6 +103,7 @@ class Package(mini_buildd.misc.Status):
 
     def add_buildresult(self, bres):
         self.daemon.keyrings.get_remotes().verify(bres.file_path)
+        self.daemon.remotes.completed(bres)
 
         arch = bres["Architecture"]
 
@@ -168,10 +170,8 @@ class Package(mini_buildd.misc.Status):
 
         # On installed: In case there is a "failed" log of the same version, remove it.
         if self.get_status() == self.INSTALLED:
-            # The pkglog_dir must be non-None on INSTALLED status
-            failed_logdir = os.path.dirname(self.changes.get_pkglog_dir(installed=False, relative=False))
-            LOG.debug("Purging failed log dir: {f}".format(f=failed_logdir))
-            shutil.rmtree(failed_logdir, ignore_errors=True)
+            LOG.debug("Purging failed log dir: {p}".format(p=self.changes.get_pkg_id()))
+            mini_buildd.misc.PkgLog.purge(self.repository.identity, False, self.changes["Source"], self.changes["Version"])
 
     def notify(self):
         def header(title, underline="-"):
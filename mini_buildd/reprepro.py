@@ -5,18 +5,231 @@ Run reprepro commands.
 from __future__ import unicode_literals
 
 import os
+import re
+import glob
+import gzip
+import fnmatch
+import itertools
+import collections
 import shutil
+import contextlib
+import time
 import threading
 
 import logging
 
+import mini_buildd.setup
 import mini_buildd.misc
+import mini_buildd.indexer
 
 LOG = logging.getLogger(__name__)
 
+
+def iter_index(lines, fields):
+    """
+    Minimal (fast) parser for Sources/Packages indices: Generate a dict of the given (single line) fields per paragraph.
+
+    >>> list(iter_index([b"Package: a\\n", b"Version: 1.0\\n", b"Files:\\n", b" 00 1 a.dsc\\n", b"\\n", b"Package: b\\n", b"Version: 2.0\\n"], ["Package", "Version"]))
+    [{u'Version': u'1.0', u'Package': u'a'}, {u'Version': u'2.0', u'Package': u'b'}]
+    """
+    paragraph = {}
+    for line in lines:
+        if not line.strip():
+            if paragraph:
+                yield paragraph
+                paragraph = {}
+        elif line[0] not in b" \t":
+            key, _sep, value = line.partition(b":")
+            key = key.decode(mini_buildd.setup.CHAR_ENCODING)
+            if key in fields:
+                paragraph[key] = value.strip().decode(mini_buildd.setup.CHAR_ENCODING)
+    if paragraph:
+        yield paragraph
+
+
 _LOCKS_LOCK = threading.Lock()
 _LOCKS = {}
 
+_INDICES_LOCK = threading.Lock()
+_INDICES = {}
+
+# Repositories using the native indexer (see mini_buildd.indexer), per basedir
+_NATIVE_INDEX = {}
+
+# Distributions changed in the currently running transaction, per basedir (only accessed while holding the repository lock)
+_TRANSACTIONS = {}
+
+
+def _open_index(path):
+    """
+    Open an exported index file, uncompressed or gzipped. Returns None if neither exists.
+    """
+    if os.path.exists(path):
+        return open(path, "rb")
+    elif os.path.exists(path + ".gz"):
+        return gzip.open(path + ".gz", "rb")
+
+
+class PackageIndex(object):
+    """
+    In-memory index of all source and binary packages of one reprepro repository.
+
+    Packages are read per distribution from the exported
+    indices below 'dists/' (reprepro replaces these
+    atomically), so queries never need the reprepro lock.
+
+    Any writing reprepro call must invalidate the affected
+    distribution (see Reprepro); it's then re-read on next
+    access. A generation counter makes sure a concurrent read
+    of a distribution just being changed is never cached.
+
+    Distributions changed but not yet exported (see
+    Reprepro.transaction()) are read from the reprepro
+    database instead, holding the repository lock
+    ('repo_lock').
+    """
+    _LIST_FORMAT = "${package}|${$type}|${architecture}|${version}|${$source}|${$sourceversion}|${$component}\n"
+
+    def __init__(self, basedir, repo_lock):
+        self._basedir = basedir
+        self._repo_lock = repo_lock
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._distributions = None
+        self._dists = {}
+        self._unexported = set()
+
+    def _read_distributions(self):
+        with open(os.path.join(self._basedir, "conf", "distributions"), "rb") as f:
+            return [d["Codename"] for d in iter_index(f, ["Codename"])]
+
+    def _read_exported(self, distribution):
+        packages = []
+        dist_dir = os.path.join(self._basedir, "dists", distribution)
+
+        for path in sorted(glob.glob(os.path.join(dist_dir, "*", "source"))):
+            component = os.path.basename(os.path.dirname(path))
+            f = _open_index(os.path.join(path, "Sources"))
+            if f:
+                with f:
+                    for src in iter_index(f, ["Package", "Version"]):
+                        packages.append({"package": src["Package"],
+                                         "type": "dsc",
+                                         "architecture": "source",
+                                         "version": src["Version"],
+                                         "source": src["Package"],
+                                         "sourceversion": src["Version"],
+                                         "distribution": distribution,
+                                         "component": component})
+
+        for typ, pattern in [("deb", os.path.join(dist_dir, "*", "binary-*")),
+                             ("udeb", os.path.join(dist_dir, "*", "debian-installer", "binary-*"))]:
+            for path in sorted(glob.glob(pattern)):
+                component = os.path.basename(os.path.dirname(path)) if typ == "deb" else os.path.basename(os.path.dirname(os.path.dirname(path)))
+                f = _open_index(os.path.join(path, "Packages"))
+                if f:
+                    with f:
+                        for pkg in iter_index(f, ["Package", "Version", "Architecture", "Source"]):
+                            # Source field: Absent if same as binary, may have "(VERSION)" appended if version differs
+                            source, _sep, sourceversion = pkg.get("Source", pkg["Package"]).partition(" ")
+                            packages.append({"package": pkg["Package"],
+                                             "type": typ,
+                                             "architecture": pkg["Architecture"],
+                                             "version": pkg["Version"],
+                                             "source": source,
+                                             "sourceversion": sourceversion.strip("()") or pkg["Version"],
+                                             "distribution": distribution,
+                                             "component": component})
+        return packages
+
+    def _read_db(self, distribution):
+        packages = []
+        with self._repo_lock:
+            output = mini_buildd.misc.call(["reprepro", "--waitforlock=10", "--basedir={b}".format(b=self._basedir),
+                                            "--list-format={f}".format(f=self._LIST_FORMAT),
+                                            "list", distribution],
+                                           log_output=False)
+        for item in output.splitlines():
+            package, typ, architecture, version, source, sourceversion, component = item.split("|")
+            packages.append({"package": package,
+                             "type": typ,
+                             "architecture": architecture,
+                             "version": version,
+                             "source": source,
+                             "sourceversion": sourceversion,
+                             "distribution": distribution,
+                             "component": component})
+        return packages
+
+    def _read(self, distribution, unexported):
+        """
+        Read one distribution. Returns a pair: (list of all packages, dict of sources by name).
+        """
+        packages = self._read_db(distribution) if unexported else self._read_exported(distribution)
+        sources = {}
+        for p in packages:
+            if p["type"] == "dsc":
+                sources.setdefault(p["source"], []).append(p)
+
+        LOG.debug("Package index: {d}: {n} packages read{f}".format(d=distribution, n=len(packages), f=" (from reprepro db)" if unexported else ""))
+        return packages, sources
+
+    def get_distributions(self):
+        with self._lock:
+            if self._distributions is None:
+                self._distributions = self._read_distributions()
+            return self._distributions
+
+    def get(self, distribution):
+        """
+        Get (packages, sources) pair of a distribution (see _read()).
+        """
+        with self._lock:
+            result = self._dists.get(distribution)
+            generation = self._generation
+            unexported = distribution in self._unexported
+
+        if result is None:
+            result = self._read(distribution, unexported)
+            with self._lock:
+                if self._generation == generation:
+                    self._dists[distribution] = result
+        return result
+
+    def invalidate(self, distribution=None):
+        """
+        Invalidate one distribution, or all (including the list of distributions) if not given.
+        """
+        with self._lock:
+            self._generation += 1
+            if distribution in self._dists:
+                del self._dists[distribution]
+            elif distribution is None or distribution not in (self._distributions or []):
+                self._distributions = None
+                self._dists = {}
+        LOG.debug("Package index invalidated: {b}: {d}".format(b=self._basedir, d=distribution or "all distributions"))
+
+    def set_unexported(self, distribution):
+        with self._lock:
+            self._unexported.add(distribution)
+        self.invalidate(distribution)
+
+    def set_exported(self, distributions=None):
+        """
+        Mark distributions (all if not given) as exported again.
+        """
+        with self._lock:
+            if distributions is None:
+                self._unexported.clear()
+            else:
+                self._unexported.difference_update(distributions)
+        for d in distributions or [None]:
+            self.invalidate(d)
+
+    def get_unexported(self):
+        with self._lock:
+            return sorted(self._unexported)
+
 
 class Reprepro(object):
     """
@@ -31,15 +244,41 @@ class Reprepro(object):
 
     For the case that someone else is using reprepro
     manually, we also always run it with '--waitforlock'.
+
+    Queries (list, show, get_sources) are answered from the
+    in-memory PackageIndex, and only take the lock to read
+    distributions not yet exported.
+
+    The lock is reentrant; callers may hold 'lock' to run a
+    sequence of commands atomically.
+
+    Transactions
+
+    Each changing reprepro call usually exports (and signs)
+    the changed distribution. In a transaction(), calls are
+    run with '--export=never', and all changed distributions
+    are exported once at the end.
+
+    With 'native_index', reprepro never exports itself; all
+    exports are done via mini_buildd.indexer.
     """
-    def __init__(self, basedir):
+    def __init__(self, basedir, native_index=None):
         self._basedir = basedir
+        if native_index is not None:
+            _NATIVE_INDEX[basedir] = native_index
+        self._native_index = _NATIVE_INDEX.get(basedir, False)
         self._cmd = ["reprepro", "--verbose", "--waitforlock=10", "--basedir={b}".format(b=basedir)]
         # Seems dict.setdefault 'should' be atomic, but it may be not the case in all versions >=2.6
         # See: http://bugs.python.org/issue13521
         with _LOCKS_LOCK:
-            self._lock = _LOCKS.setdefault(self._basedir, threading.Lock())
+            self._lock = _LOCKS.setdefault(self._basedir, threading.RLock())
             LOG.debug("Lock for reprepro repository '{r}': {o}".format(r=self._basedir, o=self._lock))
+        with _INDICES_LOCK:
+            self._index = _INDICES.setdefault(self._basedir, PackageIndex(self._basedir, self._lock))
+
+    @property
+    def lock(self):
+        return self._lock
 
     def _call(self, args, show_command=False):
         return "{command}{output}".format(command="Running {command}\n".format(command=" ".join(self._cmd + args)) if show_command else "",
@@ -50,63 +289,285 @@ class Reprepro(object):
             return self._call(args, show_command)
 
     def reindex(self):
+        """
+        Rebuild the reprepro db and all indices. Returns export times per distribution as dict: {DIST: SECONDS}.
+
+        Distributions are exported one by one (for the timings):
+        reprepro locks the whole repository for any export, so
+        exports of one repository can't run in parallel anyway
+        (the native indexer compresses in parallel, though).
+        """
+        timings = collections.OrderedDict()
         with self._lock:
-            # Update reprepro dbs, and delete any packages no longer in dists.
-            self._call(["--delete", "clearvanished"])
+            try:
+                # Update reprepro dbs, and delete any packages no longer in dists.
+                self._call(["--delete", "clearvanished"])
 
-            # Purge all indices under 'dists/' (clearvanished does not remove indices of vanished distributions)
-            shutil.rmtree(os.path.join(self._basedir, "dists"), ignore_errors=True)
+                # Purge all indices under 'dists/' (clearvanished does not remove indices of vanished distributions)
+                shutil.rmtree(os.path.join(self._basedir, "dists"), ignore_errors=True)
 
-            # Finally, rebuild all indices
-            self._call(["export"])
+                # Finally, rebuild all indices
+                self._index.invalidate()
+                if self._native_index:
+                    timings = mini_buildd.indexer.Indexer(self._basedir).export(self._index.get_distributions(), prune=True)
+                else:
+                    for distribution in self._index.get_distributions():
+                        start = time.time()
+                        self._call(["export", distribution])
+                        timings[distribution] = round(time.time() - start, 1)
+                self._index.set_exported()
+            finally:
+                # Distributions may have changed, too
+                self._index.invalidate()
+
+        LOG.info("Reindexed {b}: {n} distributions in {s}s{m}".format(b=self._basedir,
+                                                                    n=len(timings),
+                                                                    s=round(sum(timings.values()), 1),
+                                                                    m=" (max {s}s: {d})".format(s=max(timings.values()), d=max(timings, key=timings.get)) if timings else ""))
+        return timings
 
     def check(self):
         return self._call_locked(["check"])
 
+    @property
+    def index(self):
+        return self._index
+
+    def iter_packages(self, match, distributions, typ=None, architecture=None, component=None):
+        """
+        Generate all packages (dicts like list()) of the given distributions whose name matches (re.search) the compiled regex 'match'.
+        """
+        for distribution in distributions:
+            packages, _sources = self._index.get(distribution)
+            for p in packages:
+                if (not typ or p["type"] == typ) and \
+                   (not architecture or p["architecture"] == architecture) and \
+                   (not component or p["component"] == component) and \
+                   match.search(p["package"]):
+                    yield p
+
+    @classmethod
+    def glob2regex(cls, pattern):
+        """
+        >>> bool(Reprepro.glob2regex("lib*").search("libfoo1"))
+        True
+        >>> bool(Reprepro.glob2regex("foo*").search("libfoo1"))
+        False
+        """
+        return re.compile("^" + fnmatch.translate(pattern))
+
     def list(self, pattern, distribution, typ=None, list_max=50):
+        return [dict(p) for p in itertools.islice(self.iter_packages(self.glob2regex(pattern), [distribution], typ=typ), list_max)]
+
+    def show(self, package):
         result = []
-        for item in self._call_locked(["--list-format=${package}|${$type}|${architecture}|${version}|${$source}|${$sourceversion}|${$codename}|${$component};",
-                                       "--list-max={m}".format(m=list_max)] +
-                                      (["--type={t}".format(t=typ)] if typ else []) +
-                                      ["listmatched",
-                                       distribution,
-                                       pattern]).split(";"):
-            if item:
-                item_split = item.split("|")
-                result.append({"package": item_split[0],
-                               "type": item_split[1],
-                               "architecture": item_split[2],
-                               "version": item_split[3],
-                               "source": item_split[4],
-                               "sourceversion": item_split[5],
-                               "distribution": item_split[6],
-                               "component": item_split[7],
+        for distribution in self._index.get_distributions():
+            _packages, sources = self._index.get(distribution)
+            for p in sources.get(package, []):
+                result.append({"source": p["source"],
+                               "sourceversion": p["sourceversion"],
+                               "distribution": p["distribution"],
                               })
         return result
 
-    def show(self, package):
+    def get_sources(self):
+        """
+        Get all source packages of all distributions as list of dicts (like show()), plus 'component'.
+        """
         result = []
-        # reprepro ls format: "${$source} | ${$sourceversion} |    ${$codename} | source\n"
-        for item in self._call_locked(["--type=dsc",
-                                       "ls",
-                                       package]).split("\n"):
-            LOG.debug("ls: {i}".format(i=item))
-            if item:
-                item_split = item.split("|")
-                result.append({"source": item_split[0].strip(),
-                               "sourceversion": item_split[1].strip(),
-                               "distribution": item_split[2].strip(),
-                              })
+        for distribution in self._index.get_distributions():
+            _packages, sources = self._index.get(distribution)
+            for s in sources.values():
+                for p in s:
+                    result.append({"source": p["source"],
+                                   "sourceversion": p["sourceversion"],
+                                   "distribution": p["distribution"],
+                                   "component": p["component"]})
         return result
 
+    def _call_changing(self, args, distribution):
+        """
+        Run a call changing 'distribution', and invalidate it in the package index (even on failure, changes may be partial).
+        """
+        with self._lock:
+            if self._basedir not in _TRANSACTIONS and not EXPORTER.is_deferring() and not self._native_index:
+                try:
+                    return self._call(args, show_command=True)
+                finally:
+                    self._index.invalidate(distribution)
+
+            # Implicit transaction if exports are deferred or native
+            with self.transaction():
+                _TRANSACTIONS[self._basedir].add(distribution)
+                self._index.set_unexported(distribution)
+                try:
+                    return self._call(["--export=never"] + args, show_command=True)
+                finally:
+                    self._index.invalidate(distribution)
+
+    def export(self, distributions):
+        """
+        Export (and sign) the given distributions.
+        """
+        with self._lock:
+            if not distributions:
+                return ""
+            if self._native_index:
+                timings = mini_buildd.indexer.Indexer(self._basedir).export(sorted(distributions))
+                result = "Native index export: {t}\n".format(t=", ".join(["{d} {s}s".format(d=d, s=s) for d, s in timings.items()]))
+            else:
+                result = self._call(["export"] + sorted(distributions), show_command=True)
+            self._index.set_exported(distributions)
+            return result
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run a sequence of changing calls holding the lock, with only one export of all changed distributions at the end.
+
+        Nested transactions join the outer one. The export is
+        left to the EXPORTER if it's deferring exports.
+        """
+        with self._lock:
+            if self._basedir in _TRANSACTIONS:
+                yield
+            else:
+                _TRANSACTIONS[self._basedir] = set()
+                try:
+                    yield
+                finally:
+                    changed = _TRANSACTIONS.pop(self._basedir)
+                    if not EXPORTER.schedule(self._basedir, changed):
+                        LOG.info("Reprepro transaction: Exporting {n} changed distribution(s): {d}".format(n=len(changed), d=" ".join(sorted(changed))))
+                        self.export(changed)
+
     def migrate(self, package, src_distribution, dst_distribution, version=None):
-        return self._call_locked(["copysrc", dst_distribution, src_distribution, package] + ([version] if version else []), show_command=True)
+        return self._call_changing(["copysrc", dst_distribution, src_distribution, package] + ([version] if version else []), dst_distribution)
 
     def remove(self, package, distribution, version=None):
-        return self._call_locked(["removesrc", distribution, package] + ([version] if version else []), show_command=True)
+        return self._call_changing(["removesrc", distribution, package] + ([version] if version else []), distribution)
 
     def install(self, changes, distribution):
-        return self._call_locked(["include", distribution, changes], show_command=True)
+        return self._call_changing(["include", distribution, changes], distribution)
 
     def install_dsc(self, dsc, distribution):
-        return self._call_locked(["includedsc", distribution, dsc], show_command=True)
+        return self._call_changing(["includedsc", distribution, dsc], distribution)
+
+
+class Exporter(object):
+    """
+    Deferred, coalesced export of changed distributions.
+
+    When running (see run()) with a delay, changes are not
+    exported immediately (see Reprepro.transaction()). Instead,
+    the changed distributions of a repository are exported (and
+    signed) all at once, 'delay' seconds after the first
+    change. Until then, the package index reads them from the
+    reprepro database.
+
+    Failed exports stay pending, and are retried after
+    RETRY_DELAY seconds (or on the next flush()).
+    """
+    RETRY_DELAY = 60
+
+    def __init__(self):
+        self.delay = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._shutdown = False
+        # basedir: [DUE_TIME, set of distributions]
+        self._pending = {}
+        self._exports = 0
+        self._changes = 0
+
+    def configure(self, delay):
+        with self._cond:
+            self.delay = delay
+
+    def is_deferring(self):
+        with self._cond:
+            return self._running and self.delay > 0
+
+    def schedule(self, basedir, distributions):
+        """
+        Schedule export of the given distributions. Returns False if not deferring (caller needs to export).
+        """
+        with self._cond:
+            if not (self._running and self.delay > 0):
+                return False
+            if distributions:
+                self._pending.setdefault(basedir, [time.time() + self.delay, set()])[1].update(distributions)
+                self._changes += 1
+                self._cond.notify()
+            return True
+
+    def pending(self):
+        """
+        Get pending exports as dict: {BASEDIR: {"distributions": [DIST, ...], "due": SECONDS}}.
+        """
+        with self._cond:
+            return dict((basedir, {"distributions": sorted(dists), "due": max(0, round(due - time.time(), 1))}) for basedir, (due, dists) in self._pending.items())
+
+    def get_stats(self):
+        "Get number of exports run, and number of changes coalesced into them."
+        with self._cond:
+            return {"exports": self._exports, "changes": self._changes}
+
+    def _export(self, pending):
+        for basedir, (_due, dists) in pending.items():
+            try:
+                LOG.info("Exporter: Exporting {b}: {d}".format(b=basedir, d=" ".join(sorted(dists))))
+                Reprepro(basedir).export(dists)
+                with self._cond:
+                    self._exports += 1
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Exporter: Export failed (retrying later): {b}".format(b=basedir), e)
+                # Back to pending directly (also when not running: schedule() would just drop it)
+                with self._cond:
+                    self._pending.setdefault(basedir, [time.time() + self.RETRY_DELAY, set()])[1].update(dists)
+                    self._cond.notify()
+
+    def flush(self, basedir=None):
+        """
+        Export all pending distributions (of one repository, or all) now. Returns the pending exports flushed (like pending()).
+        """
+        with self._cond:
+            flushed = dict((b, p) for b, p in self._pending.items() if basedir is None or b == basedir)
+            for b in flushed:
+                del self._pending[b]
+        result = dict((b, {"distributions": sorted(dists), "due": 0}) for b, (_due, dists) in flushed.items())
+        self._export(flushed)
+        return result
+
+    def run(self):
+        with self._cond:
+            self._running = True
+            self._shutdown = False
+
+        while True:
+            with self._cond:
+                while not self._shutdown:
+                    now = time.time()
+                    due = dict((b, p) for b, p in self._pending.items() if p[0] <= now)
+                    if due:
+                        for b in due:
+                            del self._pending[b]
+                        break
+                    self._cond.wait(min([p[0] - now for p in self._pending.values()]) if self._pending else None)
+
+                if self._shutdown:
+                    self._running = False
+                    break
+            self._export(due)
+
+        # Don't leave anything unexported
+        self.flush()
+        LOG.info("Exporter shut down.")
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify()
+
+
+EXPORTER = Exporter()
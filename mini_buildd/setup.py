@@ -15,7 +15,9 @@ HOME_DIR = None
 INCOMING_DIR = None
 REPOSITORIES_DIR = None
 
+VAR_DIR = None
 SPOOL_DIR = None
+BLOB_DIR = None
 TMP_DIR = None
 LOG_DIR = None
 LOG_FILE = None
@@ -69,6 +69,11 @@ def mbd_builder_status(builds):
     return {"builds": builds}
 
 
+@register.inclusion_tag("includes/mbd_queue_status.html")
+def mbd_queue_status(jobs):
+    return {"jobs": jobs}
+
+
 @register.inclusion_tag("includes/mbd_manage_subscriptions.html")
 def mbd_manage_subscriptions(repositories, package=""):
     return {"repositories": repositories,
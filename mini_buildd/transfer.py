@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+FTP transfer of files to (mini-buildd) ftp servers.
+
+Connections are pooled per host:port. Partial uploads are
+resumed (SIZE, REST), and independent files are transferred
+in parallel.
+
+Files already (partially) on the server are only skipped (or
+resumed) when the server's content is verified via its sha256
+(mini-buildd ftpd's 'XSHA256' command); else, they are uploaded
+from scratch.
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import ftplib
+import hashlib
+import threading
+import multiprocessing.pool
+import logging
+
+import mini_buildd.misc
+
+LOG = logging.getLogger(__name__)
+
+# Defaults; see configure()
+_BLOCK_SIZE = 1024 * 1024
+_PARALLEL = 4
+
+_POOL_LOCK = threading.Lock()
+_POOL = {}
+
+_STATS_LOCK = threading.Lock()
+_STATS = {}
+
+
+def configure(block_size=None, parallel=None):
+    global _BLOCK_SIZE, _PARALLEL  # pylint: disable=global-statement
+    if block_size:
+        _BLOCK_SIZE = block_size
+    if parallel:
+        _PARALLEL = parallel
+
+
+def _connect(hopo, pooled):
+    with _POOL_LOCK:
+        idle = _POOL.get(hopo.string, []) if pooled else []
+        while idle:
+            ftp = idle.pop()
+            try:
+                ftp.voidcmd("NOOP")
+                return ftp
+            except Exception as e:
+                LOG.debug("FTP: Dropping stale pooled connection to '{h}': {e}".format(h=hopo.string, e=e))
+                ftp.close()
+
+    ftp = ftplib.FTP()
+    ftp.connect(hopo.host, hopo.port)
+    ftp.login()
+    return ftp
+
+
+def _release(hopo, ftp):
+    with _POOL_LOCK:
+        _POOL.setdefault(hopo.string, []).append(ftp)
+
+
+def _close(ftp):
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+def _update_stats(hopo, size, seconds):
+    with _STATS_LOCK:
+        stats = _STATS.setdefault(hopo.string, {"files": 0, "bytes": 0, "seconds": 0.0})
+        stats["files"] += 1
+        stats["bytes"] += size
+        stats["seconds"] += seconds
+
+
+def get_stats():
+    """
+    Get upload statistics per host:port as dict: {"files": N, "bytes": N, "seconds": N, "throughput": BYTES_PER_SECOND}.
+    """
+    with _STATS_LOCK:
+        result = {}
+        for hopo, stats in _STATS.items():
+            result[hopo] = dict(stats, throughput=round(stats["bytes"] / stats["seconds"], 1) if stats["seconds"] else None)
+        return result
+
+
+def _remote_sha256(ftp, name):
+    """
+    Get sha256 of a file on the server, or None if the server can't tell (not a mini-buildd ftpd, or an older one).
+    """
+    try:
+        return ftp.sendcmd("XSHA256 {f}".format(f=name)).split()[1]
+    except ftplib.error_perm as e:
+        LOG.debug("FTP: Can't get sha256 of '{f}' on server: {e}".format(f=name, e=e))
+        return None
+
+
+def _sha256_of_head(path, size):
+    "Get sha256 of the first 'size' bytes of a file."
+    if size == os.path.getsize(path):
+        return mini_buildd.misc.sha256_of_file(path)
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while size > 0:
+            data = f.read(min(_BLOCK_SIZE, size))
+            if not data:
+                break
+            sha256.update(data)
+            size -= len(data)
+    return sha256.hexdigest()
+
+
+def _store(ftp, path, directory):
+    """
+    Upload one file, resuming a partial upload. Returns the number of bytes actually sent.
+    """
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+
+    ftp.cwd(directory)
+    # SIZE is only allowed in binary mode
+    ftp.voidcmd("TYPE I")
+    try:
+        offset = ftp.size(name) or 0
+    except ftplib.error_perm:
+        offset = 0
+
+    if offset > size:
+        offset = 0
+    elif offset:
+        # Only skip or resume if the content on the server is verified
+        if _remote_sha256(ftp, name) != _sha256_of_head(path, offset):
+            LOG.warn("FTP: '{f}' on server does not match (or can't be verified), uploading from scratch".format(f=name))
+            offset = 0
+        elif offset == size:
+            LOG.info("FTP: '{f}' already on server (verified), skipping".format(f=name))
+            return 0
+
+    if offset:
+        LOG.info("FTP: Resuming upload of '{f}' at {o}/{s} bytes".format(f=name, o=offset, s=size))
+    with open(path, "rb") as f:
+        f.seek(offset)
+        ftp.storbinary("STOR {f}".format(f=name), f, blocksize=_BLOCK_SIZE, rest=offset if offset else None)
+    return size - offset
+
+
+def _upload(hopo, path, directory, pooled):
+    ftp = _connect(hopo, pooled)
+    try:
+        start = time.time()
+        sent = _store(ftp, path, directory)
+        if sent:
+            _update_stats(hopo, sent, time.time() - start)
+        LOG.debug("FTP: Uploaded '{f}' to '{h}' ({s} bytes)".format(f=path, h=hopo.string, s=sent))
+    except:
+        _close(ftp)
+        raise
+    if pooled:
+        _release(hopo, ftp)
+    else:
+        _close(ftp)
+
+
+def upload(hopo, files, last, directory="/incoming"):
+    """
+    Upload files in parallel, then the 'last' file (usually the changes).
+
+    'last' is uploaded on a fresh (not pooled) connection that
+    is closed afterwards: mini-buildd's ftpd processes changes
+    on disconnect, and checks for cruft in the files of the
+    session.
+    """
+    if files:
+        pool = multiprocessing.pool.ThreadPool(min(_PARALLEL, len(files)))
+        try:
+            # get() re-raises the first exception from any upload
+            pool.map_async(lambda f: _upload(hopo, f, directory, pooled=True), files).get(timeout=24 * 60 * 60)
+        finally:
+            pool.terminate()
+    _upload(hopo, last, directory, pooled=False)
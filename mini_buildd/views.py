@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import re
 import pickle
 import logging
 
@@ -123,7 +124,8 @@ def log(request, repository, package, version):
 
         return {"changes": mini_buildd.misc.open_utf8(pkg_log.changes).read() if pkg_log.changes else None,
                 "changes_path": pkg_log.make_relative(pkg_log.changes) if pkg_log.changes else None,
-                "buildlogs": dict((k, pkg_log.make_relative(v)) for k, v in pkg_log.buildlogs.iteritems())}
+                # Link compressed build logs via their plain name (decompressed on the fly by httpd)
+                "buildlogs": dict((k, re.sub(r"\.gz$", "", pkg_log.make_relative(v))) for k, v in pkg_log.buildlogs.iteritems())}
 
     return django.shortcuts.render(request,
                                    "mini_buildd/log.html",
@@ -194,7 +196,13 @@ def api(request):
 
         # Generate API call output
         response = None
-        if output == "html":
+        stream = api_cmd.get_stream()
+        if stream is not None:
+            # Streamed output is always plain (chunked transfer)
+            response = django.http.StreamingHttpResponse((chunk.encode(mini_buildd.setup.CHAR_ENCODING) for chunk in stream),
+                                                         content_type="text/plain; charset={charset}".format(charset=mini_buildd.setup.CHAR_ENCODING))
+
+        elif output == "html":
             response = django.shortcuts.render(request,
                                                ["mini_buildd/api_{c}.html".format(c=command),
                                                 "mini_buildd/api_default.html".format(c=command)],
@@ -209,6 +217,10 @@ def api(request):
             response = django.http.HttpResponse(pickle.dumps(api_cmd, pickle.HIGHEST_PROTOCOL),
                                                 content_type="application/python-pickle")
 
+        elif output == "json":
+            response = django.http.HttpResponse(api_cmd.get_json(),
+                                                content_type="application/json; charset={charset}".format(charset=mini_buildd.setup.CHAR_ENCODING))
+
         elif output[:7] == "referer":
             # Add all plain result lines as info messages on redirect
             for l in api_cmd.__unicode__().splitlines():